@@ -0,0 +1,354 @@
+""" end-to-end benchmark of the uploader against local stand-in services
+
+Generates synthetic recordings with ffmpeg's lavfi test sources, starts
+stand-ins for PeerTube, Vimeo, WordPress and SMTP, runs uploader.main on
+them and reports wall time, CPU time, peak RSS and bytes moved per stage.
+
+    python bench/benchmark.py --sermons 2 --baptisms 1 --duration 300 \\
+        --latency 0.05 --bandwidth 20
+
+CPU time is the time of the calling thread plus the ffmpeg children of
+the extraction stage, bytes moved are the bytes read and written by the
+calling thread (sockets included) plus the files ffmpeg read and wrote.
+Both are approximate while stages overlap in different threads.
+"""
+
+import argparse
+import datetime
+import functools
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "src"))
+sys.path.insert(0, BENCH_DIR)
+
+import standins  # noqa: E402
+
+# stage -> uploader functions measured as that stage
+STAGES = [
+    ("scan", ["scan_recordings"]),
+    ("clip", ["clip_sermon"]),
+    ("extraction", ["demux_audio_track", "analyze_audio",
+                    "convert_video_to_audio", "compute_peaks",
+                    "package_hls"]),
+    ("thumbnail", ["create_thumbnail"]),
+    ("upload", ["upload_sermon_to_peertube", "upload_sermon_to_vimeo",
+                "upload_baptism_to_vimeo", "upload_audio_to_wordpress",
+                "copy_audio_to_wordpress", "publish_hls"]),
+    ("post", ["create_wordpress_post", "send_queued_posts"]),
+    ("notification", ["send_baptism_online_notification"]),
+    ("archive", ["archive_file"]),
+]
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+# bytes ffmpeg moves in its own process and /proc/thread-self cannot see
+CHILD_BYTES = {
+    # the part of the video that is read is about as large as the clip
+    "clip_sermon": lambda args, result: 2 * file_size(result)
+    if result != args[1] else 0,
+    "demux_audio_track": lambda args, result: file_size(result),
+    "analyze_audio": lambda args, result: file_size(args[0]),
+    "compute_peaks": lambda args, result: file_size(args[1]),
+    "package_hls": lambda args, result: file_size(args[1]),
+    "convert_video_to_audio":
+        lambda args, result: file_size(args[0]) + file_size(result),
+}
+
+
+def thread_io():
+    """ returns the bytes read plus written by the calling thread """
+    try:
+        with open("/proc/thread-self/io") as io:
+            counters = dict(line.split(": ") for line in io)
+        return int(counters["rchar"]) + int(counters["wchar"])
+    except (OSError, KeyError):
+        return 0
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss():
+    """ returns the peak RSS in bytes of this process and its children """
+    return 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class StageRecorder(object):
+    """ wraps uploader functions and sums up their cost per stage """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = dict((stage, {"calls": 0, "errors": 0, "wall": 0.0,
+                                    "cpu": 0.0, "peak_rss": 0, "bytes": 0})
+                           for stage, functions in STAGES)
+
+    def wrap(self, module, stage, name):
+        function = getattr(module, name)
+        spawns_children = name in CHILD_BYTES
+
+        @functools.wraps(function)
+        def measured(*args, **kwargs):
+            wall, cpu, io = time.perf_counter(), time.thread_time(), \
+                thread_io()
+            child_cpu = children_cpu() if spawns_children else 0.0
+            result, failed = None, False
+            try:
+                result = function(*args, **kwargs)
+                return result
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                used = {
+                    "wall": time.perf_counter() - wall,
+                    "cpu": time.thread_time() - cpu,
+                    "bytes": thread_io() - io,
+                }
+                if spawns_children:
+                    used["cpu"] += children_cpu() - child_cpu
+                    used["bytes"] += CHILD_BYTES[name](args, result)
+                with self.lock:
+                    totals = self.stages[stage]
+                    totals["calls"] += 1
+                    totals["errors"] += failed
+                    for key, value in used.items():
+                        totals[key] += value
+                    totals["peak_rss"] = max(totals["peak_rss"], peak_rss())
+
+        setattr(module, name, measured)
+
+    def instrument(self, module):
+        for stage, functions in STAGES:
+            for name in functions:
+                if hasattr(module, name):
+                    self.wrap(module, stage, name)
+
+
+def ffmpeg(*args):
+    subprocess.check_call(["ffmpeg", "-nostdin", "-hide_banner",
+                           "-loglevel", "error", "-y"] + list(args))
+
+
+def generate_recordings(search_path, sermons, baptisms, audio_only,
+                        text_only, duration, size):
+    """ writes synthetic recordings named like the ones of the church
+
+    Every recording gets its own tone, so none is a duplicate of another.
+    The first sermon has a sidecar that cuts out its middle third.
+    """
+    sunday = datetime.date(2024, 1, 7)
+    recordings = []
+
+    def video(path):
+        frequency = 220 + 20 * len(recordings)
+        ffmpeg("-f", "lavfi", "-i", "testsrc2=size=%s:rate=25" % size,
+               "-f", "lavfi", "-i",
+               "sine=frequency=%d:sample_rate=48000" % frequency,
+               "-t", str(duration), "-c:v", "libx264", "-preset",
+               "ultrafast", "-g", "50", "-c:a", "aac", "-b:a", "128k", "-shortest",
+               "-movflags", "+faststart", path)
+
+    for number in range(sermons):
+        day = sunday + datetime.timedelta(weeks=number)
+        path = os.path.join(search_path, "%s_Predigt %d_Prediger %d.mp4" % (
+            day.isoformat(), number + 1, number + 1))
+        video(path)
+        recordings.append(path)
+        if number == 0:
+            with open(os.path.splitext(path)[0] + ".txt", "w") as sidecar:
+                sidecar.write("[video]\nstart = %.1f\nend = %.1f\n" % (
+                    duration / 3, duration * 2 / 3))
+    for number in range(baptisms):
+        day = sunday + datetime.timedelta(weeks=number, days=-1)
+        path = os.path.join(search_path, "%s_Taufe.mp4" % day.isoformat())
+        video(path)
+        recordings.append(path)
+    for number in range(audio_only):
+        day = sunday + datetime.timedelta(weeks=sermons + number)
+        path = os.path.join(search_path, "%s_Audio %d_Prediger.mp3" % (
+            day.isoformat(), number + 1))
+        ffmpeg("-f", "lavfi", "-i", "sine=frequency=%d:sample_rate=44100"
+               % (220 + 20 * len(recordings)),
+               "-t", str(duration), "-c:a", "libmp3lame", "-b:a", "128k",
+               path)
+        recordings.append(path)
+    for number in range(text_only):
+        day = sunday + datetime.timedelta(weeks=sermons + audio_only + number)
+        path = os.path.join(search_path, "%s_Text %d_Prediger.txt" % (
+            day.isoformat(), number + 1))
+        with open(path, "w") as text:
+            text.write("Predigt ohne Aufnahme\n")
+        recordings.append(path)
+    return recordings
+
+
+def write_config(workdir, peertube, vimeo, wordpress, smtp, options):
+    """ writes a config.json pointing the uploader to the stand-ins """
+    with open(os.path.join(BENCH_DIR, "..", "config.json")) as template:
+        config = json.load(template)
+
+    config["search_path"] = os.path.join(workdir, "search")
+    config["archive_path"] = os.path.join(workdir, "archive")
+    config["journal_path"] = os.path.join(workdir, "journal.sqlite")
+    config["clip"]["work_path"] = os.path.join(workdir, "clips")
+    config["thumbnail"]["cache_path"] = os.path.join(workdir, "thumbnails")
+    # the stand-ins have their own uplink, never throttle by time of day
+    config["bandwidth"] = {}
+    config["readiness"].update({
+        "initial_delay": 0.5, "max_delay": 2, "run_wait": 60})
+    config["metrics"] = {
+        "textfile": os.path.join(workdir, "sermon_uploader.prom"),
+        "run_log": os.path.join(workdir, "sermon_uploader_runs.jsonl")}
+    config["peertube"].update({
+        "peertube_url": peertube.url,
+        "token_cache": os.path.join(workdir, "peertube_token.json"),
+        "chunk_size": options.chunk_size})
+    config["vimeo"].update({"token": "bench"})
+    config["wordpress"].update({
+        "url": wordpress.url,
+        "rest_media_upload": True,
+        "application_password": "bench",
+        "local_audio_path": os.path.join(workdir, "web"),
+        "post_index_path": os.path.join(workdir, "wordpress_posts.sqlite")})
+    config["mail"].update({
+        "smtp_server": "127.0.0.1", "smtp_port": smtp.port,
+        "starttls": False})
+
+    path = os.path.join(workdir, "config.json")
+    with open(path, "w") as config_file:
+        json.dump(config, config_file, indent=4)
+    return path
+
+
+def print_report(report):
+    print("%-13s %5s %6s %9s %9s %9s %10s %9s" % (
+        "stage", "calls", "errors", "wall s", "cpu s", "rss MB", "MB moved",
+        "MB/s"))
+    rows = list(report["stages"].items()) + [("total", report["total"])]
+    for stage, totals in rows:
+        throughput = totals["bytes"] / totals["wall"] / 1e6 \
+            if totals["wall"] else 0.0
+        print("%-13s %5s %6s %9.3f %9.3f %9.1f %10.1f %9.1f" % (
+            stage, totals.get("calls", ""), totals.get("errors", ""),
+            totals["wall"], totals["cpu"], totals["peak_rss"] / 1e6,
+            totals["bytes"] / 1e6, throughput))
+    print()
+    for service, stats in report["services"].items():
+        print("%-10s %5d requests %10.1f MB received" % (
+            service, stats["requests"], stats["bytes_received"] / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sermons", type=int, default=2)
+    parser.add_argument("--baptisms", type=int, default=1)
+    parser.add_argument("--audio-only", type=int, default=1)
+    parser.add_argument("--text-only", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=60,
+                        help="length of each recording in seconds")
+    parser.add_argument("--size", default="640x360",
+                        help="frame size of the synthetic videos")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=0.0,
+                        help="uplink in Mbit/s per service, 0 is unlimited")
+    parser.add_argument("--chunk-size", type=int, default=10 * 1024 * 1024,
+                        help="PeerTube resumable chunk size in bytes")
+    parser.add_argument("--transcode", type=float, default=1.0,
+                        help="seconds PeerTube transcodes each video")
+    parser.add_argument("--workdir", help="keep recordings and results here")
+    parser.add_argument("--json", help="also write the report to this file")
+    options = parser.parse_args()
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix="sermon-bench-")
+    for directory in ("search", "archive", "archive/Taufe", "web"):
+        os.makedirs(os.path.join(workdir, directory), exist_ok=True)
+
+    print("generating recordings in " + workdir)
+    generate_recordings(os.path.join(workdir, "search"), options.sermons,
+                        options.baptisms, options.audio_only,
+                        options.text_only, options.duration, options.size)
+
+    bandwidth = options.bandwidth * 1e6 / 8 or None
+    services = {
+        "peertube": standins.PeertubeServer(options.latency, bandwidth,
+                                           options.transcode),
+        "vimeo": standins.VimeoServer(options.latency, bandwidth),
+        "wordpress": standins.WordpressServer(options.latency, bandwidth),
+        "smtp": standins.SmtpServer(options.latency),
+    }
+    for server in services.values():
+        server.start()
+    config_path = write_config(workdir, services["peertube"],
+                               services["vimeo"], services["wordpress"],
+                               services["smtp"], options)
+
+    # the stand-ins speak plain http on localhost
+    os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+    try:
+        import vimeo
+        vimeo.VimeoClient.API_ROOT = services["vimeo"].url
+    except ImportError:
+        print("vimeo is not installed, baptism uploads will fail")
+
+    import uploader
+    recorder = StageRecorder()
+    recorder.instrument(uploader)
+
+    sys.argv = ["uploader.py", "--config", config_path]
+    start_cpu = resource.getrusage(resource.RUSAGE_SELF)
+    wall, cpu = time.perf_counter(), children_cpu()
+    with open("/proc/self/io") as process_io:
+        io = dict(line.split(": ") for line in process_io)
+    uploader.main()
+    wall = time.perf_counter() - wall
+    end_cpu = resource.getrusage(resource.RUSAGE_SELF)
+    with open("/proc/self/io") as process_io:
+        end_io = dict(line.split(": ") for line in process_io)
+
+    report = {
+        "options": vars(options),
+        "stages": recorder.stages,
+        "total": {
+            "wall": wall,
+            "cpu": end_cpu.ru_utime + end_cpu.ru_stime -
+            start_cpu.ru_utime - start_cpu.ru_stime + children_cpu() - cpu,
+            "peak_rss": peak_rss(),
+            "bytes": sum(int(end_io[key]) - int(io[key])
+                         for key in ("rchar", "wchar")) +
+            recorder.stages["extraction"]["bytes"],
+        },
+        "services": dict((name, server.stats())
+                         for name, server in services.items()),
+    }
+    print_report(report)
+    if options.json:
+        with open(options.json, "w") as json_file:
+            json.dump(report, json_file, indent=4)
+
+    for server in services.values():
+        server.shutdown()
+    if not options.workdir:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
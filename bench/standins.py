@@ -0,0 +1,466 @@
+""" local stand-ins for the services the uploader talks to
+
+Each server answers just enough of the real API for the uploader to run
+against it. Every server accepts a latency in seconds that is added to
+each request and a bandwidth in bytes per second that limits request and
+response bodies, so a slow church uplink can be reproduced on one machine.
+"""
+
+import json
+import re
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xmlrpc.client import DateTime, Fault
+from xmlrpc.server import SimpleXMLRPCDispatcher
+
+# bytes read or written between two bandwidth checks
+BLOCK_SIZE = 64 * 1024
+
+
+class Throttle(object):
+    """ shares a bandwidth limit between all connections of a server """
+
+    def __init__(self, bandwidth=None):
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+
+    def transfer(self, size):
+        """ blocks until size more bytes fit into the bandwidth """
+        if not self.bandwidth:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next_free = max(self.next_free, now) + \
+                size / float(self.bandwidth)
+            delay = self.next_free - now
+        time.sleep(delay)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """ threaded http server on a free local port with shared counters """
+
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0.0, bandwidth=None):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.throttle = Throttle(bandwidth)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def count(self, received=0, sent=0, requests=0):
+        with self.lock:
+            self.requests += requests
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests,
+                    "bytes_received": self.bytes_received,
+                    "bytes_sent": self.bytes_sent}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ reads bodies and writes answers through the server's throttle """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self, keep=True):
+        """ returns the request body, or only counts it if keep is False """
+        chunks = []
+        size = 0
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                length = int(self.rfile.readline().split(b";")[0], 16)
+                if length == 0:
+                    self.rfile.readline()
+                    break
+                data = self.rfile.read(length)
+                self.rfile.readline()
+                self.server.throttle.transfer(length)
+                size += length
+                if keep:
+                    chunks.append(data)
+        else:
+            remaining = int(self.headers.get("Content-Length") or 0)
+            while remaining > 0:
+                data = self.rfile.read(min(BLOCK_SIZE, remaining))
+                if not data:
+                    break
+                self.server.throttle.transfer(len(data))
+                remaining -= len(data)
+                size += len(data)
+                if keep:
+                    chunks.append(data)
+        self.server.count(received=size)
+        return b"".join(chunks), size
+
+    def reply(self, status, body=b"", headers=None,
+              content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            for start in range(0, len(body), BLOCK_SIZE):
+                block = body[start:start + BLOCK_SIZE]
+                self.server.throttle.transfer(len(block))
+                self.wfile.write(block)
+        self.server.count(sent=len(body))
+
+    def dispatch(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.count(requests=1)
+        url = urlsplit(self.path)
+        self.route(self.command, url.path, parse_qs(url.query))
+
+    def route(self, method, path, query):
+        self.read_body(keep=False)
+        self.reply(404, {"error": "not found"})
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_HEAD = do_DELETE = dispatch
+
+
+class PeertubeHandler(StandInHandler):
+    """ token, account, upload and video state endpoints of peertube """
+
+    def route(self, method, path, query):
+        server = self.server
+        if method == "POST" and path == "/api/v1/users/token":
+            self.read_body()
+            self.reply(200, {"access_token": uuid.uuid4().hex,
+                             "refresh_token": uuid.uuid4().hex,
+                             "token_type": "Bearer",
+                             "expires_in": 86400,
+                             "refresh_token_expires_in": 1209600})
+        elif method == "GET" and path == "/api/v1/users/me":
+            self.reply(200, {"id": 1, "username": "bench",
+                             "videoChannels": [{"id": 1, "name": "bench",
+                                                "displayName": "Bench"}]})
+        elif method == "POST" and path == "/api/v1/videos/upload":
+            self.read_body(keep=False)
+            self.reply(200, {"video": server.new_video()})
+        elif method == "POST" and path == "/api/v1/videos/upload-resumable":
+            self.read_body()
+            upload_id = uuid.uuid4().hex
+            with server.lock:
+                server.sessions[upload_id] = {
+                    "size": int(self.headers["X-Upload-Content-Length"]),
+                    "received": 0}
+            self.reply(201, headers={
+                "Location": "//127.0.0.1:%d%s?upload_id=%s" % (
+                    server.server_address[1], path, upload_id)})
+        elif path == "/api/v1/videos/upload-resumable":
+            self.resumable(method, query.get("upload_id", [""])[0])
+        elif method == "PUT" and path.startswith("/api/v1/videos/"):
+            # thumbnailfile and previewfile of an update
+            self.read_body(keep=False)
+            self.reply(204)
+        elif method == "GET" and path.startswith("/api/v1/videos/"):
+            state = server.video_state(path.split("/")[-1])
+            if state is None:
+                self.reply(404, {"error": "unknown video"})
+            else:
+                self.reply(200, state)
+        else:
+            StandInHandler.route(self, method, path, query)
+
+    def resumable(self, method, upload_id):
+        session = self.server.sessions.get(upload_id)
+        if session is None:
+            self.read_body(keep=False)
+            self.reply(404, {"error": "unknown upload"})
+            return
+        if method == "DELETE":
+            del self.server.sessions[upload_id]
+            self.reply(204)
+            return
+        content_range = self.headers.get("Content-Range", "")
+        match = re.match(r"bytes (\d+)-(\d+)/(\d+)", content_range)
+        if match and int(match.group(1)) != session["received"]:
+            self.read_body(keep=False)
+            self.reply(416)
+            return
+        data, size = self.read_body(keep=False)
+        session["received"] += size
+        if session["received"] >= session["size"]:
+            video = session.get("video") or self.server.new_video()
+            session["video"] = video
+            self.reply(200, {"video": video})
+        elif session["received"] == 0:
+            self.reply(308)
+        else:
+            self.reply(308, headers={
+                "Range": "bytes=0-%d" % (session["received"] - 1)})
+
+
+class PeertubeServer(StandInServer):
+
+    def __init__(self, latency=0.0, bandwidth=None, transcode_time=0.0):
+        StandInServer.__init__(self, PeertubeHandler, latency, bandwidth)
+        self.sessions = {}
+        self.videos = {}
+        self.transcode_time = transcode_time
+
+    def new_video(self):
+        with self.lock:
+            video_id = len(self.videos) + 1
+            video = {"id": video_id, "uuid": str(uuid.uuid4()),
+                     "shortUUID": uuid.uuid4().hex[:22],
+                     "created": time.time()}
+            self.videos[video_id] = video
+        return {"id": video["id"], "uuid": video["uuid"],
+                "shortUUID": video["shortUUID"]}
+
+    def video_state(self, video_id):
+        """ the video is transcoded for transcode_time after the upload """
+        with self.lock:
+            for video in self.videos.values():
+                if video_id in (str(video["id"]), video["uuid"],
+                                video["shortUUID"]):
+                    break
+            else:
+                return None
+        if time.time() - video["created"] < self.transcode_time:
+            state = {"id": 2, "label": "To transcode"}
+        else:
+            state = {"id": 1, "label": "Published"}
+        return {"id": video["id"], "uuid": video["uuid"],
+                "shortUUID": video["shortUUID"], "state": state}
+
+
+class VimeoHandler(StandInHandler):
+    """ upload attempt, tus upload, metadata and pictures of vimeo """
+
+    def route(self, method, path, query):
+        server = self.server
+        if method == "POST" and path == "/me/videos":
+            data = json.loads(self.read_body()[0] or b"{}")
+            with server.lock:
+                video_id = len(server.videos) + 1
+                server.videos[video_id] = {
+                    "size": int(data.get("upload", {}).get("size", 0)),
+                    "offset": 0}
+            self.reply(200, {"uri": "/videos/%d" % video_id,
+                             "upload": {"approach": "tus",
+                                        "upload_link": "%s/upload/%d" % (
+                                            server.url, video_id)}})
+        elif path.startswith("/upload/"):
+            video = server.videos[int(path.split("/")[-1])]
+            if method == "PATCH":
+                video["offset"] += self.read_body(keep=False)[1]
+                status = 204
+            else:
+                self.read_body(keep=False)
+                status = 200
+            self.reply(status, headers={
+                "Tus-Resumable": "1.0.0",
+                "Upload-Offset": str(video["offset"]),
+                "Upload-Length": str(video["size"])})
+        elif path.startswith("/videos/") and method == "PATCH":
+            self.read_body()
+            self.reply(200, {})
+        elif path.startswith("/videos/") and method == "GET":
+            self.reply(200, {"uri": path, "metadata": {"connections": {
+                "pictures": {"uri": path + "/pictures"}}}})
+        elif path.endswith("/pictures") and method == "POST":
+            self.read_body()
+            self.reply(201, {"uri": path + "/1",
+                             "link": server.url + "/picture" + path})
+        elif path.startswith("/picture/") and method == "PUT":
+            self.read_body(keep=False)
+            self.reply(200, {})
+        else:
+            StandInHandler.route(self, method, path, query)
+
+
+class VimeoServer(StandInServer):
+
+    def __init__(self, latency=0.0, bandwidth=None):
+        StandInServer.__init__(self, VimeoHandler, latency, bandwidth)
+        self.videos = {}
+
+
+class WordpressHandler(StandInHandler):
+    """ XML-RPC (including system.multicall) and REST media of wordpress """
+
+    def route(self, method, path, query):
+        server = self.server
+        if method == "POST" and path.endswith("/xmlrpc.php"):
+            body = self.read_body()[0]
+            self.reply(200, server.dispatcher._marshaled_dispatch(body),
+                       content_type="text/xml")
+        elif method == "POST" and path == "/wp-json/wp/v2/media":
+            size = self.read_body(keep=False)[1]
+            name = re.search(r'filename="([^"]+)"',
+                             self.headers.get("Content-Disposition", ""))
+            media = server.new_media(name.group(1) if name else "upload",
+                                     size)
+            self.reply(201, {"id": media["id"],
+                             "source_url": media["url"]})
+        else:
+            StandInHandler.route(self, method, path, query)
+
+
+class WordpressServer(StandInServer):
+
+    def __init__(self, latency=0.0, bandwidth=None):
+        StandInServer.__init__(self, WordpressHandler, latency, bandwidth)
+        self.posts = {}
+        self.modified = 0
+        self.media = {}
+        self.dispatcher = SimpleXMLRPCDispatcher(allow_none=True,
+                                                 encoding="utf-8")
+        self.dispatcher.register_multicall_functions()
+        self.dispatcher.register_function(
+            lambda: ["wp.newPost", "wp.editPost", "wp.getPosts",
+                     "wp.uploadFile", "system.multicall"],
+            "mt.supportedMethods")
+        self.dispatcher.register_function(self.new_post, "wp.newPost")
+        self.dispatcher.register_function(self.edit_post, "wp.editPost")
+        self.dispatcher.register_function(self.get_posts, "wp.getPosts")
+        self.dispatcher.register_function(self.upload_file, "wp.uploadFile")
+
+    def new_post(self, blog_id, username, password, content):
+        with self.lock:
+            post_id = str(len(self.posts) + 1)
+            self.posts[post_id] = {"post_id": post_id}
+        self.edit_post(blog_id, username, password, post_id, content)
+        return post_id
+
+    def edit_post(self, blog_id, username, password, post_id, content):
+        post = self.posts.get(str(post_id))
+        if post is None:
+            raise Fault(404, "Invalid post ID.")
+        terms = [{"term_id": str(index), "taxonomy": taxonomy, "name": name}
+                 for taxonomy, names in content.get("terms_names", {}).items()
+                 for index, name in enumerate(names)]
+        with self.lock:
+            post.update(content, terms=terms)
+            self.modified += 1
+            post["modified"] = self.modified
+            post["post_modified_gmt"] = DateTime(time.gmtime())
+        return True
+
+    def get_posts(self, blog_id, username, password, filter=None,
+                  fields=None):
+        filter = filter or {}
+        order = "modified" if filter.get("orderby") == "modified" \
+            else "post_id"
+        with self.lock:
+            posts = sorted(self.posts.values(),
+                           key=lambda post: int(post[order]),
+                           reverse=filter.get("order", "DESC") == "DESC")
+        if fields and "post" not in fields:
+            posts = [dict((name, value) for name, value in post.items()
+                          if name == "post_id" or name in fields)
+                     for post in posts]
+        offset = int(filter.get("offset", 0))
+        return posts[offset:offset + int(filter.get("number", 10))]
+
+    def upload_file(self, blog_id, username, password, data):
+        media = self.new_media(data["name"], len(data["bits"].data))
+        return {"id": media["id"], "file": data["name"],
+                "url": media["url"], "type": data.get("type")}
+
+    def new_media(self, name, size):
+        with self.lock:
+            media_id = len(self.media) + 1
+            media = {"id": media_id, "size": size,
+                     "url": "%s/wp-content/uploads/%s" % (self.url, name)}
+            self.media[media_id] = media
+        return media
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    """ accepts mails without authentication or TLS and counts them """
+
+    def respond(self, line):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.respond("220 stand-in ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip().upper()
+            if command.startswith("EHLO"):
+                self.respond("250-stand-in\r\n250-AUTH PLAIN LOGIN\r\n"
+                             "250 8BITMIME")
+            elif command.startswith("AUTH"):
+                self.respond("235 accepted")
+            elif command.startswith("DATA"):
+                self.respond("354 end with .")
+                size = 0
+                for data in iter(self.rfile.readline, b""):
+                    if data in (b".\r\n", b".\n"):
+                        break
+                    size += len(data)
+                self.server.count(received=size)
+                self.respond("250 queued")
+            elif command.startswith("QUIT"):
+                self.respond("221 bye")
+                return
+            else:
+                self.respond("250 ok")
+
+
+class SmtpServer(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, bandwidth=None):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0),
+                                                 SmtpHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.mails = 0
+        self.bytes_received = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def count(self, received=0):
+        with self.lock:
+            self.mails += 1
+            self.bytes_received += received
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.mails,
+                    "bytes_received": self.bytes_received,
+                    "bytes_sent": 0}
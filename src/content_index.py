@@ -0,0 +1,85 @@
+""" content addressed index of the recordings that were already published
+
+Re-exports under a new name or archived files copied back into the search
+path have the content of a recording that is online already. The index
+finds them by a cheap fingerprint of size, head and tail and confirms a
+candidate with the sha256 of the whole file, so only real matches are
+read completely.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import utils
+
+# stages that describe the local files of a recording, not its content
+LOCAL_STAGES = ("audio", "archive")
+
+
+def fingerprint(path):
+    """ hashes size, first and last megabyte of path, ignoring its name """
+    return utils.sample_digest(path, str(os.stat(path).st_size).encode(
+        "ascii"))
+
+
+class ContentIndex(object):
+    """ sqlite index of fingerprint, sha256 and the outputs of recordings """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS content ("
+                "path TEXT PRIMARY KEY, "
+                "fingerprint TEXT NOT NULL, "
+                "sha256 TEXT, "
+                "outputs TEXT NOT NULL, "
+                "added REAL NOT NULL)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS content_fingerprint "
+                "ON content (fingerprint)")
+
+    def add(self, path, outputs, sha256=None):
+        """ records the archived file at path and the outputs of its stages
+
+        Without sha256 the full hash is computed on the first lookup that
+        matches the fingerprint.
+        """
+        outputs = dict((stage, output) for stage, output in outputs.items()
+                       if stage not in LOCAL_STAGES)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO content VALUES (?, ?, ?, ?, ?)",
+                (path, fingerprint(path), sha256, json.dumps(outputs),
+                 time.time()))
+
+    def lookup(self, path):
+        """ returns the outputs of a recording with the content of path """
+        with self.lock:
+            candidates = self.connection.execute(
+                "SELECT path, sha256, outputs FROM content "
+                "WHERE fingerprint = ?", (fingerprint(path),)).fetchall()
+        if not candidates:
+            return None
+
+        digest = utils.file_digest(path)
+        for known_path, sha256, outputs in candidates:
+            if sha256 is None:
+                if not os.path.exists(known_path):
+                    continue
+                sha256 = utils.file_digest(known_path)
+                with self.lock, self.connection:
+                    self.connection.execute(
+                        "UPDATE content SET sha256 = ? WHERE path = ?",
+                        (sha256, known_path))
+            if sha256 == digest:
+                return json.loads(outputs)
+        return None
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,67 @@
+""" persistent journal of the finished pipeline stages of each recording """
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import utils
+
+
+def recording_key(path):
+    """ identifies a recording by file name, size, mtime and content
+
+    Hashing the first and last megabyte is enough to tell re-exports of a
+    recording apart without reading gigabytes from the file server.
+    """
+    stat = os.stat(path)
+    return utils.sample_digest(path, ("%s\0%d\0%d\0" % (
+        os.path.basename(path), stat.st_size,
+        int(stat.st_mtime))).encode("utf-8"))
+
+
+class Journal(object):
+    """ sqlite backed record of completed stages and their outputs """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS stages ("
+                "recording TEXT NOT NULL, "
+                "path TEXT NOT NULL, "
+                "stage TEXT NOT NULL, "
+                "output TEXT, "
+                "finished REAL NOT NULL, "
+                "PRIMARY KEY (recording, stage))")
+
+    def stages(self, key):
+        """ returns a dict of the finished stages of key and their output """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT stage, output FROM stages WHERE recording = ?",
+                (key,)).fetchall()
+        return dict((stage, json.loads(output)) for stage, output in rows)
+
+    def record(self, key, path, stage, output=None):
+        """ marks stage of key as finished, committed before returning """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)",
+                (key, path, stage, json.dumps(output), time.time()))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def run_stage(journal, key, path, stage, function, *args):
+    """ returns the journaled output of stage or runs and records it """
+    done = journal.stages(key)
+    if stage in done:
+        return done[stage]
+    output = function(*args)
+    journal.record(key, path, stage, output)
+    return output
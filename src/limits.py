@@ -0,0 +1,72 @@
+""" concurrency caps per destination for parallel backlog processing
+
+Each destination (peertube, vimeo, wordpress, smtp) and the CPU bound
+extraction get their own semaphore, so several recordings can be worked
+on at once without overloading one of the services or the machine.
+"""
+
+import functools
+import threading
+from contextlib import ExitStack, contextmanager
+
+DESTINATIONS = ("extraction", "peertube", "vimeo", "wordpress", "smtp")
+
+SEMAPHORES = {}
+
+# destinations whose slots the calling thread uses on behalf of slots()
+LOCAL = threading.local()
+
+
+def configure(concurrency):
+    """ sets the caps from the concurrency section of the config """
+    SEMAPHORES.clear()
+    for destination in DESTINATIONS:
+        SEMAPHORES[destination] = threading.BoundedSemaphore(
+            max(1, int(concurrency.get(destination, 1))))
+
+
+@contextmanager
+def slot(destination):
+    """ waits for a free slot of destination, unlimited if not configured """
+    semaphore = SEMAPHORES.get(destination)
+    if semaphore is None or destination in getattr(LOCAL, "held", ()):
+        yield
+        return
+    with semaphore:
+        yield
+
+
+def limited(destination):
+    """ runs the decorated function within the cap of destination """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with slot(destination):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def slots(*destinations):
+    """ takes the slots of several destinations for work that needs all
+
+    They are always taken in the order of DESTINATIONS. That only rules
+    out a deadlock if the work never takes a further slot through limited
+    while holding these, every destination it uses has to be listed.
+    """
+    with ExitStack() as stack:
+        for destination in DESTINATIONS:
+            if destination in destinations:
+                stack.enter_context(slot(destination))
+        yield frozenset(destinations)
+
+
+def holding(held, function, *args):
+    """ runs function in a worker thread on the slots held by slots() """
+    previous = getattr(LOCAL, "held", frozenset())
+    LOCAL.held = previous | held
+    try:
+        return function(*args)
+    finally:
+        LOCAL.held = previous
@@ -0,0 +1,571 @@
+""" ffmpeg based media helpers for the sermon uploader """
+
+import json
+import logging
+import math
+import os
+import subprocess
+import threading
+
+FFMPEG = "ffmpeg"
+FFPROBE = "ffprobe"
+
+# audio file extension -> (ffmpeg encoder, codec name reported by ffprobe)
+AUDIO_CODECS = {
+    "mp3": ("libmp3lame", "mp3"),
+    "m4a": ("aac", "aac"),
+    "aac": ("aac", "aac"),
+    "opus": ("libopus", "opus"),
+    "ogg": ("libvorbis", "vorbis"),
+}
+
+# audio file extension -> MIME type for the source elements of a post
+AUDIO_MIME_TYPES = {
+    "mp3": "audio/mpeg",
+    "m4a": "audio/mp4",
+    "aac": "audio/aac",
+    "opus": "audio/ogg; codecs=opus",
+    "ogg": "audio/ogg",
+    "m3u8": "application/vnd.apple.mpegurl",
+}
+
+# EBU R128 targets of loudnorm, -16 LUFS is common for spoken podcasts
+LOUDNORM_TARGET = {"integrated": -16.0, "true_peak": -1.5, "range": 11.0}
+
+
+class FFmpegError(Exception):
+    """ raised when ffmpeg or ffprobe could not process a file """
+
+
+def probe(path):
+    """ returns the ffprobe description of the streams and format of path """
+    cmd = [FFPROBE, "-v", "error", "-print_format", "json",
+           "-show_format", "-show_streams", path]
+    try:
+        output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise FFmpegError("could not run " + FFPROBE + ": " + str(e))
+    except subprocess.CalledProcessError as e:
+        raise FFmpegError(path + ": " + e.stderr.decode("utf-8", "replace"))
+    return json.loads(output.decode("utf-8"))
+
+
+def get_audio_stream(info):
+    """ returns the first audio stream of a probe result or None """
+    for stream in info.get("streams", []):
+        if stream.get("codec_type") == "audio":
+            return stream
+    return None
+
+
+def get_duration(info):
+    """ returns the duration in seconds of a probe result, 0 if unknown """
+    try:
+        return float(info["format"]["duration"])
+    except (KeyError, ValueError):
+        return 0.0
+
+
+def feed(stdin, pipe):
+    """ copies the file like stdin into the pipe of ffmpeg """
+    try:
+        for block in iter(lambda: stdin.read(1024 * 1024), b""):
+            pipe.write(block)
+    except (BrokenPipeError, OSError) as e:
+        # ffmpeg exited early, its error is reported by run_ffmpeg
+        logging.debug("feeding ffmpeg stopped: " + str(e))
+    finally:
+        if hasattr(stdin, "close"):
+            stdin.close()
+        try:
+            pipe.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+
+def run_ffmpeg(args, duration=0.0, progress=None, outputs=(),
+               loglevel="error", stdin=None, pass_fds=()):
+    """ runs ffmpeg with args and reports progress as (seconds, duration)
+
+    ffmpeg writes its machine readable progress to stdout, errors are
+    collected from stderr and raised as FFmpegError. Files listed in
+    outputs are removed when ffmpeg fails, so no half written file stays.
+    The file like stdin is fed to the input pipe:0. The write ends of
+    pipes in pass_fds are handed to ffmpeg as pipe:<fd> and closed here,
+    so their readers see the end when ffmpeg exits. Returns what ffmpeg
+    wrote to stderr.
+    """
+    cmd = [FFMPEG, "-hide_banner", "-loglevel", loglevel, "-y",
+           "-progress", "pipe:1", "-nostats"] + list(args)
+    if stdin is None:
+        cmd.insert(1, "-nostdin")
+    logging.debug("running " + " ".join(cmd))
+    try:
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE if stdin is not None else None,
+            pass_fds=pass_fds)
+    except OSError as e:
+        raise FFmpegError("could not run " + FFMPEG + ": " + str(e))
+    finally:
+        for fd in pass_fds:
+            os.close(fd)
+
+    # drain stderr in the background so a chatty ffmpeg never blocks
+    errors = []
+    error_reader = threading.Thread(
+        target=lambda: errors.append(process.stderr.read()))
+    error_reader.start()
+    if stdin is not None:
+        feeder = threading.Thread(target=feed, args=(stdin, process.stdin))
+        feeder.start()
+
+    for line in process.stdout:
+        key, _, value = line.decode("ascii", "replace").strip().partition("=")
+        if progress is None:
+            continue
+        # out_time_ms is in microseconds as well, despite its name
+        if key in ("out_time_us", "out_time_ms"):
+            try:
+                done = int(value) / 1000000.0
+            except ValueError:
+                # N/A before the first packet was written
+                continue
+            if done >= 0:
+                progress(done, duration)
+        elif key == "progress" and value == "end":
+            progress(duration, duration)
+
+    process.wait()
+    error_reader.join()
+    if stdin is not None:
+        feeder.join()
+    if process.returncode != 0:
+        for output in outputs:
+            if os.path.exists(output):
+                os.remove(output)
+        raise FFmpegError("ffmpeg exited with %d: %s" % (
+            process.returncode, b"".join(errors).decode("utf-8", "replace")))
+    return b"".join(errors).decode("utf-8", "replace")
+
+
+def extract_audio(video_path, audio_path, sample_rate=44100, channels=2,
+                  bitrate="128k", progress=None):
+    """ writes the audio track of video_path to audio_path
+
+    Only the audio stream is mapped, so the video is never decoded. When
+    the source audio already has the codec of the target file it is copied
+    without re-encoding.
+    """
+    info = probe(video_path)
+    stream = get_audio_stream(info)
+    if stream is None:
+        raise FFmpegError(video_path + " has no audio stream")
+
+    extension = os.path.splitext(audio_path)[1].lstrip(".").lower()
+    if extension not in AUDIO_CODECS:
+        raise FFmpegError("unsupported audio format: " + extension)
+    encoder, codec = AUDIO_CODECS[extension]
+
+    if stream.get("codec_name") == codec:
+        logging.info("copying %s audio stream of %s", codec, video_path)
+        codec_args = ["-c:a", "copy"]
+    else:
+        codec_args = ["-c:a", encoder, "-b:a", bitrate,
+                      "-ar", str(sample_rate), "-ac", str(channels)]
+
+    run_ffmpeg(["-i", video_path, "-map", "0:a:0", "-vn", "-sn", "-dn"] +
+               codec_args + [audio_path],
+               get_duration(info), progress, outputs=[audio_path])
+    return audio_path
+
+
+def loudnorm_filter(target=None, measured=None):
+    """ returns the loudnorm filter for target, linear with a measurement
+
+    Without a measurement loudnorm normalizes dynamically in one pass.
+    With the result of measure_loudness it applies one constant gain, the
+    second pass of the EBU R128 two pass normalization.
+    """
+    target = dict(LOUDNORM_TARGET, **(target or {}))
+    arguments = "loudnorm=I=%s:TP=%s:LRA=%s" % (
+        target["integrated"], target["true_peak"], target["range"])
+    if measured is not None:
+        arguments += (":measured_I=%s:measured_TP=%s:measured_LRA=%s"
+                      ":measured_thresh=%s:offset=%s:linear=true" % (
+                          measured["input_i"], measured["input_tp"],
+                          measured["input_lra"], measured["input_thresh"],
+                          measured["target_offset"]))
+    return arguments
+
+
+def select_filter(segments):
+    """ returns the filter keeping only the [start, end] seconds segments """
+    return "aselect='%s',asetpts=N/SR/TB" % "+".join(
+        "between(t,%.3f,%.3f)" % (start, end) for start, end in segments)
+
+
+def measure_loudness(path, target=None, progress=None, pcm=None):
+    """ runs the analysis pass of loudnorm over the audio of path
+
+    Returns the measured input_i, input_tp, input_lra, input_thresh and
+    target_offset, or None for silence, which cannot be normalized. With
+    pcm as (sample_rate, consume) the decoded audio is also streamed to
+    consume as mono 16 bit PCM, so other analyses need no decode of their
+    own.
+    """
+    info = probe(path)
+    if get_audio_stream(info) is None:
+        raise FFmpegError(path + " has no audio stream")
+    analysis = loudnorm_filter(target) + ":print_format=json"
+    if pcm is None:
+        output = run_ffmpeg(
+            ["-i", path, "-map", "0:a:0", "-vn", "-sn", "-dn",
+             "-af", analysis, "-f", "null", "-"],
+            get_duration(info), progress, loglevel="info")
+    else:
+        sample_rate, consume = pcm
+        write_fd, reader = pcm_reader(consume)
+        try:
+            output = run_ffmpeg(
+                ["-i", path, "-filter_complex",
+                 "[0:a:0]asplit=2[m][p];[m]%s[n]" % analysis,
+                 "-map", "[n]", "-f", "null", "-", "-map", "[p]"] +
+                pcm_output(write_fd, sample_rate),
+                get_duration(info), progress, loglevel="info",
+                pass_fds=(write_fd,))
+        finally:
+            reader.join()
+        if reader.error is not None:
+            raise reader.error
+
+    # loudnorm prints its JSON summary as the last block of the log
+    start, end = output.rfind("{"), output.rfind("}")
+    if start < 0 or end < start:
+        raise FFmpegError("no loudness measurement for " + path)
+    measured = json.loads(output[start:end + 1])
+    if not math.isfinite(float(measured["input_i"])):
+        logging.warning("%s is silent, not normalizing it", path)
+        return None
+    return dict((key, measured[key]) for key in (
+        "input_i", "input_tp", "input_lra", "input_thresh", "target_offset"))
+
+
+def pcm_reader(consume):
+    """ returns (write fd, thread) of a pipe whose reader calls consume
+
+    consume gets the read end as a binary file and reads it to the end.
+    An exception it raises is kept in thread.error.
+    """
+    read_fd, write_fd = os.pipe()
+
+    def run():
+        try:
+            with os.fdopen(read_fd, "rb") as stream:
+                consume(stream)
+                # drain, ffmpeg must never block on a reader that stopped
+                while stream.read(1024 * 1024):
+                    pass
+        except Exception as e:
+            thread.error = e
+
+    thread = threading.Thread(target=run, name="pcm")
+    thread.error = None
+    thread.start()
+    return write_fd, thread
+
+
+def pcm_output(write_fd, sample_rate):
+    """ returns the output arguments of mono 16 bit PCM into write_fd """
+    return ["-ac", "1", "-ar", str(sample_rate), "-c:a", "pcm_s16le",
+            "-f", "s16le", "pipe:%d" % write_fd]
+
+
+def decode_pcm(path, sample_rate, consume, progress=None):
+    """ streams the audio of path as mono 16 bit PCM to consume(stream) """
+    info = probe(path)
+    if get_audio_stream(info) is None:
+        raise FFmpegError(path + " has no audio stream")
+    write_fd, reader = pcm_reader(consume)
+    try:
+        run_ffmpeg(["-i", path, "-map", "0:a:0", "-vn", "-sn", "-dn"] +
+                   pcm_output(write_fd, sample_rate),
+                   get_duration(info), progress, pass_fds=(write_fd,))
+    finally:
+        reader.join()
+    if reader.error is not None:
+        raise reader.error
+
+
+def hls_output(rendition, codec):
+    """ returns the options of the HLS muxer writing rendition
+
+    The playlist at the path of rendition lists segments of segment_time
+    seconds next to it. Their names are fixed, the URIs in the playlist
+    must not inherit spaces from the name of the sermon. AAC is segmented
+    as MPEG-TS, other codecs like Opus need fragmented MP4.
+    """
+    directory = os.path.dirname(rendition["path"])
+    options = ["-f", "hls", "-hls_playlist_type", "vod",
+               "-hls_time", str(rendition.get("segment_time", 6))]
+    if codec == "aac":
+        return options + ["-hls_segment_type", "mpegts",
+                          "-hls_segment_filename",
+                          os.path.join(directory, "segment_%05d.ts")]
+    return options + ["-hls_segment_type", "fmp4",
+                      "-hls_fmp4_init_filename", "init.mp4",
+                      "-hls_segment_filename",
+                      os.path.join(directory, "segment_%05d.m4s")]
+
+
+def encode_renditions(source, renditions, target=None, measured=None,
+                      progress=None, pcm=None, segments=None):
+    """ decodes the audio of source once and encodes every rendition
+
+    renditions are dicts with path, bitrate, sample_rate, channels and an
+    optional filter, the codec follows the extension of path. A path
+    ending in .m3u8 is written as HLS segments of codec. The decoded
+    and normalized audio is split inside ffmpeg, so adding a rendition only
+    costs its encoder. target None skips the loudness normalization. With
+    pcm as (sample_rate, consume) the same audio is also streamed to
+    consume as mono 16 bit PCM, e.g. for its waveform. segments limits
+    every output to those [start, end] seconds of source.
+    """
+    info = probe(source)
+    if get_audio_stream(info) is None:
+        raise FFmpegError(source + " has no audio stream")
+
+    normalize = loudnorm_filter(target, measured) if target is not None \
+        else "anull"
+    if segments:
+        normalize = select_filter(segments) + "," + normalize
+    branches = len(renditions) + (1 if pcm is not None else 0)
+    graph = ["[0:a:0]%s,asplit=%d%s" % (
+        normalize, branches,
+        "".join("[s%d]" % number for number in range(branches)))]
+    outputs = []
+    for number, rendition in enumerate(renditions):
+        extension = os.path.splitext(rendition["path"])[1].lstrip(".").lower()
+        codec = rendition.get("codec", "aac") if extension == "m3u8" \
+            else extension
+        if codec not in AUDIO_CODECS:
+            raise FFmpegError("unsupported audio format: " + codec)
+        label = "[s%d]" % number
+        if rendition.get("filter"):
+            graph.append("%s%s[r%d]" % (label, rendition["filter"], number))
+            label = "[r%d]" % number
+        outputs += ["-map", label, "-c:a", AUDIO_CODECS[codec][0],
+                    "-b:a", str(rendition.get("bitrate", "128k")),
+                    "-ar", str(rendition.get("sample_rate", 44100)),
+                    "-ac", str(rendition.get("channels", 2))]
+        if extension == "m4a":
+            outputs += ["-movflags", "+faststart"]
+        elif extension == "m3u8":
+            outputs += hls_output(rendition, codec)
+        outputs.append(rendition["path"])
+
+    paths = [rendition["path"] for rendition in renditions]
+    if pcm is None:
+        run_ffmpeg(["-i", source, "-filter_complex", ";".join(graph)] +
+                   outputs, get_duration(info), progress, outputs=paths)
+        return paths
+
+    sample_rate, consume = pcm
+    write_fd, reader = pcm_reader(consume)
+    try:
+        outputs += ["-map", "[s%d]" % len(renditions)] + pcm_output(
+            write_fd, sample_rate)
+        run_ffmpeg(["-i", source, "-filter_complex", ";".join(graph)] +
+                   outputs, get_duration(info), progress, outputs=paths,
+                   pass_fds=(write_fd,))
+    finally:
+        reader.join()
+    if reader.error is not None:
+        raise reader.error
+    return paths
+
+
+def is_faststart(path):
+    """ tells if the MP4 at path has its moov box before the media data
+
+    Only then ffmpeg can demux it from a pipe, without seeking to the end.
+    """
+    import struct
+
+    with open(path, "rb") as data:
+        for _ in range(16):
+            header = data.read(8)
+            if len(header) < 8:
+                return False
+            size, box = struct.unpack(">I4s", header)
+            if box == b"moov":
+                return True
+            if box == b"mdat" or size == 0:
+                return False
+            if size == 1:
+                size = struct.unpack(">Q", data.read(8))[0] - 8
+            elif size < 8:
+                return False
+            data.seek(size - 8, os.SEEK_CUR)
+    return False
+
+
+def demux_audio(video_path, audio_path, stdin=None, progress=None):
+    """ copies the first audio stream of video_path into audio_path
+
+    With stdin the video is read from that file like object instead, e.g.
+    a consumer of a Tee. The stream is not re-encoded, so audio_path is
+    small and can be measured and encoded locally afterwards.
+    """
+    info = probe(video_path)
+    if get_audio_stream(info) is None:
+        raise FFmpegError(video_path + " has no audio stream")
+    run_ffmpeg(["-i", "pipe:0" if stdin is not None else video_path,
+                "-map", "0:a:0", "-vn", "-sn", "-dn", "-c:a", "copy",
+                audio_path],
+               get_duration(info), progress, outputs=[audio_path],
+               stdin=stdin)
+    return audio_path
+
+
+def parse_timestamp(value):
+    """ returns the seconds of "HH:MM:SS.ms", "MM:SS" or plain seconds """
+    seconds = 0.0
+    try:
+        for part in str(value).strip().split(":"):
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        raise ValueError("not a timestamp: " + str(value))
+    return seconds
+
+
+def keyframe_times(path, start, end):
+    """ returns the sorted times of the video keyframes from start to end
+
+    Only the packet headers of that interval are read, nothing is
+    decoded, so this takes a fraction of a second even on a long file.
+    """
+    cmd = [FFPROBE, "-v", "error", "-select_streams", "v:0",
+           "-read_intervals", "%f%%%f" % (max(start, 0.0), end),
+           "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path]
+    try:
+        output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise FFmpegError("could not run " + FFPROBE + ": " + str(e))
+    except subprocess.CalledProcessError as e:
+        raise FFmpegError(path + ": " + e.stderr.decode("utf-8", "replace"))
+    times = []
+    for line in output.decode("ascii", "replace").splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            times.append(float(pts_time))
+    return sorted(times)
+
+
+def snap_to_keyframes(path, start, end=None, window=30.0):
+    """ moves start and end outwards onto keyframes of path
+
+    A stream copy can only start at a keyframe, so start goes back to the
+    last keyframe before it and end forward to the next one, the clip
+    never loses a word. end None or past the last keyframe means the end
+    of the file.
+    """
+    before = [time for time in keyframe_times(path, start - window, start)
+              if time <= start]
+    start = before[-1] if before else 0.0
+    if end is not None:
+        after = [time for time in keyframe_times(path, end, end + window)
+                 if time >= end]
+        end = after[0] if after else None
+    return start, end
+
+
+def clip_video(video_path, clip_path, start, end=None, progress=None):
+    """ copies the part of video_path from start to end into clip_path
+
+    Start and end should be keyframes (see snap_to_keyframes). Nothing is
+    re-encoded, so this runs at the speed of the disk. The clip is written
+    under a hidden name and renamed when complete.
+    """
+    info = probe(video_path)
+    duration = (end if end is not None else get_duration(info)) - start
+    tmp_path = os.path.join(os.path.dirname(clip_path) or ".",
+                            "." + os.path.basename(clip_path))
+    args = ["-ss", "%f" % start, "-i", video_path]
+    if end is not None:
+        args += ["-t", "%f" % duration]
+    args += ["-map", "0:v", "-map", "0:a?", "-c", "copy",
+             "-avoid_negative_ts", "make_zero"]
+    if os.path.splitext(clip_path)[1].lower() in (".mp4", ".m4v", ".mov"):
+        args += ["-movflags", "+faststart"]
+    run_ffmpeg(args + [tmp_path], duration, progress, outputs=[tmp_path])
+    os.replace(tmp_path, clip_path)
+    return clip_path
+
+
+def extract_keyframes(video_path, times, work_dir, width=1280,
+                      small_size=(160, 90)):
+    """ writes the keyframe at or before each of times as JPEG
+
+    Every time is an input of its own with input side seeking, and only
+    keyframes are decoded, so the cost does not grow with the length of
+    the video. Next to each JPEG a small grayscale raw frame for scoring
+    is written. Returns [(time, jpeg path, raw path)].
+    """
+    args = []
+    for time in times:
+        args += ["-skip_frame", "nokey", "-noaccurate_seek",
+                 "-ss", "%f" % time, "-i", video_path]
+    frames = []
+    for number, time in enumerate(times):
+        image = os.path.join(work_dir, "candidate%d.jpg" % number)
+        small = os.path.join(work_dir, "candidate%d.gray" % number)
+        args += ["-map", "%d:v:0" % number, "-frames:v", "1",
+                 "-vf", "scale=%d:-2" % width, "-q:v", "3", image,
+                 "-map", "%d:v:0" % number, "-frames:v", "1",
+                 "-vf", "scale=%d:%d,format=gray" % small_size,
+                 "-f", "rawvideo", small]
+        frames.append((time, image, small))
+    run_ffmpeg(args, outputs=[path for frame in frames for path in frame[1:]])
+    return [frame for frame in frames if os.path.exists(frame[1]) and
+            os.path.getsize(frame[2]) == small_size[0] * small_size[1]]
+
+
+def score_frame(small_path, small_size=(160, 90)):
+    """ rates a grayscale raw frame by sharpness and exposure
+
+    Sharpness is the variance of the Laplacian, scaled down by how far the
+    mean brightness is from mid gray, so fades to black, blank slides and
+    blurred camera moves lose against a sharp, well lit frame.
+    """
+    import numpy
+
+    frame = numpy.fromfile(small_path, dtype=numpy.uint8).reshape(
+        small_size[1], small_size[0]).astype(numpy.float32) / 255.0
+    laplacian = (4 * frame[1:-1, 1:-1] - frame[:-2, 1:-1] -
+                 frame[2:, 1:-1] - frame[1:-1, :-2] - frame[1:-1, 2:])
+    exposure = 1.0 - 2.0 * abs(float(frame.mean()) - 0.5)
+    return float(laplacian.var()) * exposure
+
+
+def create_thumbnail(video_path, thumbnail_path, candidates=6, width=1280):
+    """ writes the best of candidates evenly spread keyframes as JPEG """
+    import shutil
+    import tempfile
+
+    duration = get_duration(probe(video_path))
+    # the very start and end are mostly black or a title slide
+    times = [duration * (number + 1) / (candidates + 1)
+             for number in range(candidates)]
+    work_dir = tempfile.mkdtemp(prefix="sermon-thumbnail-")
+    try:
+        frames = extract_keyframes(video_path, times, work_dir, width)
+        if not frames:
+            raise FFmpegError("no keyframe found in " + video_path)
+        time, image, small = max(
+            frames, key=lambda frame: score_frame(frame[2]))
+        logging.info("thumbnail of %s taken near %.1f s", video_path, time)
+        shutil.move(image, thumbnail_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return thumbnail_path
@@ -0,0 +1,210 @@
+""" trace spans of the pipeline stages and their export
+
+Every stage runs inside a span that records its duration, the bytes it
+moved, how often it had to retry and whether it failed. At the end of a
+run the spans are appended to a JSON lines log and summed up per stage
+into a Prometheus textfile for the node exporter.
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRIC_PREFIX = "sermon_uploader"
+
+
+class Span(object):
+    """ one execution of a stage """
+
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = 0.0
+        self.bytes = 0
+        self.retries = 0
+        self.error = None
+
+    def as_dict(self):
+        data = dict(self.attributes)
+        data.update({"stage": self.stage, "start": self.start,
+                     "duration": self.duration, "bytes": self.bytes,
+                     "retries": self.retries, "error": self.error})
+        return data
+
+
+class Tracer(object):
+    """ collects the spans of one run from all threads """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = []
+        self.run_id = os.urandom(16).hex()
+        self.run_start = time.time()
+
+    @contextmanager
+    def span(self, stage, **attributes):
+        span = Span(stage, attributes)
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = "%s: %s" % (type(e).__name__, e)
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            stack.pop()
+            with self.lock:
+                self.spans.append(span)
+
+    def current(self):
+        """ returns the innermost open span of the calling thread """
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else None
+
+    def pending(self):
+        """ returns the number of spans recorded since the last take """
+        with self.lock:
+            return len(self.spans)
+
+    def take(self):
+        """ returns the spans of the finished run and starts a new one """
+        with self.lock:
+            spans, self.spans = self.spans, []
+            run_id, run_start = self.run_id, self.run_start
+            self.run_id, self.run_start = os.urandom(16).hex(), time.time()
+        return run_id, run_start, spans
+
+
+TRACER = Tracer()
+
+
+def add_bytes(count):
+    """ adds count to the bytes moved by the current stage """
+    span = TRACER.current()
+    if span is not None:
+        span.bytes += count
+
+
+def add_retry():
+    """ counts a retry of the current stage """
+    span = TRACER.current()
+    if span is not None:
+        span.retries += 1
+
+
+def traced(stage, path_arg=None, count_bytes=None):
+    """ runs the decorated function inside a span of stage
+
+    path_arg is the index of the argument naming the recording,
+    count_bytes(args, result) returns the bytes the call moved.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            attributes = {"function": function.__name__}
+            if path_arg is not None and len(args) > path_arg:
+                attributes["recording"] = os.path.basename(
+                    str(args[path_arg]))
+            with TRACER.span(stage, **attributes):
+                result = function(*args, **kwargs)
+                if count_bytes is not None:
+                    add_bytes(count_bytes(args, result))
+                return result
+        return wrapper
+    return decorator
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+def summarize(spans):
+    """ sums up spans per stage """
+    stages = {}
+    for span in spans:
+        totals = stages.setdefault(span.stage, {
+            "calls": 0, "errors": 0, "duration": 0.0, "bytes": 0,
+            "retries": 0})
+        totals["calls"] += 1
+        totals["errors"] += span.error is not None
+        totals["duration"] += span.duration
+        totals["bytes"] += span.bytes
+        totals["retries"] += span.retries
+    return stages
+
+
+def write_prometheus(path, run_start, spans):
+    """ writes the stage totals of a run in the Prometheus text format """
+    metrics = [
+        ("stage_calls", "Stage executions in the last run", "calls"),
+        ("stage_errors", "Failed stage executions in the last run", "errors"),
+        ("stage_duration_seconds", "Time spent in the stage in the last run",
+         "duration"),
+        ("stage_bytes", "Bytes moved by the stage in the last run", "bytes"),
+        ("stage_retries", "Retries of the stage in the last run", "retries"),
+    ]
+    stages = summarize(spans)
+    lines = []
+    for name, help_text, key in metrics:
+        lines.append("# HELP %s_%s %s" % (METRIC_PREFIX, name, help_text))
+        lines.append("# TYPE %s_%s gauge" % (METRIC_PREFIX, name))
+        for stage, totals in sorted(stages.items()):
+            lines.append('%s_%s{stage="%s"} %s' % (
+                METRIC_PREFIX, name, stage, totals[key]))
+
+    lines.append("# HELP %s_stage_throughput_bytes_per_second Bytes per "
+                 "second of the stage in the last run" % METRIC_PREFIX)
+    lines.append("# TYPE %s_stage_throughput_bytes_per_second gauge"
+                 % METRIC_PREFIX)
+    for stage, totals in sorted(stages.items()):
+        if totals["bytes"] and totals["duration"]:
+            lines.append('%s_stage_throughput_bytes_per_second{stage="%s"} '
+                         '%f' % (METRIC_PREFIX, stage,
+                                 totals["bytes"] / totals["duration"]))
+
+    for name, help_text, value in [
+            ("last_run_timestamp_seconds", "Start of the last run",
+             run_start),
+            ("last_run_duration_seconds", "Wall time of the last run",
+             time.time() - run_start)]:
+        lines.append("# HELP %s_%s %s" % (METRIC_PREFIX, name, help_text))
+        lines.append("# TYPE %s_%s gauge" % (METRIC_PREFIX, name))
+        lines.append("%s_%s %f" % (METRIC_PREFIX, name, value))
+
+    # the node exporter must never read a half written file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as textfile:
+        textfile.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def write_run_log(path, run_id, spans):
+    """ appends one JSON line per span to the run log """
+    with open(path, "a") as run_log:
+        for span in spans:
+            data = span.as_dict()
+            data["run"] = run_id
+            run_log.write(json.dumps(data, sort_keys=True) + "\n")
+
+
+def export(metrics_config):
+    """ writes the spans of the finished run to the configured files """
+    run_id, run_start, spans = TRACER.take()
+    try:
+        if metrics_config.get("textfile"):
+            write_prometheus(metrics_config["textfile"], run_start, spans)
+        if metrics_config.get("run_log") and spans:
+            write_run_log(metrics_config["run_log"], run_id, spans)
+    except (OSError, IOError) as e:
+        logging.error("writing metrics failed: " + str(e))
@@ -0,0 +1,104 @@
+""" waveform peaks of an audio track for the player of the post
+
+The waveform player of the theme needs the minimum and maximum of every
+few thousand samples. Computed in the browser it needs the whole MP3
+first, so they are computed here from the decoded PCM while it streams
+out of ffmpeg and published as a small JSON file next to the audio. The
+file follows the audiowaveform JSON format (version 2, 8 bit) for the
+finest zoom level and lists the coarser levels under "levels".
+"""
+
+import json
+
+DEFAULT_SAMPLE_RATE = 8000
+DEFAULT_SAMPLES_PER_PIXEL = (1024, 4096, 16384)
+
+# buckets of the finest level reduced per block read from the stream
+BLOCK_BUCKETS = 256
+
+
+class Peaks(object):
+    """ min and max per bucket of a mono signed 16 bit PCM stream """
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE,
+                 samples_per_pixel=DEFAULT_SAMPLES_PER_PIXEL):
+        self.sample_rate = sample_rate
+        self.samples_per_pixel = sorted(samples_per_pixel)
+        finest = self.samples_per_pixel[0]
+        if any(level % finest for level in self.samples_per_pixel):
+            raise ValueError("zoom levels must be multiples of " + str(finest))
+        self.minimum = None
+        self.maximum = None
+
+    def read(self, stream):
+        """ reduces the PCM read from stream until its end
+
+        Whole blocks of buckets are reduced at once with NumPy, only the
+        samples of an incomplete bucket are carried to the next block.
+        """
+        import numpy
+
+        finest = self.samples_per_pixel[0]
+        minimum, maximum = [], []
+        carry = b""
+        while True:
+            data = stream.read(finest * BLOCK_BUCKETS * 2)
+            if not data:
+                break
+            data = carry + data
+            whole = len(data) // (finest * 2) * finest * 2
+            carry = data[whole:]
+            if not whole:
+                continue
+            buckets = numpy.frombuffer(data[:whole], dtype="<i2").reshape(
+                -1, finest)
+            minimum.append(buckets.min(axis=1))
+            maximum.append(buckets.max(axis=1))
+        if len(carry) >= 2:
+            rest = numpy.frombuffer(carry[:len(carry) // 2 * 2], dtype="<i2")
+            minimum.append(rest.min(keepdims=True))
+            maximum.append(rest.max(keepdims=True))
+        empty = numpy.zeros(0, dtype=numpy.int16)
+        self.minimum = numpy.concatenate(minimum) if minimum else empty
+        self.maximum = numpy.concatenate(maximum) if maximum else empty
+        return self
+
+    def level(self, samples_per_pixel):
+        """ returns (minimum, maximum) arrays at samples_per_pixel """
+        import numpy
+
+        factor = samples_per_pixel // self.samples_per_pixel[0]
+        minimum, maximum = self.minimum, self.maximum
+        if factor == 1 or not len(minimum):
+            return minimum, maximum
+        # the last bucket repeats its own value to fill the group
+        padding = -len(minimum) % factor
+        minimum = numpy.pad(minimum, (0, padding), mode="edge")
+        maximum = numpy.pad(maximum, (0, padding), mode="edge")
+        return (minimum.reshape(-1, factor).min(axis=1),
+                maximum.reshape(-1, factor).max(axis=1))
+
+    def to_json(self):
+        """ returns the levels as audiowaveform JSON with 8 bit values """
+        import numpy
+
+        levels = []
+        for samples_per_pixel in self.samples_per_pixel:
+            minimum, maximum = self.level(samples_per_pixel)
+            data = numpy.empty(2 * len(minimum), dtype=numpy.int8)
+            # the high byte of a 16 bit sample is its 8 bit value
+            data[0::2] = minimum >> 8
+            data[1::2] = maximum >> 8
+            levels.append({"samples_per_pixel": samples_per_pixel,
+                           "length": len(minimum),
+                           "data": data.tolist()})
+        document = {"version": 2, "channels": 1,
+                    "sample_rate": self.sample_rate, "bits": 8}
+        document.update(levels[0])
+        document["levels"] = levels[1:]
+        return document
+
+    def write(self, path):
+        with open(path, "w") as peaks_file:
+            json.dump(self.to_json(), peaks_file, separators=(",", ":"))
+        return path
@@ -0,0 +1,95 @@
+""" local index of the sermon posts that exist on wordpress
+
+Reruns and the audio only and text only sermons must not post a sermon a
+second time. Looking every post up on wordpress would cost a request per
+post, so the posts of the sermon category are kept in a local table keyed
+by date, title and preacher. It is filled once in large pages and then
+only brought up to date with the posts modified since the last sync.
+"""
+
+import html
+import sqlite3
+import threading
+
+
+def normalize(text):
+    """ makes a title comparable to the one wordpress stores """
+    return " ".join(html.unescape(text).split()).casefold()
+
+
+def post_key(date, title, preacher):
+    """ returns the index key of the sermon of date by preacher """
+    return date.isoformat(), normalize(title), normalize(preacher)
+
+
+def parse_post_title(post_title):
+    """ returns (title, preacher) of a "title // preacher" post title """
+    title, separator, preacher = post_title.rpartition(" // ")
+    if not separator:
+        return None, None
+    return title, preacher
+
+
+class PostIndex(object):
+    """ sqlite table of post ids by sermon plus the cursor of the last sync """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS posts ("
+                "date TEXT NOT NULL, "
+                "title TEXT NOT NULL, "
+                "preacher TEXT NOT NULL, "
+                "post_id TEXT NOT NULL, "
+                "PRIMARY KEY (date, title, preacher))")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS posts_id ON posts (post_id)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sync ("
+                "url TEXT PRIMARY KEY, "
+                "modified TEXT NOT NULL)")
+
+    def lookup(self, key):
+        """ returns the id of the post of key or None """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT post_id FROM posts "
+                "WHERE date = ? AND title = ? AND preacher = ?",
+                key).fetchone()
+        return row[0] if row else None
+
+    def add(self, key, post_id):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?)",
+                tuple(key) + (str(post_id),))
+
+    def update(self, entries, modified, url):
+        """ stores [(key, post_id)] of one sync page and its cursor """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?)",
+                [tuple(key) + (str(post_id),) for key, post_id in entries])
+            if modified is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO sync VALUES (?, ?)",
+                    (url, modified))
+
+    def remove(self, post_id):
+        """ forgets a post that does not exist on wordpress anymore """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM posts WHERE post_id = ?", (str(post_id),))
+
+    def cursor(self, url):
+        """ returns the newest modification time seen on url, None at first """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT modified FROM sync WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -1,19 +1,26 @@
 #!/usr/bin/env python2
 # coding: utf-8
 
+import io
 import os
 import mimetypes
 import json
 import logging
 import datetime
+import time
+import threading
 import pytz
-from os.path import splitext, basename, abspath
+from os.path import splitext, basename, abspath, isfile
 from tzlocal import get_localzone
 
 from requests_oauthlib import OAuth2Session
 from oauthlib.oauth2 import LegacyApplicationClient
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 
+from urllib.parse import urljoin
+
+import metrics
+import scheduler
 import utils
 
 PEERTUBE_SECRETS_FILE = 'peertube_secret'
@@ -22,6 +29,13 @@ PEERTUBE_PRIVACY = {
     "unlisted": 2,
     "private": 3
 }
+DEFAULT_CHUNK_SIZE = 10 * 1024 * 1024
+DEFAULT_RETRIES = 5
+UPLOAD_STATE_SUFFIX = '.peertube-upload'
+
+# video states of the peertube api, everything else is still processed
+VIDEO_STATE_PUBLISHED = 1
+VIDEO_STATES_FAILED = (7, 8, 11)
 
 
 def get_authenticated_service(secret):
@@ -98,22 +112,8 @@ def create_playlist(oauth, url, options):
             exit(1)
 
 
-def upload_video(oauth, secret, options):
-
-    def get_userinfo():
-        str_response = oauth.get(url+"/api/v1/users/me").content.decode('utf-8')
-        return json.loads(str_response)
-        #return json.loads(oauth.get(url+"/api/v1/users/me").content)
-
-    def get_file(path):
-        mimetypes.init()
-        return (basename(path), open(abspath(path), 'rb'),
-                mimetypes.types_map[splitext(path)[1]])
-
-    path = options['file']
-    url = str(secret['peertube_url']).rstrip('/')
-    user_info = get_userinfo()
-
+def get_video_fields(options, user_info):
+    """ returns the video metadata fields shared by all upload modes """
     # We need to transform fields into tuple to deal with tags as
     # MultipartEncoder does not support list refer
     # https://github.com/requests/toolbelt/issues/190 and
@@ -122,12 +122,10 @@ def upload_video(oauth, secret, options):
         ("name", options['name'] or splitext(basename(options['file']))[0]),
         ("licence", "1"),
         ("description", "KircheNeuenburg.de"),
-        ("nsfw", "0"),
-        ("videofile", get_file(path))
+        ("nsfw", "0")
     ]
 
-
-        # if no category, set default to 2 (Films)
+    # if no category, set default to 2 (Films)
     fields.append(("category", "2"))
 
     if options['language']:
@@ -136,42 +134,407 @@ def upload_video(oauth, secret, options):
         # if no language, set default to 1 (English)
         fields.append(("language", "en"))
 
-
     fields.append(("commentsEnabled", "1"))
-
-    privacy = None
-
-    
     fields.append(("privacy", str(PEERTUBE_PRIVACY["public"])))
 
     playlist_id = get_default_playlist(user_info)
     fields.append(("channelId", str(playlist_id)))
+    return fields
+
+
+def get_userinfo(oauth, url):
+    str_response = oauth.get(url + "/api/v1/users/me").content.decode('utf-8')
+    return json.loads(str_response)
+
+
+def get_mimetype(path):
+    mimetypes.init()
+    return mimetypes.types_map[splitext(path)[1]]
+
+
+def upload_video(oauth, secret, options, user_info=None):
+
+    def get_file(path):
+        # a stream passed in options replaces reading the file again
+        data = options.get('stream') or open(abspath(path), 'rb')
+        return (basename(path), data, get_mimetype(path))
+
+    path = options['file']
+    url = str(secret['peertube_url']).rstrip('/')
+    user_info = user_info or get_userinfo(oauth, url)
+
+    fields = get_video_fields(options, user_info)
+    fields.append(("videofile", get_file(path)))
 
     multipart_data = MultipartEncoder(fields)
 
     headers = {
         'Content-Type': multipart_data.content_type
     }
+    body = scheduler.ThrottledReader(multipart_data, multipart_data.len,
+                                     deadline=options.get('deadline'))
     response = oauth.post(url + "/api/v1/videos/upload",
-                          data=multipart_data,
+                          data=body,
                           headers=headers)
     if response is not None:
         if response.status_code == 200:
-            jresponse = response.json()
-            jresponse = jresponse['video']
-            uuid = jresponse['uuid']
-            idvideo = str(jresponse['id'])
-            logging.info('Peertube : Video was successfully uploaded.')
-            template = '%s/videos/watch/%s'
-            logging.info(template % (url, uuid))
-            print(template % (url, uuid))
-            return template % (url, uuid)
+            metrics.add_bytes(os.path.getsize(path))
+            return get_watch_url(url, response)
         else:
             logging.error(('Peertube: The upload failed with an unexpected response: '
                            '%s') % response)
             exit(1)
 
 
+def get_watch_url(url, response):
+    jresponse = response.json()
+    jresponse = jresponse['video']
+    uuid = jresponse['uuid']
+    logging.info('Peertube : Video was successfully uploaded.')
+    template = '%s/videos/watch/%s'
+    logging.info(template % (url, uuid))
+    print(template % (url, uuid))
+    return template % (url, uuid)
+
+
+class UploadError(Exception):
+    """ raised when a resumable upload cannot continue in this run """
+
+
+def get_video_state(oauth, url, video_id):
+    """ returns the state id and label of the video with uuid or id """
+    response = oauth.get(url + "/api/v1/videos/" + str(video_id))
+    response.raise_for_status()
+    state = response.json()['state']
+    return state['id'], state.get('label', '')
+
+
+def set_video_thumbnail(oauth, url, video_id, thumbnail):
+    """ sets the image at thumbnail as thumbnail and preview of the video """
+    with open(thumbnail, 'rb') as thumbnail_file, \
+            open(thumbnail, 'rb') as preview_file:
+        multipart_data = MultipartEncoder([
+            ("thumbnailfile", (basename(thumbnail), thumbnail_file,
+                               get_mimetype(thumbnail))),
+            ("previewfile", (basename(thumbnail), preview_file,
+                             get_mimetype(thumbnail)))])
+        response = oauth.put(url + "/api/v1/videos/" + str(video_id),
+                             data=multipart_data,
+                             headers={'Content-Type':
+                                      multipart_data.content_type})
+    response.raise_for_status()
+
+
+def load_upload_state(state_file, path):
+    """ returns the stored resumable session for path if it is still valid """
+    if not isfile(state_file):
+        return None
+    try:
+        with open(state_file) as state_data:
+            state = json.load(state_data)
+    except (OSError, ValueError) as e:
+        logging.warning("Peertube: Ignoring broken upload state " +
+                        state_file + ": " + str(e))
+        return None
+    stat = os.stat(path)
+    if state.get('size') != stat.st_size or \
+            state.get('mtime') != int(stat.st_mtime):
+        logging.info("Peertube: " + path + " changed since the last "
+                     "attempt, starting a new upload session.")
+        return None
+    return state
+
+
+def save_upload_state(state_file, state):
+    """ writes the upload session atomically so a crash never truncates it """
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, 'w') as state_data:
+        json.dump(state, state_data)
+    os.replace(tmp_file, state_file)
+
+
+def parse_range_offset(response):
+    """ returns the next byte to send from the Range header of a 308 """
+    range_header = response.headers.get('Range')
+    if not range_header:
+        return 0
+    # Range: bytes=0-<last received byte>
+    return int(range_header.split('-')[-1]) + 1
+
+
+def create_upload_session(oauth, url, options, user_info, size):
+    path = options['file']
+    data = dict(get_video_fields(options, user_info))
+    data['filename'] = basename(path)
+    headers = {
+        'X-Upload-Content-Length': str(size),
+        'X-Upload-Content-Type': get_mimetype(path)
+    }
+    response = oauth.post(url + "/api/v1/videos/upload-resumable",
+                          json=data, headers=headers)
+    if response.status_code not in (200, 201):
+        raise UploadError('Peertube: Could not create upload session: %s'
+                          % response)
+    # PeerTube answers with a protocol relative location
+    return urljoin(url + "/", response.headers['Location'])
+
+
+def query_upload_offset(oauth, upload_url, size):
+    """ asks the server how many bytes of the session it has received """
+    headers = {
+        'Content-Range': 'bytes */%d' % size,
+        'Content-Length': '0'
+    }
+    response = oauth.put(upload_url, headers=headers)
+    if response.status_code == 308:
+        return parse_range_offset(response), None
+    if response.status_code == 200:
+        return size, response
+    if response.status_code in (404, 410):
+        # the session expired on the server side
+        return None, response
+    # anything else is transient, the session must not be given up for it
+    raise UploadError('Peertube: Could not query the upload offset: %s'
+                      % response)
+
+
+def read_chunk(source, size):
+    """ reads size bytes, or up to the end, from a file or a stream """
+    parts = []
+    while size > 0:
+        part = source.read(size)
+        if not part:
+            break
+        parts.append(part)
+        size -= len(part)
+    return b''.join(parts)
+
+
+def upload_video_resumable(oauth, secret, options, user_info=None):
+    """ uploads the video in chunks and continues an interrupted session
+
+    The session url and the acknowledged offset are stored next to the
+    video, so a later run picks up at the last byte the server confirmed.
+    With options['stream'] the chunks are taken from that sequential
+    stream, the file is only read to repeat data the server lost.
+    """
+    path = options['file']
+    url = str(secret['peertube_url']).rstrip('/')
+    chunk_size = int(options.get('chunk_size') or DEFAULT_CHUNK_SIZE)
+    retries = int(options.get('retries', DEFAULT_RETRIES))
+    state_file = options.get('state_file') or path + UPLOAD_STATE_SUFFIX
+
+    stat = os.stat(path)
+    size = stat.st_size
+    state = load_upload_state(state_file, path)
+    response = None
+    offset = 0
+
+    if state is not None:
+        offset, response = query_upload_offset(oauth, state['upload_url'],
+                                               size)
+        if offset is None:
+            logging.info("Peertube: Upload session expired, starting over.")
+            state = None
+        else:
+            logging.info("Peertube: Resuming upload of %s at byte %d of %d"
+                         % (path, offset, size))
+
+    if state is None:
+        user_info = user_info or get_userinfo(oauth, url)
+        state = {
+            'upload_url': create_upload_session(oauth, url, options,
+                                                user_info, size),
+            'size': size,
+            'mtime': int(stat.st_mtime)
+        }
+        offset = 0
+    state['offset'] = offset
+    save_upload_state(state_file, state)
+
+    failures = 0
+    stream = options.get('stream')
+    chunk, chunk_offset = b'', None
+    with open(abspath(path), 'rb') as video_data:
+        while response is None or response.status_code != 200:
+            if offset != chunk_offset:
+                if stream is not None and stream.position <= offset:
+                    stream.skip(offset - stream.position)
+                    chunk = read_chunk(stream, chunk_size)
+                else:
+                    video_data.seek(offset)
+                    chunk = read_chunk(video_data, chunk_size)
+                chunk_offset = offset
+            end = offset + len(chunk) - 1
+            headers = {
+                'Content-Range': 'bytes %d-%d/%d' % (offset, end, size),
+                'Content-Length': str(len(chunk)),
+                'Content-Type': 'application/octet-stream'
+            }
+            try:
+                body = scheduler.ThrottledReader(
+                    io.BytesIO(chunk), len(chunk), remaining=size - offset,
+                    deadline=options.get('deadline'))
+                response = oauth.put(state['upload_url'], data=body,
+                                     headers=headers)
+            except Exception as e:
+                response = None
+                error = e
+            else:
+                error = None
+                if response.status_code == 308 and \
+                        parse_range_offset(response) > offset:
+                    metrics.add_bytes(parse_range_offset(response) - offset)
+                    offset = parse_range_offset(response)
+                    state['offset'] = offset
+                    save_upload_state(state_file, state)
+                    failures = 0
+                    continue
+                if response.status_code == 200:
+                    metrics.add_bytes(size - offset)
+                    break
+                # a 308 that does not advance counts against the retries
+                # of this offset, otherwise the loop would never end
+                error = response if response.status_code != 308 else \
+                    'the server still acknowledges only byte %d' % \
+                    parse_range_offset(response)
+
+            failures += 1
+            if failures > retries:
+                raise UploadError('Peertube: Giving up after %d failed '
+                                  'chunks at byte %d: %s'
+                                  % (failures, offset, error))
+            metrics.add_retry()
+            logging.warning('Peertube: Chunk at byte %d failed (%s), '
+                            'retrying.' % (offset, error))
+            time.sleep(min(2 ** failures, 60))
+            try:
+                offset, response = query_upload_offset(
+                    oauth, state['upload_url'], size)
+            except Exception:
+                offset, response = state['offset'], None
+            if offset is None:
+                raise UploadError('Peertube: Upload session was lost: %s'
+                                  % response)
+
+    os.remove(state_file)
+    return get_watch_url(url, response)
+
+
+class PeertubeClient(object):
+    """ one authenticated keep-alive session for all uploads of a run
+
+    The OAuth token is cached on disk with its expiry and only refreshed
+    when it is about to expire, the account info is fetched once.
+    """
+
+    # refresh the access token if it expires within this many seconds
+    EXPIRY_MARGIN = 300
+
+    def __init__(self, secret, token_cache=None):
+        self.secret = secret
+        self.url = str(secret['peertube_url']).rstrip('/')
+        self.token_url = self.url + '/api/v1/users/token'
+        self.token_cache = token_cache
+        self.lock = threading.Lock()
+        self.oauth = None
+        self.user_info = None
+
+    def create_session(self, token=None):
+        return OAuth2Session(
+            client=LegacyApplicationClient(
+                client_id=str(self.secret['client_id'])),
+            token=token,
+            auto_refresh_url=self.token_url,
+            auto_refresh_kwargs={
+                'client_id': str(self.secret['client_id']),
+                'client_secret': str(self.secret['client_secret'])
+            },
+            token_updater=self.save_token)
+
+    def load_token(self):
+        if not self.token_cache or not isfile(self.token_cache):
+            return None
+        try:
+            with open(self.token_cache) as token_data:
+                return json.load(token_data)
+        except (OSError, ValueError) as e:
+            logging.warning("Peertube: Ignoring token cache " +
+                            self.token_cache + ": " + str(e))
+            return None
+
+    def save_token(self, token):
+        if not self.token_cache:
+            return
+        tmp_file = self.token_cache + ".tmp"
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as token_data:
+            json.dump(token, token_data)
+        os.replace(tmp_file, self.token_cache)
+
+    def fetch_token(self):
+        logging.info("Peertube: Requesting a new access token.")
+        self.oauth = self.create_session()
+        self.save_token(self.oauth.fetch_token(
+            token_url=self.token_url,
+            # lower as peertube does not store uppercase for pseudo
+            username=str(self.secret['username'].lower()),
+            password=str(self.secret['password']),
+            client_id=str(self.secret['client_id']),
+            client_secret=str(self.secret['client_secret'])
+        ))
+
+    def refresh_token(self):
+        logging.info("Peertube: Refreshing the access token.")
+        try:
+            self.save_token(self.oauth.refresh_token(
+                self.token_url,
+                client_id=str(self.secret['client_id']),
+                client_secret=str(self.secret['client_secret'])))
+        except Exception as e:
+            # the refresh token expired as well
+            logging.info("Peertube: Refresh failed (" + str(e) + ").")
+            self.fetch_token()
+
+    def session(self):
+        """ returns the authenticated session, refreshing it if needed """
+        with self.lock:
+            if self.oauth is None:
+                token = self.load_token()
+                if token is None:
+                    self.fetch_token()
+                else:
+                    self.oauth = self.create_session(token)
+            expires_at = self.oauth.token.get('expires_at', 0)
+            if expires_at - time.time() < self.EXPIRY_MARGIN:
+                self.refresh_token()
+            return self.oauth
+
+    def get_user_info(self):
+        oauth = self.session()
+        with self.lock:
+            if self.user_info is None:
+                self.user_info = get_userinfo(oauth, self.url)
+            return self.user_info
+
+    def get_channel_id(self):
+        return get_default_playlist(self.get_user_info())
+
+    def video_state(self, video_id):
+        return get_video_state(self.session(), self.url, video_id)
+
+    def set_thumbnail(self, video_id, thumbnail):
+        set_video_thumbnail(self.session(), self.url, video_id, thumbnail)
+
+    def upload(self, options, resumable=True):
+        """ uploads the video described by options, returns its watch url """
+        if resumable:
+            return upload_video_resumable(self.session(), self.secret,
+                                          options, self.get_user_info())
+        return upload_video(self.session(), self.secret, options,
+                            self.get_user_info())
+
+
 def run(options):
     secret = RawConfigParser()
     try:
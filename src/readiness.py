@@ -0,0 +1,142 @@
+""" tracks uploaded videos until their platform can play them
+
+PeerTube transcodes a video after the upload, a post published before
+that shows a broken player. The tracker polls all pending videos from
+one thread, each with its own exponential backoff, and hands the action
+of a video to a worker once it is playable, a post and a large archive
+copy must not hold the checks of the other videos. The callers go on
+with other recordings in the meantime.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class VideoFailed(Exception):
+    """ raised by a check when the platform gave up on the video """
+
+
+class ReadinessTracker(object):
+    """ one polling loop for all videos waiting to become playable
+
+    check(item) returns True once the video is playable, False while it
+    is processed and raises VideoFailed if it never will be.
+    """
+
+    def __init__(self, check, initial_delay=10, max_delay=300,
+                 timeout=6 * 3600, workers=1):
+        self.check = check
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.pending = []
+        self.active = 0
+        self.order = itertools.count()
+        self.stopped = False
+        self.actions = ThreadPoolExecutor(max_workers=workers,
+                                          thread_name_prefix="publish")
+        self.thread = threading.Thread(target=self.run, name="readiness")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def track(self, name, item, on_ready):
+        """ runs on_ready() once check(item) reports the video playable """
+        now = time.monotonic()
+        with self.condition:
+            heapq.heappush(self.pending, (now, next(self.order), {
+                "name": name, "item": item, "on_ready": on_ready,
+                "delay": self.initial_delay, "since": now}))
+            self.condition.notify_all()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.pending) + self.active
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (
+                        not self.pending or
+                        self.pending[0][0] > time.monotonic()):
+                    self.condition.wait(
+                        self.pending[0][0] - time.monotonic()
+                        if self.pending else None)
+                if self.stopped:
+                    return
+                due, order, entry = heapq.heappop(self.pending)
+                self.active += 1
+            try:
+                self.poll(entry)
+            finally:
+                with self.condition:
+                    self.active -= 1
+                    self.condition.notify_all()
+
+    def poll(self, entry):
+        """ checks one video, hands on its action or schedules the next check """
+        try:
+            ready = self.check(entry["item"])
+        except VideoFailed as e:
+            logging.error("%s will not become playable: %s", entry["name"], e)
+            return
+        except Exception as e:
+            logging.warning("checking %s failed: %s", entry["name"], e)
+            ready = False
+
+        if ready:
+            # counted as active until the action is done, see wait()
+            with self.condition:
+                self.active += 1
+            self.actions.submit(self.act, entry)
+            return
+
+        now = time.monotonic()
+        if now - entry["since"] > self.timeout:
+            logging.error("%s is still not playable after %d s, giving up",
+                          entry["name"], now - entry["since"])
+            return
+        logging.info("%s is not playable yet, checking again in %d s",
+                     entry["name"], entry["delay"])
+        with self.condition:
+            heapq.heappush(self.pending, (now + entry["delay"],
+                                          next(self.order), entry))
+        entry["delay"] = min(entry["delay"] * 2, self.max_delay)
+
+    def act(self, entry):
+        """ runs the action of a playable video on a worker """
+        try:
+            entry["on_ready"]()
+        except Exception:
+            logging.exception("publishing " + entry["name"] + " failed")
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def wait(self, timeout=None):
+        """ waits until no video is pending or publishing, False on timeout """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.pending or self.active:
+                remaining = None if deadline is None else \
+                    deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def stop(self):
+        """ ends the loop, videos still pending are left to the next run
+
+        Actions already handed to the workers are finished first.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.actions.shutdown(wait=True)
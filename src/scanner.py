@@ -0,0 +1,83 @@
+""" single pass scan of the search path
+
+One os.scandir pass lists the search path and sorts every file into
+sermon or baptism videos, audio only and text only sermons. File names
+are parsed with the precompiled patterns of the filename grammar. Only
+the listing is read, the file types come with it, so no file is stat'ed
+and a slow share costs no round trip per file.
+"""
+
+import datetime
+import os
+import re
+
+# named groups date, title and preacher are picked up as metadata
+DEFAULT_GRAMMAR = {
+    "sermon": "(?P<date>[0-9]{4}-[0,1][0-9]-[0-3][0-9])_"
+              "(?P<title>[\\W\\w]+)_(?P<preacher>[\\W\\w]+)[.][\\W\\w]+",
+    "baptism": "(?P<date>[0-9]{4}-[0,1][0-9]-[0-3][0-9])_Taufe[.][\\W\\w]+",
+}
+
+# kinds of the scan result, files matching no pattern are left out
+KINDS = ("sermon", "baptism", "audio", "text", "extracted", "sidecar")
+
+GRAMMAR = {}
+PATTERNS = []
+
+
+def configure(grammar):
+    """ compiles the filename grammar, grammar overrides the defaults """
+    GRAMMAR.clear()
+    GRAMMAR.update(DEFAULT_GRAMMAR)
+    GRAMMAR.update(grammar)
+    # sermons are tried first, a baptism name never has a preacher part
+    PATTERNS[:] = [(name, re.compile(GRAMMAR[name]))
+                   for name in ("sermon", "baptism")]
+
+
+configure({})
+
+
+def parse_name(file_name):
+    """ returns (pattern name, metadata) of file_name or (None, None) """
+    for name, pattern in PATTERNS:
+        match = pattern.match(file_name)
+        if match:
+            metadata = match.groupdict()
+            metadata["date"] = datetime.datetime.strptime(
+                metadata["date"], "%Y-%m-%d").date()
+            return name, metadata
+    return None, None
+
+
+def scan(path, video_extension, audio_extension, text_extension):
+    """ lists path once and returns {kind: [(path, metadata)]}
+
+    Audio and text files next to a video of the same name are the audio
+    extracted from it and its sidecar, not sermons of their own.
+    """
+    kinds = {video_extension: "video", audio_extension: "audio",
+             text_extension: "text"}
+    found = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            stem, _, extension = entry.name.rpartition(".")
+            if not stem or extension not in kinds or not entry.is_file():
+                continue
+            name, metadata = parse_name(entry.name)
+            if metadata is not None:
+                found.append((kinds[extension], name, stem, entry.path,
+                              metadata))
+
+    video_stems = set(stem for kind, name, stem, file_path, metadata in found
+                      if kind == "video")
+    recordings = dict((kind, []) for kind in KINDS)
+    for kind, name, stem, file_path, metadata in found:
+        if kind == "video":
+            kind = name
+        elif stem in video_stems:
+            kind = "extracted" if kind == "audio" else "sidecar"
+        elif name != "sermon":
+            continue
+        recordings[kind].append((file_path, metadata))
+    return recordings
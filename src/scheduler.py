@@ -0,0 +1,154 @@
+""" bandwidth limits for uploads that share the uplink with the livestream
+
+All upload streams of the process draw from one token bucket. Its rate
+follows the time windows of the bandwidth config, e.g. 2 Mbit/s during
+the Sunday service and full speed at night. A sermon that would miss its
+deadline at the throttled rate is sent at full speed instead.
+"""
+
+import datetime
+import logging
+import threading
+import time
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+# bytes read from an upload body between two checks of the bucket
+BLOCK_SIZE = 64 * 1024
+
+
+def parse_time(value):
+    hour, minute = value.split(":")
+    return datetime.time(int(hour), int(minute))
+
+
+def mbit_to_bytes(mbit):
+    """ converts Mbit/s to bytes per second, None (unlimited) for 0 """
+    return mbit * 1000000 / 8.0 if mbit else None
+
+
+def window_rate(bandwidth_config, now):
+    """ returns the allowed bytes per second at now, None if unlimited """
+    for window in bandwidth_config.get("windows", []):
+        start, end = parse_time(window["start"]), parse_time(window["end"])
+        day = now.weekday()
+        if start <= end:
+            inside = start <= now.time() < end
+        elif now.time() >= start:
+            inside = True
+        else:
+            # past midnight the window still belongs to the day it started
+            day, inside = (day - 1) % 7, now.time() < end
+        if inside and WEEKDAYS[day] in window.get("days", WEEKDAYS):
+            return mbit_to_bytes(window.get("mbit"))
+    return mbit_to_bytes(bandwidth_config.get("default_mbit"))
+
+
+class TokenBucket(object):
+    """ thread safe token bucket, a rate of None means unlimited """
+
+    def __init__(self, rate=None, burst_seconds=1.0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate):
+        with self.lock:
+            if rate != self.rate:
+                logging.info("upload bandwidth set to %s",
+                             "unlimited" if rate is None else
+                             "%.1f Mbit/s" % (rate * 8 / 1000000.0))
+            self.rate = rate
+
+    def consume(self, amount):
+        """ takes amount tokens, sleeping until the bucket has paid them """
+        with self.lock:
+            now = time.monotonic()
+            if self.rate is None:
+                self.tokens, self.updated = 0.0, now
+                return
+            self.tokens = min(self.rate * self.burst_seconds,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # going into debt lets concurrent streams queue up fairly
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+UPLINK = TokenBucket()
+CONFIG = {}
+
+
+def configure(bandwidth_config):
+    """ sets the windows from the bandwidth section of the config """
+    CONFIG.clear()
+    CONFIG.update(bandwidth_config)
+    UPLINK.set_rate(window_rate(CONFIG, datetime.datetime.now()))
+
+
+def current_rate():
+    """ returns the rate of the current time window and applies it """
+    rate = window_rate(CONFIG, datetime.datetime.now())
+    UPLINK.set_rate(rate)
+    return rate
+
+
+def misses_deadline(remaining, deadline):
+    """ tells if remaining bytes at the current rate miss the deadline """
+    rate = current_rate()
+    if deadline is None or rate is None:
+        return False
+    left = (deadline - datetime.datetime.now()).total_seconds()
+    # a deadline that already passed does not justify full speed
+    return 0 < left < remaining / rate
+
+
+def sermon_deadline(metadata):
+    """ returns the time the sermon of metadata should be online by """
+    if not CONFIG.get("sermon_deadline") or metadata.get("date") is None:
+        return None
+    return datetime.datetime.combine(metadata["date"],
+                                     parse_time(CONFIG["sermon_deadline"]))
+
+
+class ThrottledReader(object):
+    """ file like upload body that draws its bytes from the uplink bucket
+
+    requests sends objects with read and __len__ in small blocks with a
+    Content-Length header, so the throttle shapes the actual stream.
+    """
+
+    def __init__(self, source, length, remaining=None, deadline=None):
+        self.source = source
+        self.length = length
+        self.remaining = length if remaining is None else remaining
+        self.deadline = deadline
+        self.checked = 0
+        self.full_speed = False
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.source.read()
+        else:
+            data = self.source.read(min(size, BLOCK_SIZE))
+        if not data:
+            return data
+        # look at the window and the deadline again every few megabytes
+        if self.checked <= 0:
+            self.full_speed = misses_deadline(self.remaining, self.deadline)
+            if self.full_speed:
+                logging.info("sending at full speed to meet the deadline %s",
+                             self.deadline)
+            self.checked = 64 * BLOCK_SIZE
+        self.checked -= len(data)
+        self.remaining -= len(data)
+        if not self.full_speed:
+            UPLINK.consume(len(data))
+        return data
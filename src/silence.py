@@ -0,0 +1,93 @@
+""" silence detection on the decoded audio of a sermon
+
+Recordings start before the sermon and keep running after it, and the
+audio has long pauses in between. The level of every short block of the
+decoded PCM is computed with NumPy while ffmpeg streams it, the parts to
+keep are derived from those levels and applied by the encoding pass.
+"""
+
+DEFAULT_SAMPLE_RATE = 8000
+
+# blocks whose level is reduced together per read from the stream
+READ_BLOCKS = 512
+
+DEFAULTS = {
+    # blocks quieter than this count as silence
+    "threshold_db": -45.0,
+    "block_ms": 100,
+    # pauses longer than min_gap seconds are shortened to keep_gap
+    "min_gap": 5.0,
+    "keep_gap": 1.5,
+    # seconds kept before the first and after the last sound
+    "padding": 0.5,
+}
+
+
+def block_levels(stream, sample_rate=DEFAULT_SAMPLE_RATE, block_ms=100):
+    """ returns the RMS level in dBFS of every block of a mono 16 bit PCM
+
+    Whole blocks are reduced at once, the samples of an incomplete block
+    are carried to the next read.
+    """
+    import numpy
+
+    block = max(1, int(sample_rate * block_ms / 1000))
+    levels = []
+    carry = b""
+    while True:
+        data = stream.read(block * READ_BLOCKS * 2)
+        if not data:
+            break
+        data = carry + data
+        whole = len(data) // (block * 2) * block * 2
+        carry = data[whole:]
+        if not whole:
+            continue
+        samples = numpy.frombuffer(data[:whole], dtype="<i2").reshape(
+            -1, block).astype(numpy.float32) / 32768.0
+        levels.append(numpy.sqrt(numpy.mean(samples * samples, axis=1)))
+    if not levels:
+        return numpy.zeros(0, dtype=numpy.float32)
+    # -120 dBFS stands in for digital silence instead of -inf
+    return 20 * numpy.log10(numpy.maximum(numpy.concatenate(levels), 1e-6))
+
+
+def keep_segments(levels, block_ms=100, threshold_db=-45.0, min_gap=5.0,
+                  keep_gap=1.5, padding=0.5):
+    """ returns the [start, end] seconds to keep, None if nothing is cut
+
+    Leading and trailing silence is dropped up to padding seconds, pauses
+    longer than min_gap are shortened to keep_gap seconds.
+    """
+    import numpy
+
+    block_seconds = block_ms / 1000.0
+    loud = numpy.flatnonzero(levels > threshold_db)
+    if not len(loud):
+        return None
+    duration = len(levels) * block_seconds
+
+    # runs of silent blocks are the steps between consecutive loud blocks
+    gaps = numpy.flatnonzero(numpy.diff(loud) * block_seconds > min_gap)
+    segments = []
+    start = max(0.0, loud[0] * block_seconds - padding)
+    for gap in gaps:
+        end = (loud[gap] + 1) * block_seconds + keep_gap / 2
+        segments.append([round(float(start), 3), round(float(end), 3)])
+        start = loud[gap + 1] * block_seconds - keep_gap / 2
+    end = min(duration, (loud[-1] + 1) * block_seconds + padding)
+    segments.append([round(float(start), 3), round(float(end), 3)])
+
+    if len(segments) == 1 and segments[0][0] <= 0 and \
+            segments[0][1] >= duration:
+        return None
+    return segments
+
+
+def find_segments(stream, silence_config, sample_rate=DEFAULT_SAMPLE_RATE):
+    """ reads the PCM stream and returns its segments to keep """
+    settings = dict(DEFAULTS, **silence_config)
+    levels = block_levels(stream, sample_rate, settings["block_ms"])
+    return keep_segments(levels, settings["block_ms"],
+                         settings["threshold_db"], settings["min_gap"],
+                         settings["keep_gap"], settings["padding"])
@@ -0,0 +1,135 @@
+""" read a file once and hand its bytes to several consumers
+
+The video lives on a network share and is needed by the upload, the
+audio extraction and the hash of the archive check. A Tee reads it once
+in large sequential blocks and puts every block into a bounded queue per
+consumer, so the slowest consumer sets the pace and memory stays at
+consumers * queue_blocks * block_size.
+"""
+
+import hashlib
+import logging
+import os
+import queue
+import threading
+
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+DEFAULT_QUEUE_BLOCKS = 4
+
+
+class TeeConsumer(object):
+    """ sequential file like view of the bytes a Tee reads """
+
+    def __init__(self, tee, queue_blocks):
+        self.tee = tee
+        self.blocks = queue.Queue(queue_blocks)
+        self.closed = False
+        self.position = 0
+        self.buffer = memoryview(b"")
+        self.finished = False
+
+    def __len__(self):
+        # bytes left, like requests and the multipart encoder expect
+        return self.tee.size - self.position
+
+    def put(self, block):
+        """ called by the reader, blocks while the queue is full """
+        while not self.closed:
+            try:
+                self.blocks.put(block, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size=-1):
+        """ returns up to size bytes, b"" at the end of the file """
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(DEFAULT_BLOCK_SIZE), b""))
+        while not self.buffer and not self.finished:
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                self.finished = True
+                raise block
+            if not block:
+                self.finished = True
+            self.buffer = memoryview(block)
+        data = self.buffer[:size].tobytes()
+        self.buffer = self.buffer[len(data):]
+        self.position += len(data)
+        return data
+
+    def skip(self, count):
+        """ drops count bytes, e.g. the part an upload already sent """
+        while count > 0:
+            data = self.read(min(count, DEFAULT_BLOCK_SIZE))
+            if not data:
+                break
+            count -= len(data)
+
+    def close(self):
+        """ stops taking blocks, the other consumers go on without it """
+        self.closed = True
+        while True:
+            try:
+                self.blocks.get_nowait()
+            except queue.Empty:
+                break
+
+
+class Tee(object):
+    """ reads path once and feeds the consumers created before start """
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE,
+                 queue_blocks=DEFAULT_QUEUE_BLOCKS, hash_content=False):
+        self.path = path
+        self.size = os.stat(path).st_size
+        self.block_size = block_size
+        self.queue_blocks = queue_blocks
+        self.hasher = hashlib.sha256() if hash_content else None
+        self.consumers = []
+        self.digest = None
+        self.thread = None
+
+    def consumer(self):
+        consumer = TeeConsumer(self, self.queue_blocks)
+        self.consumers.append(consumer)
+        return consumer
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="tee")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            with open(self.path, "rb", buffering=0) as source:
+                while True:
+                    if all(consumer.closed for consumer in self.consumers):
+                        logging.debug("all readers of " + self.path +
+                                      " are gone")
+                        return
+                    block = source.read(self.block_size)
+                    if self.hasher is not None:
+                        self.hasher.update(block)
+                    for consumer in self.consumers:
+                        consumer.put(block)
+                    if not block:
+                        break
+            if self.hasher is not None:
+                self.digest = self.hasher.hexdigest()
+        except Exception as e:
+            # the consumers raise it from their next read
+            for consumer in self.consumers:
+                consumer.put(e)
+
+    def join(self):
+        """ waits for the reader, returns the sha256 if the file was hashed
+
+        Called once every consumer is done. Consumers that stopped early
+        are closed, so they cannot hold the reader back.
+        """
+        for consumer in self.consumers:
+            consumer.close()
+        if self.thread is not None:
+            self.thread.join()
+        return self.digest
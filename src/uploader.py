@@ -1,5 +1,13 @@
 """ automatic_sermon_uploader """
 
+import threading
+
+import limits
+import metrics
+import scheduler
+from limits import limited
+from metrics import traced
+
 
 def load_config(file_path):
     """ loads configuration from json file specified with path"""
@@ -11,120 +19,405 @@ def load_config(file_path):
     return data
 
 
-def test_get_file_list(tmpdir):
+def create_baptism_video_password(metadata):
+    """ creates a password for video access"""
 
-    empty_list = list("")
-    assert get_file_list("./", "mp3") == empty_list
+    return "taufe" + metadata["date"].strftime("%d%m%Y")
 
 
-def get_file_list(path, file_extension):
-    """ searches all files in path for files matching the file extension """
-    import glob
+def print_progress(name):
+    """ returns a progress callback printing every ten percent of name """
+    state = {"step": -1}
 
-    try:
-        if path.endswith('/'):
-            path = path[:-1]
+    def progress(done, total):
+        if total <= 0:
+            return
+        step = int(done * 10 / total)
+        if step != state["step"]:
+            state["step"] = step
+            print(name + ": " + str(min(step * 10, 100)) + "%")
 
-        file_list = glob.glob(path + "/*." + file_extension)
+    return progress
 
-    except:
-        file_list = []
 
-    return file_list
+def rendition_path(audio_path, rendition):
+    """ returns the path of an additional rendition next to audio_path """
+    import os
+    return os.path.splitext(audio_path)[0] + rendition.get("suffix", "") + \
+        "." + rendition["extension"]
 
 
-def create_baptism_video_password(metadata):
-    """ creates a password for video access"""
+def hls_directory(audio_path, hls_config):
+    """ returns the directory of the HLS segments of audio_path """
+    import os
+    return os.path.splitext(audio_path)[0] + hls_config.get("suffix", "_hls")
 
-    return "taufe" + metadata["date"].strftime("%d%m%Y")
 
+def hls_rendition(audio_path, hls_config, directory=None):
+    """ returns the rendition writing audio_path as HLS into directory """
+    import os
 
-def convert_video_to_audio(file_path, video_extension, audio_extension):
-    """ converts the video file to an audio file """
-    import moviepy.editor as mp
+    directory = directory or hls_directory(audio_path, hls_config)
+    playlist = os.path.basename(os.path.splitext(audio_path)[0]) + ".m3u8"
+    return dict(hls_config, path=os.path.join(directory, playlist))
+
+
+@limited("extraction")
+@traced("loudness", path_arg=0)
+def analyze_audio(file_path, audio_config, loudness=True, silence=True):
+    """ measures the loudness and finds the silence of the audio track
+
+    Both analyses share one decode. Returns the loudness measurement and
+    the [start, end] segments to keep, None for what was not asked for or
+    when there is nothing to normalize or cut.
+    """
+    import media
+    import silence as silence_detection
+
+    found = {}
+    pcm = None
+    if silence:
+        sample_rate = silence_detection.DEFAULT_SAMPLE_RATE
+        pcm = (sample_rate, lambda stream: found.update(
+            segments=silence_detection.find_segments(
+                stream, audio_config["silence"], sample_rate)))
+    measured = None
+    if loudness:
+        measured = media.measure_loudness(
+            file_path, audio_config.get("loudnorm"), pcm=pcm)
+    elif pcm is not None:
+        media.decode_pcm(file_path, pcm[0], pcm[1])
+    return measured, found.get("segments")
+
+
+@limited("extraction")
+@traced("extraction", path_arg=0,
+        count_bytes=lambda args, result: metrics.file_size(result))
+def demux_audio_track(video_path, stream, work_dir):
+    """ copies the audio track of the streamed video into work_dir """
+    import media
+    import os
 
-    try:
-        audio_path = file_path.replace("." + video_extension,
-                                    "." + audio_extension)
-        clip = mp.VideoFileClip(file_path).subclip(0)
-        clip.audio.write_audiofile(audio_path, 44100, 2, 2000,
-                                    None, "128k", None, False, False, False)
-    except:
-        audio_path = ''
+    return media.demux_audio(
+        video_path, os.path.join(work_dir, os.path.basename(video_path) +
+                                 ".mka"), stream)
+
+
+@limited("extraction")
+@traced("extraction", path_arg=0,
+        count_bytes=lambda args, result: metrics.file_size(args[0]) +
+        metrics.file_size(result))
+def convert_video_to_audio(file_path, video_extension, audio_extension,
+                           audio_config=None, loudness=None, source=None,
+                           segments=None):
+    """ converts the video file to an audio file using ffmpeg
+
+    With audio.loudnorm or audio.renditions configured the audio is decoded
+    once, normalized with the loudness measurement and encoded into the
+    main file and every rendition next to it. With audio.hls the same pass
+    writes HLS segments into a directory next to it. Only the [start, end]
+    seconds in segments are encoded, if given. source is read instead of
+    file_path if the audio track was demuxed already.
+    """
+    import media
+    import os
+    import shutil
 
+    audio_config = audio_config or {}
+    audio_path = file_path.replace("." + video_extension,
+                                   "." + audio_extension)
+    progress = print_progress(audio_path.split("/")[-1])
+
+    if not audio_config.get("loudnorm") and \
+            not audio_config.get("renditions") and \
+            not audio_config.get("hls") and not segments:
+        return media.extract_audio(
+            source or file_path, audio_path,
+            sample_rate=audio_config.get("sample_rate", 44100),
+            channels=audio_config.get("channels", 2),
+            bitrate=audio_config.get("bitrate", "128k"),
+            progress=progress)
+
+    renditions = [{"path": audio_path,
+                   "sample_rate": audio_config.get("sample_rate", 44100),
+                   "channels": audio_config.get("channels", 2),
+                   "bitrate": audio_config.get("bitrate", "128k")}]
+    for rendition in audio_config.get("renditions", []):
+        renditions.append(dict(rendition,
+                               path=rendition_path(audio_path, rendition)))
+    if audio_config.get("hls"):
+        # segments of an earlier, failed run must not end up in the playlist
+        directory = hls_directory(audio_path, audio_config["hls"])
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        renditions.append(hls_rendition(audio_path, audio_config["hls"]))
+    pcm = None
+    if audio_config.get("peaks"):
+        # the waveform comes from the same decoded and normalized audio
+        waveform = new_waveform(audio_config)
+        pcm = (waveform.sample_rate, lambda stream: waveform.read(
+            stream).write(peaks_path(audio_path)))
+    media.encode_renditions(source or file_path, renditions,
+                            audio_config.get("loudnorm"), loudness, progress,
+                            pcm, segments)
     return audio_path
 
 
-def get_sermon_metadata(file_path):
-    """ extracts date, title and preacher out of filename """
-    import re
-    import datetime
+def peaks_path(audio_path):
+    import os
 
-    metadata = {"date": None, "title": None, "preacher": None}
+    return os.path.splitext(audio_path)[0] + ".peaks.json"
 
-    file_name = file_path.split("/")[-1]
 
-    regex_match = re.match("(?P<date>[0-9]{4}-[0,1][0-9]-[0-3][0-9])_" +
-                           "(?P<title>[\\W\\w]+)_(?P<preacher>[\\W\\w]+)" +
-                           "[.][\\W\\w]+",
-                           file_name)
+def new_waveform(audio_config):
+    import peaks
 
-    if regex_match:
-        date_raw = regex_match.group("date").split("-")
+    return peaks.Peaks(
+        audio_config["peaks"].get("sample_rate", peaks.DEFAULT_SAMPLE_RATE),
+        audio_config["peaks"].get("samples_per_pixel",
+                                  peaks.DEFAULT_SAMPLES_PER_PIXEL))
 
-        metadata["date"] = datetime.date(int(date_raw[0]), int(date_raw[1]),
-                                         int(date_raw[2]))
-        metadata["title"] = regex_match.group("title")
-        metadata["preacher"] = regex_match.group("preacher")
-    else:
-        metadata = None
 
-    return metadata
+@limited("extraction")
+@traced("peaks", path_arg=1)
+def compute_peaks(audio_config, audio_path, target):
+    """ decodes audio_path once more and writes its waveform peaks """
+    import media
 
+    waveform = new_waveform(audio_config)
+    media.decode_pcm(audio_path, waveform.sample_rate, waveform.read)
+    return waveform.write(target)
 
-def get_baptism_metadata(file_path):
-    """ extracts date out of filename """
-    import re
-    import datetime
 
-    metadata = {"date": None}
+def publish_peaks(config, audio_path):
+    """ moves the waveform peaks of audio_path next to it on wordpress
+
+    They are written by the encoding pass of the audio. Audio that was
+    only copied, or extracted before, is decoded again for them. Returns
+    the url of the peaks or None if the audio is gone already.
+    """
+    import logging
+    import os
+    import shutil
+    import tempfile
+
+    path = peaks_path(audio_path)
+    work_dir = None
+    try:
+        if not os.path.exists(path):
+            if not os.path.exists(audio_path):
+                logging.warning("no waveform for %s, it was published "
+                                "already", audio_path)
+                return None
+            work_dir = tempfile.mkdtemp(prefix="sermon-peaks-")
+            path = compute_peaks(config.get("audio", {}), audio_path,
+                                 os.path.join(work_dir,
+                                              os.path.basename(path)))
+        return copy_audio_to_wordpress(config, path, True)
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+@limited("extraction")
+@traced("hls", path_arg=1)
+def package_hls(audio_config, audio_path, directory):
+    """ encodes audio_path once more into HLS segments in directory """
+    import media
+    import os
 
-    file_name = file_path.split("/")[-1]
+    os.makedirs(directory)
+    media.encode_renditions(audio_path, [
+        hls_rendition(audio_path, audio_config["hls"], directory)])
+    return directory
 
-    regex_match = re.match("(?P<date>[0-9]{4}-[0,1][0-9]-[0-3][0-9])_" +
-                           "Taufe[.][\\W\\w]+",
-                           file_name)
 
-    if regex_match:
-        date_raw = regex_match.group("date").split("-")
+@traced("audio_publish", path_arg=1)
+def publish_hls(config, audio_path):
+    """ moves the HLS segments of audio_path to wordpress in one go
 
-        metadata["date"] = datetime.date(int(date_raw[0]), int(date_raw[1]),
-                                         int(date_raw[2]))
-    else:
-        metadata = None
+    They are written by the encoding pass of the audio. Audio that was
+    only copied, or extracted before, is segmented on its own. Returns the
+    url of the playlist or None if the audio is gone already.
+    """
+    import logging
+    import os
+    import shutil
+    import tempfile
+    import utils
 
-    return metadata
+    hls_config = config["audio"]["hls"]
+    directory = hls_directory(audio_path, hls_config)
+    playlist = os.path.basename(hls_rendition(audio_path, hls_config)["path"])
+    work_dir = None
+    try:
+        if not os.path.exists(os.path.join(directory, playlist)):
+            if not os.path.exists(audio_path):
+                logging.warning("no HLS segments for %s, it was published "
+                                "already", audio_path)
+                return None
+            work_dir = tempfile.mkdtemp(prefix="sermon-hls-")
+            directory = package_hls(config["audio"], audio_path,
+                                    os.path.join(work_dir,
+                                                 os.path.basename(directory)))
+        name = os.path.basename(directory)
+        utils.publish_directory(
+            directory, config["wordpress"]["local_audio_path"] + "/" + name,
+            True)
+        return config["wordpress"]["url"] + "/" + \
+            config["wordpress"]["wp_audio_path"] + "/" + name + "/" + playlist
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+@traced("scan")
+def scan_recordings(config):
+    """ sorts the files of the search path by kind in one directory pass """
+    import scanner
+
+    return scanner.scan(config["search_path"],
+                        config["video_file_extension"],
+                        config["audio_file_extension"],
+                        config["text_file_extension"])
 
 
-def upload_sermon_to_peertube(config, video_path, metadata):
-    """ uploads the video to vimeo using the credentials stored in config """
+def get_sermon_metadata(file_path):
+    """ extracts date, title and preacher out of filename """
+    import scanner
+
+    name, metadata = scanner.parse_name(file_path.split("/")[-1])
+    return metadata if name == "sermon" else None
+
+
+def get_baptism_metadata(file_path):
+    """ extracts date out of filename """
+    import scanner
+
+    name, metadata = scanner.parse_name(file_path.split("/")[-1])
+    return metadata if name == "baptism" else None
+
+
+PEERTUBE_CLIENTS = {}
+PEERTUBE_CLIENTS_LOCK = threading.Lock()
+
+
+def get_peertube_client(config):
+    """ returns the peertube client shared by all uploads of this process """
     import pt_upload
+
+    with PEERTUBE_CLIENTS_LOCK:
+        key = (config['peertube']['peertube_url'],
+               config['peertube']['username'])
+        if key not in PEERTUBE_CLIENTS:
+            secret = dict()
+            secret['peertube_url'] = config['peertube']['peertube_url']
+            secret['client_id'] = config['peertube']['client_id']
+            secret['username'] = config['peertube']['username']
+            secret['password'] = config['peertube']['password']
+            secret['client_secret'] = config['peertube']['client_secret']
+            PEERTUBE_CLIENTS[key] = pt_upload.PeertubeClient(
+                secret, config['peertube'].get('token_cache'))
+        return PEERTUBE_CLIENTS[key]
+
+
+@limited("peertube")
+@traced("upload", path_arg=1)
+def upload_sermon_to_peertube(config, video_path, metadata, stream=None):
+    """ uploads the video to peertube using the credentials stored in config
+
+    stream is a Tee consumer of the video the chunks are taken from.
+    """
     options = dict()
-    secret = dict()
     options['file'] = video_path
     options['name'] = metadata["title"] + " // " +  metadata["preacher"] +  " // Gottesdienst am " +   metadata["date"].strftime("%d.%m.%Y")
     options['language'] = "german"
-    secret['peertube_url'] = config['peertube']['peertube_url']
-    secret['client_id'] = config['peertube']['client_id']
-    secret['username'] = config['peertube']['username']
-    secret['password'] = config['peertube']['password']
-    secret['client_secret'] = config['peertube']['client_secret']
-    oauth = pt_upload.get_authenticated_service(secret)
-    video_uri = pt_upload.upload_video(oauth, secret, options)
+    options['chunk_size'] = config['peertube'].get('chunk_size')
+    options['deadline'] = scheduler.sermon_deadline(metadata)
+    options['stream'] = stream
+    try:
+        video_uri = get_peertube_client(config).upload(
+            options, config['peertube'].get('resumable', True))
+    finally:
+        if stream is not None:
+            stream.close()
     print(video_uri)
     return video_uri
 
 
+VIMEO_CHUNK_SIZE = 8 * 1024 * 1024
+VIMEO_RETRIES = 3
+
+
+def vimeo_upload(vimeo_handle, video_path, deadline=None):
+    """ uploads video_path to vimeo by tus through the uplink throttle
+
+    The vimeo client would send the file itself at full speed, so only the
+    upload attempt is created with it. The chunks are sent here and drawn
+    from the token bucket of the scheduler like every other upload.
+    returns the uri of the video
+    """
+    import io
+    import logging
+    import os
+    import time
+    import requests
+
+    size = os.path.getsize(video_path)
+    attempt = vimeo_handle.post(
+        "/me/videos", data={"upload": {"approach": "tus", "size": size}},
+        params={"fields": "uri,upload"})
+    attempt.raise_for_status()
+    attempt = attempt.json()
+    upload_link = attempt["upload"]["upload_link"]
+
+    offset = 0
+    failures = 0
+    with open(video_path, "rb") as video:
+        while offset < size:
+            video.seek(offset)
+            chunk = video.read(VIMEO_CHUNK_SIZE)
+            try:
+                response = requests.patch(
+                    upload_link, data=scheduler.ThrottledReader(
+                        io.BytesIO(chunk), len(chunk), size - offset,
+                        deadline),
+                    headers={
+                        "Tus-Resumable": "1.0.0",
+                        "Upload-Offset": str(offset),
+                        "Content-Type": "application/offset+octet-stream"})
+                response.raise_for_status()
+                acknowledged = int(response.headers["Upload-Offset"])
+            except (requests.RequestException, KeyError, ValueError) as e:
+                acknowledged, error = offset, e
+            else:
+                error = "the offset did not advance"
+            if acknowledged > offset:
+                offset, failures = acknowledged, 0
+                continue
+            failures += 1
+            if failures > VIMEO_RETRIES:
+                raise IOError("Vimeo: giving up at byte %d of %s: %s" % (
+                    offset, video_path, error))
+            logging.warning("Vimeo: chunk at byte %d failed (%s), retrying",
+                            offset, error)
+            time.sleep(2 ** failures)
+            # the server may have kept part of the chunk
+            try:
+                head = requests.head(upload_link,
+                                     headers={"Tus-Resumable": "1.0.0"})
+                head.raise_for_status()
+                offset = int(head.headers["Upload-Offset"])
+            except (requests.RequestException, KeyError, ValueError) as e:
+                # the chunk is sent again from the last known offset
+                failures += 1
+                logging.warning("Vimeo: offset query failed (%s)", e)
+    return attempt["uri"]
+
+
+@limited("vimeo")
+@traced("upload", path_arg=1,
+        count_bytes=lambda args, result: metrics.file_size(args[1]))
 def upload_sermon_to_vimeo(config, video_path, metadata):
     """ uploads the video to vimeo using the credentials stored in config """
     import vimeo
@@ -134,7 +427,8 @@ def upload_sermon_to_vimeo(config, video_path, metadata):
         key=config["vimeo"]["key"],
         secret=config["vimeo"]["secret"])
 
-    video_uri = vimeo_handle.upload(video_path)
+    video_uri = vimeo_upload(vimeo_handle, video_path,
+                             scheduler.sermon_deadline(metadata))
 
     vimeo_handle.patch(video_uri, data={'name': metadata["title"] + " // " +
                                         metadata["preacher"] +
@@ -145,6 +439,9 @@ def upload_sermon_to_vimeo(config, video_path, metadata):
     return video_uri
 
 
+@limited("vimeo")
+@traced("upload", path_arg=1,
+        count_bytes=lambda args, result: metrics.file_size(args[1]))
 def upload_baptism_to_vimeo(config, video_path, metadata):
     """ uploads the video to vimeo using the credentials stored in config """
     import vimeo
@@ -154,7 +451,7 @@ def upload_baptism_to_vimeo(config, video_path, metadata):
         key=config["vimeo"]["key"],
         secret=config["vimeo"]["secret"])
 
-    video_uri = vimeo_handle.upload(video_path)
+    video_uri = vimeo_upload(vimeo_handle, video_path)
 
     vimeo_handle.patch(video_uri, data={'name': "Zur Erinnerung " +
                                         "an die Taufe am " +
@@ -169,17 +466,30 @@ def upload_baptism_to_vimeo(config, video_path, metadata):
     return video_uri
 
 
+def wordpress_rest_auth(config):
+    """ returns the basic auth of the wordpress REST api """
+    # the REST api does not accept the login password
+    if not config["wordpress"].get("application_password"):
+        raise ValueError("wordpress.rest_media_upload needs an "
+                         "application password in "
+                         "wordpress.application_password")
+    return (config["wordpress"]["user"],
+            config["wordpress"]["application_password"])
+
+
+@limited("wordpress")
+@traced("upload", path_arg=1,
+        count_bytes=lambda args, result: metrics.file_size(args[1]))
 def upload_audio_to_wordpress(config, audio_path):
     """uploads the audio to wordpress using the credentials stored in config"""
     import mimetypes
-    from wordpress_xmlrpc import Client
+
+    if config["wordpress"].get("rest_media_upload"):
+        return upload_audio_to_wordpress_rest(config, audio_path)
+
     from wordpress_xmlrpc.compat import xmlrpc_client
     from wordpress_xmlrpc.methods import media
 
-    wordpress_handle = Client(
-        config["wordpress"]["url"] + "/xmlrpc.php",
-        config["wordpress"]["user"], config["wordpress"]["password"])
-
     audio_name = audio_path.split("/")[-1]
 
     audio_mime_type = mimetypes.guess_type(audio_path)
@@ -192,34 +502,89 @@ def upload_audio_to_wordpress(config, audio_path):
     with open(audio_path, 'rb') as audio_data:
         data['bits'] = xmlrpc_client.Binary(audio_data.read())
 
-    response = wordpress_handle.call(media.UploadFile(data))
+    response = get_wordpress_publisher(config).call(media.UploadFile(data))
 
     return response['url']
 
 
-def copy_audio_to_wordpress(config, audio_path):
+def upload_audio_to_wordpress_rest(config, audio_path):
+    """ streams the audio to the wordpress REST api with constant memory
+
+    requests sends an open file in small blocks, so unlike the base64
+    encoded XML-RPC upload the file is never loaded into memory. Basic auth
+    needs an application password of the wordpress user.
+    """
+    import mimetypes
+    import os
+    import requests
+
+    audio_name = audio_path.split("/")[-1]
+    audio_mime_type = mimetypes.guess_type(audio_path)[0] or \
+        "application/octet-stream"
+
+    with open(audio_path, 'rb') as audio_data:
+        size = os.fstat(audio_data.fileno()).st_size
+        response = requests.post(
+            config["wordpress"]["url"] + "/wp-json/wp/v2/media",
+            data=scheduler.ThrottledReader(audio_data, size),
+            headers={
+                'Content-Type': audio_mime_type,
+                'Content-Disposition':
+                    'attachment; filename="' + audio_name + '"',
+                'Content-Length': str(size)
+            },
+            auth=wordpress_rest_auth(config))
+    response.raise_for_status()
+
+    return response.json()['source_url']
+
+
+@traced("audio_publish", path_arg=1,
+        count_bytes=lambda args, result: metrics.file_size(args[1]))
+def copy_audio_to_wordpress(config, audio_path, move=False):
     """moves the audio to wordpress using the wp path stored in config"""
 
-    import shutil
+    import utils
 
     audio_name = audio_path.split("/")[-1]
     audio_url = config["wordpress"]["url"] + "/" + \
         config["wordpress"]["wp_audio_path"] + "/" + audio_name
 
-    shutil.copy(audio_path, config["wordpress"]["local_audio_path"])
+    utils.publish_file(
+        audio_path, config["wordpress"]["local_audio_path"] + "/" + audio_name,
+        move)
 
     return audio_url
 
 
-def create_wordpress_post(config, video_url, audio_url, metadata):
-    """ creates a wordpress post with the embedded video and Audio """
-    import datetime
-    from wordpress_xmlrpc import Client, WordPressPost
-    from wordpress_xmlrpc.methods import posts
+WORDPRESS_PUBLISHERS = {}
+WORDPRESS_PUBLISHERS_LOCK = threading.Lock()
+
+
+def get_wordpress_publisher(config):
+    """ returns the wordpress publisher shared by this process """
+    import wp_publish
+
+    with WORDPRESS_PUBLISHERS_LOCK:
+        key = (config["wordpress"]["url"], config["wordpress"]["user"])
+        if key not in WORDPRESS_PUBLISHERS:
+            WORDPRESS_PUBLISHERS[key] = wp_publish.WordpressPublisher(config)
+        return WORDPRESS_PUBLISHERS[key]
+
 
-    wordpress_handle = Client(
-        config["wordpress"]["url"] + "/xmlrpc.php",
-        config["wordpress"]["user"], config["wordpress"]["password"])
+def build_wordpress_post(config, video_url, audio_url, metadata,
+                         audio_sources=None, peaks_url=None, hls_url=None):
+    """ builds a wordpress post with the embedded video and Audio
+
+    audio_sources are [url, MIME type] of renditions the player should
+    prefer over the MP3 at audio_url, which stays the download. With the
+    peaks_url of the waveform the player draws it right away and loads
+    the audio only when it is played. The HLS playlist at hls_url comes
+    first, browsers that cannot stream it fall back to the files.
+    """
+    import datetime
+    import media
+    from wordpress_xmlrpc import WordPressPost
 
     if video_url is not None:
         video_html = "<div>[iframe src=\"https://player.vimeo.com" + \
@@ -235,11 +600,20 @@ def create_wordpress_post(config, video_url, audio_url, metadata):
             config["wordpress"]["download_button_color"] +\
             "; border-radius:3px; padding:5px; color:#ffffff; \
             border-color:black; border:1px;\" href=\"" + audio_url +\
-            "\" title=\"" + config["Wordpress"]["download_button_text"] + \
+            "\" title=\"" + config["wordpress"]["download_button_text"] + \
             "\" target=\"_blank\">" +\
             config["wordpress"]["download_button_text"] + "</a>"
-        audio_html = "<div><h3>Audiopredigt:</h3><audio controls src=\"" + \
-            audio_url + "\"></audio></div>"
+        audio_mime_type = media.AUDIO_MIME_TYPES.get(
+            audio_url.rsplit(".", 1)[-1].lower(), "audio/mpeg")
+        audio_tag = "<audio controls>" if peaks_url is None else \
+            "<audio controls preload=\"none\" data-peaks=\"" + peaks_url + \
+            "\">"
+        sources = (audio_sources or []) + [[audio_url, audio_mime_type]]
+        if hls_url is not None:
+            sources.insert(0, [hls_url, media.AUDIO_MIME_TYPES["m3u8"]])
+        audio_html = "<div><h3>Audiopredigt:</h3>" + audio_tag + \
+            "".join("<source src=\"" + url + "\" type=\"" + mime_type +
+                    "\">" for url, mime_type in sources) + "</audio></div>"
     else:
         audio_html = "<div> Es tut uns Leid, aus technischen Gr&uuml;nden gibt \
             es zu diesem Gottesdienst leider keine Tonaufnahme</div>"
@@ -265,9 +639,68 @@ def create_wordpress_post(config, video_url, audio_url, metadata):
         'category': [config["wordpress"]["category"]],
         }
     post.post_status = 'publish'
-    post.id = wordpress_handle.call(posts.NewPost(post))
+    return post
+
+
+@limited("wordpress")
+@traced("post")
+def create_wordpress_post(config, video_url, audio_url, metadata,
+                          audio_sources=None, peaks_url=None, hls_url=None):
+    """ creates or updates the wordpress post with the video and Audio """
+    post = build_wordpress_post(config, video_url, audio_url, metadata,
+                                audio_sources, peaks_url, hls_url)
+    post.id = get_wordpress_publisher(config).publish_post(post)
+    return post.id
+
+
+def publish_queued_posts(config, journal, recordings):
+    """ publishes the posts of recordings in batches and journals their ids
+
+    recordings is a list of (key, path, video_url, audio_url, metadata),
+    returns the keys whose post exists afterwards.
+    """
+    if all("post" in journal.stages(recording[0])
+           for recording in recordings):
+        # an idle run neither takes the wordpress slot nor records a span
+        return set(recording[0] for recording in recordings)
+    return send_queued_posts(config, journal, recordings)
+
+
+@limited("wordpress")
+@traced("post")
+def send_queued_posts(config, journal, recordings):
+    """ sends the posts publish_queued_posts found missing """
+    import logging
+
+    publisher = None
+    posted = set()
+    for key, path, video_url, audio_url, metadata in recordings:
+        if "post" in journal.stages(key):
+            posted.add(key)
+            continue
+        if publisher is None:
+            publisher = get_wordpress_publisher(config)
+        # a sermon without recording leaves an existing post alone
+        publisher.queue_post(key, build_wordpress_post(
+            config, video_url, audio_url, metadata,
+            peaks_url=journal.stages(key).get("peaks_url"),
+            hls_url=journal.stages(key).get("hls_url")),
+            replace=video_url is not None or audio_url is not None)
+    if publisher is None:
+        return posted
+
+    paths = dict((recording[0], recording[1]) for recording in recordings)
+    for key, result in publisher.flush().items():
+        if isinstance(result, Exception):
+            logging.error("posting " + paths[key] + " failed: " + str(result))
+        else:
+            journal.record(key, paths[key], "post", result)
+            posted.add(key)
+    return posted
 
 
+@limited("smtp")
+@traced("notification")
 def send_baptism_online_notification(config, video_url, metadata):
     """ send mail notification when baptism video was uploaded"""
 
@@ -295,10 +728,11 @@ def send_baptism_online_notification(config, video_url, metadata):
                               config["mail"]["smtp_port"])
     # identify ourselves to smtp gmail client
     mailserver.ehlo()
-    # secure our email with tls encryption
-    mailserver.starttls()
-    # re-identify ourselves as an encrypted connection
-    mailserver.ehlo()
+    if config["mail"].get("starttls", True):
+        # secure our email with tls encryption
+        mailserver.starttls()
+        # re-identify ourselves as an encrypted connection
+        mailserver.ehlo()
     mailserver.login(config["mail"]["login"], config["mail"]["password"])
 
     config["mail"]["receivers"]
@@ -309,54 +743,771 @@ def send_baptism_online_notification(config, video_url, metadata):
     mailserver.quit()
 
 
-def main():
-    """ here happens all the magic """
+@traced("archive", path_arg=0,
+        count_bytes=lambda args, result: metrics.file_size(result))
+def archive_file(path, archive_dir, index=None, outputs=None):
+    """ moves path into archive_dir and returns its new location
+
+    The original is only removed once the archived copy is verified. With
+    an index the archived file is recorded there together with outputs.
+    """
+    import logging
+    import sqlite3
+    import utils
+
+    target = archive_dir + "/" + path.split("/")[-1]
+    # a hash taken while the recording was read for the upload is reused
+    digest = utils.move_verified(path, target,
+                                 (outputs or {}).get("sha256"))
+    if index is not None:
+        try:
+            index.add(target, outputs or {}, digest)
+        except (sqlite3.Error, OSError) as e:
+            logging.error("indexing " + target + " failed: " + str(e))
+    return target
+
+
+def content_index_path(config):
+    """ returns the content index, kept in the archive unless configured """
     import os
-    import shutil
 
-    config = load_config("./config.json")
+    return config.get("content_index_path") or os.path.join(
+        config["archive_path"], "content_index.sqlite")
+
+
+def reuse_published(journal, index, key, path):
+    """ takes over the outputs of an indexed recording with the same content
+
+    Returns True if path is a copy of a recording that was published
+    before, its stages are then journaled as done with the old outputs.
+    """
+    import logging
+
+    # recordings with journaled stages are our own work in progress
+    if index is None or journal.stages(key):
+        return False
+    outputs = index.lookup(path)
+    if outputs is None:
+        return False
+    logging.info(path + " was published before, reusing " +
+                 ", ".join(str(outputs[stage]) for stage in
+                           ("video_url", "audio_url") if stage in outputs))
+    for stage, output in outputs.items():
+        journal.record(key, path, stage, output)
+    return True
+
+
+def publish_renditions(config, audio_path):
+    """ moves the renditions of audio_path to wordpress
+
+    returns a list of [url, MIME type] in the order of the config
+    """
+    import media
+
+    sources = []
+    for rendition in config.get("audio", {}).get("renditions", []):
+        sources.append([
+            copy_audio_to_wordpress(
+                config, rendition_path(audio_path, rendition), True),
+            media.AUDIO_MIME_TYPES[rendition["extension"]]])
+    return sources
+
+
+def sidecar_path(config, video_path):
+    import os
+
+    return os.path.splitext(video_path)[0] + "." + \
+        config["text_file_extension"]
+
+
+def read_clip_times(config, video_path):
+    """ returns (start, end) in seconds of the sermon in video_path
+
+    They are read from the [video] section of the sidecar NFO, end may be
+    left out. Returns None without a sidecar or start.
+    """
+    import logging
+    import media
+    import utils
+
+    nfo = utils.readNFO(sidecar_path(config, video_path))
+    if nfo is None or utils.getNFOValue(nfo, "start") is None:
+        return None
+    end = utils.getNFOValue(nfo, "end")
+    try:
+        start = media.parse_timestamp(utils.getNFOValue(nfo, "start"))
+        end = media.parse_timestamp(end) if end is not None else None
+    except ValueError as e:
+        logging.error("sidecar of " + video_path + ": " + str(e))
+        return None
+    if end is not None and end <= start:
+        logging.error("sidecar of %s ends before it starts", video_path)
+        return None
+    return start, end
+
+
+def clip_path(config, video_path):
+    """ returns where the clip of the sermon in video_path is written """
+    import os
+    return os.path.join(config["clip"].get("work_path", "."),
+                        os.path.basename(video_path))
+
+
+@limited("extraction")
+@traced("clip", path_arg=1,
+        count_bytes=lambda args, result: metrics.file_size(result))
+def clip_sermon(config, video_path):
+    """ cuts the sermon given by the sidecar out of video_path
+
+    The cut is moved onto keyframes and stream copied into clip.work_path,
+    so the upload and the extraction only get the sermon. Returns the clip
+    or video_path if the sidecar gives no times.
+    """
+    import logging
+    import os
+    import media
+
+    times = read_clip_times(config, video_path)
+    if times is None:
+        return video_path
+    clip_config = config["clip"]
+    clip = clip_path(config, video_path)
+    # the clip of an earlier run is reused unless the sidecar changed
+    if os.path.exists(clip) and os.path.getmtime(clip) >= max(
+            os.path.getmtime(video_path),
+            os.path.getmtime(sidecar_path(config, video_path))):
+        return clip
+
+    start, end = media.snap_to_keyframes(
+        video_path, times[0], times[1], clip_config.get("search_window", 30))
+    logging.info("clipping %s from %.1f s to %s", video_path, start,
+                 "the end" if end is None else "%.1f s" % end)
+    os.makedirs(os.path.dirname(clip) or ".", exist_ok=True)
+    return media.clip_video(video_path, clip, start, end,
+                            print_progress(os.path.basename(clip)))
+
+
+@limited("extraction")
+@traced("thumbnail", path_arg=1)
+def create_thumbnail(config, video_path):
+    """ returns the thumbnail of video_path, cached by its content
+
+    The cache is keyed by the content fingerprint, so a rerun, a renamed
+    copy or the clip of an earlier run never decode the video again.
+    """
+    import os
+    import media
+    from content_index import fingerprint
+
+    thumbnail_config = config["thumbnail"]
+    cache_dir = thumbnail_config.get("cache_path", ".")
+    thumbnail = os.path.join(cache_dir, fingerprint(video_path) + ".jpg")
+    if os.path.exists(thumbnail):
+        return thumbnail
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = os.path.join(cache_dir, "." + os.path.basename(thumbnail))
+    media.create_thumbnail(video_path, tmp_path,
+                           thumbnail_config.get("candidates", 6),
+                           thumbnail_config.get("width", 1280))
+    os.replace(tmp_path, thumbnail)
+    return thumbnail
+
+
+@limited("peertube")
+def set_peertube_thumbnail(config, video_url, thumbnail):
+    get_peertube_client(config).set_thumbnail(
+        video_url.rstrip("/").split("/")[-1], thumbnail)
+
+
+@limited("vimeo")
+def set_vimeo_thumbnail(config, video_url, thumbnail):
+    import vimeo
+
+    vimeo_handle = vimeo.VimeoClient(
+        token=config["vimeo"]["token"],
+        key=config["vimeo"]["key"],
+        secret=config["vimeo"]["secret"])
+    vimeo_handle.upload_picture("/videos/" + video_url.split("/")[-1],
+                                thumbnail, activate=True)
+
+
+def add_thumbnail(config, video_path, video_url, set_thumbnail):
+    """ creates the thumbnail of video_path and sets it on the platform
+
+    The cached file is only kept until the platform has it, the journal
+    then remembers the stage and no run needs it again.
+    """
+    import os
+
+    thumbnail = create_thumbnail(config, video_path)
+    set_thumbnail(config, video_url, thumbnail)
+    os.remove(thumbnail)
+    return thumbnail
+
+
+def needs_extraction(done):
+    """ tells if the journaled stages done lack the extracted audio """
+    import os
 
-    audio_list = get_file_list(
-        config["search_path"], config["audio_file_extension"])
-    video_list = get_file_list(
-        config["search_path"], config["video_file_extension"])
-    text_list = get_file_list(
-        config["search_path"], config["text_file_extension"])
+    return "audio_url" not in done and (done.get("audio") is None or
+                                        not os.path.exists(done["audio"]))
+
+
+def publish_audio_extras(config, journal, key, path, audio):
+    """ publishes the waveform peaks and HLS segments of audio
+
+    Both are optional for the post, a failure is logged and leaves the
+    plain player. returns the url of the peaks and of the HLS playlist
+    """
+    import logging
+    from journal import run_stage
+
+    audio_config = config.get("audio", {})
+    urls = []
+    for setting, stage, publish, what in (
+            ("peaks", "peaks_url", publish_peaks, "waveform"),
+            ("hls", "hls_url", publish_hls, "HLS segments")):
+        url = None
+        if audio_config.get(setting):
+            try:
+                url = run_stage(journal, key, path, stage, publish, config,
+                                audio)
+            except Exception:
+                logging.exception(what + " of " + path + " failed")
+        urls.append(url)
+    return tuple(urls)
+
+
+def prepare_audio(config, journal, key, video, stream=None):
+    """ extracts the audio of video and publishes it
+
+    With a Tee consumer as stream the audio track is demuxed from it into
+    a local file first, so the video is not read from the share again.
+    returns the audio path, its url, the [url, MIME type] of the
+    additional renditions, the url of the waveform peaks and the url of
+    the HLS playlist
+    """
+    import shutil
+    import tempfile
+    from journal import run_stage
 
-    for video in video_list:
-        metadata = get_sermon_metadata(video)
-        if metadata is not None:
+    audio_config = config.get("audio", {})
+    done = journal.stages(key)
+    audio = done.get("audio")
+    work_dir = None
+    try:
+        if needs_extraction(done):
+            source = None
+            if stream is not None:
+                work_dir = tempfile.mkdtemp(prefix="sermon-audio-")
+                source = demux_audio_track(video, stream, work_dir)
+            missing = [stage for stage, setting in (
+                ("loudness", "loudnorm"), ("silence", "silence"))
+                if audio_config.get(setting) and stage not in done]
+            if missing:
+                # the analysis pass decodes everything, its results are kept
+                loudness, segments = analyze_audio(
+                    source or video, audio_config, "loudness" in missing,
+                    "silence" in missing)
+                if "loudness" in missing:
+                    journal.record(key, video, "loudness", loudness)
+                if "silence" in missing:
+                    journal.record(key, video, "silence", segments)
+                done = journal.stages(key)
             audio = convert_video_to_audio(
                 video, config["video_file_extension"],
-                config["audio_file_extension"])
-            video_url = upload_sermon_to_peertube(config, video, metadata)
-            audio_url = copy_audio_to_wordpress(config, audio)
-            create_wordpress_post(config, video_url, audio_url, metadata)
-            shutil.move(
-                video, config["archive_path"] + "/" + video.split("/")[-1])
+                config["audio_file_extension"], audio_config,
+                done.get("loudness"), source, done.get("silence"))
+            journal.record(key, video, "audio", audio)
+    finally:
+        if stream is not None:
+            stream.close()
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    # the extras may have to be read from the audio before it is moved
+    peaks_url, hls_url = publish_audio_extras(config, journal, key, video,
+                                              audio)
+    # the extracted audio is not needed anywhere else, so it is moved
+    audio_url = run_stage(journal, key, video, "audio_url",
+                          copy_audio_to_wordpress, config, audio, True)
+    return audio, audio_url, run_stage(journal, key, video, "audio_sources",
+                                       publish_renditions, config,
+                                       audio), peaks_url, hls_url
+
+
+def process_sermon_video(config, executor, journal, index, video, metadata,
+                         tracker=None):
+    """ runs audio extraction and video upload in parallel, then posts
+
+    The upload is network bound and ffmpeg runs in its own process, so both
+    branches overlap completely and are joined only for the post. With the
+    clip section set both work on the sermon cut out by clip_sermon, the
+    whole service is archived. With a tracker the post is left to it until
+    the video is playable. Finished stages are journaled, so after a
+    failure the next run only repeats what is missing. The video stays in
+    the search path until then.
+    """
+    import logging
+    import os
+    import shutil
+    import media
+    import utils
+    from concurrent.futures import wait
+    from journal import recording_key, run_stage
+    from tee import Tee
+
+    key = recording_key(video)
+    reuse_published(journal, index, key, video)
+
+    # upload, extraction and thumbnail get only the sermon if the sidecar
+    # says where, a later run cuts the clip again for what is left
+    done = journal.stages(key)
+    source = video
+    if config.get("clip") and (
+            "video_url" not in done or needs_extraction(done) or
+            (config.get("thumbnail") and "thumbnail" not in done)):
+        try:
+            source = clip_sermon(config, video)
+        except Exception:
+            logging.exception("clipping " + video + " failed")
+            return False
+
+    # read the video once for the upload, the audio track and its hash
+    reader = audio_stream = video_stream = None
+    destinations = []
+    if config.get("tee") and "video_url" not in done:
+        # the archive check hashes the original, not the clip
+        reader = Tee(source, config["tee"].get("block_size", 8388608),
+                     config["tee"].get("queue_blocks", 4),
+                     hash_content="sha256" not in done and source == video)
+        video_stream = reader.consumer()
+        destinations.append("peertube")
+        if needs_extraction(done):
+            # the extraction runs while the upload slot is held, with or
+            # without a consumer, so its slot has to be taken here as well
+            destinations.append("extraction")
+            # ffmpeg can only demux an MP4 from a pipe with moov first
+            if media.is_faststart(source):
+                audio_stream = reader.consumer()
+            else:
+                logging.info(source + " is not faststart, the extraction "
+                             "reads it separately")
+
+    # the consumers of one reader wait for each other, so their slots
+    # are taken together before any of them starts
+    with limits.slots(*destinations) as held:
+        audio_future = executor.submit(
+            limits.holding, held, prepare_audio, config, journal, key,
+            source, audio_stream)
+        video_future = executor.submit(
+            limits.holding, held, run_stage, journal, key, video,
+            "video_url", upload_sermon_to_peertube, config, source, metadata,
+            video_stream)
+        if reader is not None:
+            reader.start()
+        wait([audio_future, video_future])
+        if reader is not None and reader.join() is not None:
+            journal.record(key, video, "sha256", reader.digest)
+
+    try:
+        audio, audio_url, audio_sources, peaks_url, hls_url = \
+            audio_future.result()
+        video_url = video_future.result()
+    except Exception:
+        logging.exception("processing " + video + " failed")
+        return False
+
+    if config.get("thumbnail"):
+        try:
+            run_stage(journal, key, video, "thumbnail", add_thumbnail,
+                      config, source, video_url, set_peertube_thumbnail)
+        except Exception:
+            # the platform's default frame is no reason to hold the post
+            logging.exception("thumbnail of " + video + " failed")
+
+    def publish():
+        run_stage(journal, key, video, "post", create_wordpress_post,
+                  config, video_url, audio_url, metadata, audio_sources,
+                  peaks_url, hls_url)
+        # drop the audio before the video leaves the search path, otherwise
+        # a crash in between would turn it into an audio only sermon
+        if audio and os.path.exists(audio):
             os.remove(audio)
+        if audio and config.get("audio", {}).get("hls"):
+            shutil.rmtree(hls_directory(audio, config["audio"]["hls"]),
+                          ignore_errors=True)
+        run_stage(journal, key, video, "archive", archive_file,
+                  video, config["archive_path"], index, journal.stages(key))
+        # the sidecar goes with its video, alone it would be a text sermon
+        sidecar = sidecar_path(config, video)
+        if os.path.exists(sidecar):
+            utils.move_verified(sidecar, os.path.join(
+                config["archive_path"], os.path.basename(sidecar)))
+        # the clip may be left from a run that did not get to the post
+        if config.get("clip") and os.path.exists(clip_path(config, video)):
+            os.remove(clip_path(config, video))
+
+    if tracker is not None and "post" not in journal.stages(key):
+        # the post waits until peertube finished transcoding
+        tracker.track(video, video_url, publish)
+        return True
+    try:
+        publish()
+    except Exception:
+        logging.exception("processing " + video + " failed")
+        return False
+    return True
+
+
+def process_baptism_video(config, journal, index, video, metadata):
+    """ uploads a baptism video and notifies the baptism team """
+    import logging
+    from journal import recording_key, run_stage
+
+    key = recording_key(video)
+    reuse_published(journal, index, key, video)
+    try:
+        video_url = run_stage(journal, key, video, "video_url",
+                              upload_baptism_to_vimeo, config, video, metadata)
+        if config.get("thumbnail"):
+            try:
+                run_stage(journal, key, video, "thumbnail", add_thumbnail,
+                          config, video, video_url, set_vimeo_thumbnail)
+            except Exception:
+                logging.exception("thumbnail of " + video + " failed")
+        run_stage(journal, key, video, "notification",
+                  send_baptism_online_notification, config, video_url,
+                  metadata)
+        run_stage(journal, key, video, "archive", archive_file,
+                  video, config["archive_path"] + "/Taufe", index,
+                  journal.stages(key))
+    except Exception:
+        logging.exception("processing " + video + " failed")
+        return False
+    return True
+
+
+def prioritize(recordings):
+    """ returns (video, metadata, is_sermon) in the order to upload them
+
+    Sermons go before baptisms and the newest recording of each goes first,
+    so the one people are waiting for gets the uplink.
+    """
+    def newest_first(videos, is_sermon):
+        return [(video, metadata, is_sermon) for video, metadata in
+                sorted(videos, key=lambda item: item[1]["date"],
+                       reverse=True)]
+
+    return (newest_first(recordings["sermon"], True) +
+            newest_first(recordings["baptism"], False))
+
+
+def is_peertube_video_playable(config, video_url):
+    """ tells if peertube finished processing the video at video_url """
+    # not limited, a short status query must not queue behind the uploads
+    import pt_upload
+    from readiness import VideoFailed
+
+    state, label = get_peertube_client(config).video_state(
+        video_url.rstrip("/").split("/")[-1])
+    if state in pt_upload.VIDEO_STATES_FAILED:
+        raise VideoFailed(label)
+    return state == pt_upload.VIDEO_STATE_PUBLISHED
+
+
+def create_tracker(config):
+    """ returns a tracker of peertube's transcoding, None if not configured """
+    from readiness import ReadinessTracker
+
+    readiness = config.get("readiness")
+    if not readiness:
+        return None
+    return ReadinessTracker(
+        lambda video_url: is_peertube_video_playable(config, video_url),
+        initial_delay=readiness.get("initial_delay", 10),
+        max_delay=readiness.get("max_delay", 300),
+        timeout=readiness.get("timeout", 6 * 3600),
+        workers=readiness.get("publish_workers", 1))
+
+
+def process_files(config, journal, index, recordings, tracker=None):
+    """ uploads, posts and archives the recordings of a scan
+
+    Up to concurrency.recordings videos are processed at once, the caps of
+    each destination are applied by the stage functions themselves. Posts
+    of videos still being transcoded are published by the tracker; without
+    one a tracker for this run is created, which is given
+    readiness.run_wait seconds at the end before the remaining posts are
+    left to the next run.
+    """
+    import logging
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from journal import recording_key, run_stage
+
+    own_tracker = tracker is None
+    if own_tracker:
+        tracker = create_tracker(config)
+
+    try:
+        workers = max(1, int(config.get("concurrency", {}).get(
+            "recordings", 1)))
+        # every sermon runs its extraction and upload branch in parallel
+        with ThreadPoolExecutor(max_workers=2 * workers) as branches, \
+                ThreadPoolExecutor(max_workers=workers) as videos:
+            futures = {}
+            for video, metadata, is_sermon in prioritize(recordings):
+                if is_sermon:
+                    futures[videos.submit(
+                        process_sermon_video, config, branches, journal,
+                        index, video, metadata, tracker)] = video
+                else:
+                    futures[videos.submit(
+                        process_baptism_video, config, journal, index, video,
+                        metadata)] = video
+            for future, video in futures.items():
+                try:
+                    future.result()
+                except Exception:
+                    logging.exception("processing " + video + " failed")
+
+        # audio and text only sermons are posted together in one batch
+        queued = []
+        for audio, metadata in recordings["audio"]:
+            key = recording_key(audio)
+            reuse_published(journal, index, key, audio)
+            publish_audio_extras(config, journal, key, audio, audio)
+            try:
+                audio_url = run_stage(journal, key, audio, "audio_url",
+                                      copy_audio_to_wordpress, config, audio)
+            except Exception:
+                # the journal has the other stages, the next run retries
+                logging.exception("processing " + audio + " failed")
+                continue
+            queued.append((key, audio, None, audio_url, metadata))
+
+        for text, metadata in recordings["text"]:
+            queued.append((recording_key(text), text, None, None, metadata))
+
+        posted = publish_queued_posts(config, journal, queued)
+        for key, path, video_url, audio_url, metadata in queued:
+            if key not in posted:
+                continue
+            try:
+                if audio_url is not None:
+                    run_stage(journal, key, path, "archive", archive_file,
+                              path, config["archive_path"], index,
+                              journal.stages(key))
+                else:
+                    os.remove(path)
+            except Exception:
+                # the post is journaled, the next run only archives it
+                logging.exception("archiving " + path + " failed")
+    finally:
+        # the posts already handed to the tracker still get their time
+        if own_tracker and tracker is not None:
+            if not tracker.wait(config["readiness"].get("run_wait", 900)):
+                logging.info("%d videos are still transcoding, their posts "
+                             "are left to the next run", len(tracker))
+            tracker.stop()
+
+
+def plan_actions(config, journal, recordings, index=None):
+    """ returns the actions process_files would take as lines of text
+
+    Only the scan, the journal and the content index are read, no media or
+    network library is imported, so it is cheap enough to run on every
+    poll. Copies of published recordings show the outputs they reuse.
+    """
+    import os
+    from journal import recording_key
+
+    def name(path):
+        return os.path.basename(path)
+
+    def pending(path):
+        """ returns a test for the stages of path that still have to run """
+        done = journal.stages(recording_key(path)) if journal else {}
+        # like reuse_published, only a recording without stages is looked up
+        if not done and index is not None:
+            outputs = index.lookup(path)
+            if outputs is not None:
+                actions.append("reuse %s for %s" % (", ".join(
+                    str(outputs[stage]) for stage in ("video_url", "audio_url")
+                    if stage in outputs), name(path)))
+                done = outputs
+        return lambda stage: stage not in done
+
+    wordpress = config["wordpress"]
+    actions = []
+    for video, metadata, is_sermon in prioritize(recordings):
+        todo = pending(video)
+        if is_sermon:
+            audio = os.path.splitext(video)[0] + "." + \
+                config["audio_file_extension"]
+            audio_files = [audio] + [
+                rendition_path(audio, rendition) for rendition in
+                config.get("audio", {}).get("renditions", [])]
+            if config.get("audio", {}).get("hls"):
+                audio_files.append(hls_directory(audio,
+                                                 config["audio"]["hls"]))
+            times = read_clip_times(config, video) \
+                if config.get("clip") else None
+            if times is not None and (todo("audio_url") or
+                                      todo("video_url")):
+                actions.append("clip %s from %.1f s to %s" % (
+                    name(video), times[0], "the end" if times[1] is None
+                    else "%.1f s" % times[1]))
+            if todo("audio_url"):
+                actions.append("extract audio of %s to %s" % (
+                    name(video), ", ".join(map(name, audio_files))))
+                actions.append("move %s to %s" % (
+                    ", ".join(map(name, audio_files)),
+                    wordpress["local_audio_path"]))
+            if todo("video_url"):
+                actions.append("upload %s to PeerTube %s" % (
+                    name(video), config["peertube"]["peertube_url"]))
+            if config.get("thumbnail") and todo("thumbnail"):
+                actions.append("set a thumbnail of %s on PeerTube" % (
+                    name(video)))
+            if todo("post"):
+                actions.append("post \"%s // %s\" on %s" % (
+                    metadata["title"], metadata["preacher"],
+                    wordpress["url"]))
+            if todo("archive"):
+                actions.append("move %s to %s" % (
+                    name(video), config["archive_path"]))
+        else:
+            if todo("video_url"):
+                actions.append("upload %s to Vimeo" % name(video))
+            if config.get("thumbnail") and todo("thumbnail"):
+                actions.append("set a thumbnail of %s on Vimeo" % (
+                    name(video)))
+            if todo("notification"):
+                actions.append("mail the link of %s to %s" % (
+                    name(video), ", ".join(config["mail"]["receivers"])))
+            if todo("archive"):
+                actions.append("move %s to %s" % (
+                    name(video), config["archive_path"] + "/Taufe"))
+
+    for path, metadata in recordings["audio"] + recordings["text"]:
+        todo = pending(path)
+        is_audio = path.endswith("." + config["audio_file_extension"])
+        if is_audio and todo("audio_url"):
+            actions.append("copy %s to %s" % (
+                name(path), wordpress["local_audio_path"]))
+        if todo("post"):
+            actions.append("post \"%s // %s\" on %s" % (
+                metadata["title"], metadata["preacher"], wordpress["url"]))
+        if is_audio and todo("archive"):
+            actions.append("move %s to %s" % (
+                name(path), config["archive_path"]))
+        elif not is_audio:
+            actions.append("delete " + name(path))
+    return actions
+
+
+def watch(config, journal, index):
+    """ processes recordings as soon as they are completely written """
+    import logging
+    import os
+    import watcher
+
+    watch_config = config.get("watch", {})
+    # the daemon keeps one tracker, posts are published whenever ready
+    tracker = create_tracker(config)
+
+    def process(paths):
+        # the run of the daemon starts with the first complete file, posts
+        # the tracker published since the last run are exported as their own
+        if metrics.TRACER.pending():
+            metrics.export(config.get("metrics", {}))
+        try:
+            # the scan knows which files belong to a video still being written
+            ready = set(os.path.basename(path) for path in paths)
+            recordings = dict(
+                (kind, [(path, metadata) for path, metadata in found
+                        if os.path.basename(path) in ready])
+                for kind, found in scan_recordings(config).items())
+            process_files(config, journal, index, recordings, tracker)
+        except Exception:
+            logging.exception("processing " + ", ".join(paths) + " failed")
+        metrics.export(config.get("metrics", {}))
+
+    watcher.watch(config["search_path"],
+                  [config[name + "_file_extension"]
+                   for name in ("video", "audio", "text")],
+                  process,
+                  settle_time=watch_config.get("settle_time", 30),
+                  poll_interval=watch_config.get("poll_interval", 10),
+                  retry_interval=watch_config.get("retry_interval", 3600),
+                  mode=watch_config.get("mode", "auto"))
+
+
+def main():
+    """ here happens all the magic """
+    import argparse
+    import os
+    import scanner
+    from content_index import ContentIndex
+    from journal import Journal
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", default="./config.json",
+                        help="path of the configuration file")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and process new recordings as "
+                        "soon as they are complete")
+    parser.add_argument("--plan", action="store_true",
+                        help="only print what would be uploaded, posted, "
+                        "mailed and moved")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if config["wordpress"].get("rest_media_upload"):
+        # fail before the first upload rather than for every recording
+        try:
+            wordpress_rest_auth(config)
+        except ValueError as e:
+            parser.error(str(e))
+    scheduler.configure(config.get("bandwidth", {}))
+    scanner.configure(config.get("filename_grammar", {}))
+
+    if args.plan:
+        journal_path = config.get("journal_path", "./journal.sqlite")
+        index_path = content_index_path(config)
+        # a dry run must not create the journal or the index
+        journal = Journal(journal_path) if os.path.exists(journal_path) \
+            else None
+        index = ContentIndex(index_path) if os.path.exists(index_path) \
+            else None
+        for action in plan_actions(config, journal,
+                                   scan_recordings(config), index):
+            print(action)
+        if journal is not None:
+            journal.close()
+        if index is not None:
+            index.close()
+        return
+
+    journal = Journal(config.get("journal_path", "./journal.sqlite"))
+    index_path = content_index_path(config)
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    index = ContentIndex(index_path)
+    limits.configure(config.get("concurrency", {}))
+
+    try:
+        if args.watch:
+            watch(config, journal, index)
         else:
-            metadata = get_baptism_metadata(video)
-            if metadata is not None:
-                video_url = upload_baptism_to_vimeo(config, video, metadata)
-                send_baptism_online_notification(config, video_url, metadata)
-                shutil.move(
-                    video, config["archive_path"] + "/Taufe/" +
-                    video.split("/")[-1])
-
-    for audio in audio_list:
-        metadata = get_sermon_metadata(audio)
-        if metadata is not None:
-            audio_url = copy_audio_to_wordpress(config, audio)
-            create_wordpress_post(config, None, audio_url, metadata)
-            shutil.move(
-                audio, config["archive_path"] + "/" + audio.split("/")[-1])
-
-    for text in text_list:
-        metadata = get_sermon_metadata(text)
-        if metadata is not None:
-            create_wordpress_post(config, None, None, metadata)
-            os.remove(text)
+            process_files(config, journal, index,
+                          scan_recordings(config))
+    finally:
+        journal.close()
+        index.close()
+        for publisher in WORDPRESS_PUBLISHERS.values():
+            publisher.close()
+        metrics.export(config.get("metrics", {}))
 
 if __name__ == "__main__":
     main()
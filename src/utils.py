@@ -2,9 +2,14 @@
 # coding: utf-8
 
 
-from os.path import dirname, splitext, basename, isfile
+from os.path import dirname, splitext, basename, isfile, join
 from os import devnull
 from subprocess import check_call, CalledProcessError, STDOUT
+from configparser import RawConfigParser, NoOptionError, NoSectionError, \
+    Error as ConfigParserError
+import errno
+import os
+import shutil
 import unicodedata
 import logging
 
@@ -83,6 +88,9 @@ PEERTUBE_LANGUAGE = {
 }
 ######################
 
+# ioctl request of linux to share the extents of a file (reflink)
+FICLONE = 0x40049409
+
 
 def getCategory(category, platform):
     if platform == "youtube":
@@ -169,6 +177,30 @@ def loadNFO(options):
     return False
 
 
+def readNFO(nfo_file):
+    """ returns the nfo at nfo_file, None if it is missing or no nfo
+
+    Unlike loadNFO it never exits, a sidecar may just be plain text.
+    """
+    if not isfile(nfo_file):
+        return None
+    nfo = RawConfigParser()
+    try:
+        nfo.read(nfo_file, encoding='utf-8')
+    except (ConfigParserError, UnicodeDecodeError) as e:
+        logging.debug(nfo_file + " is no NFO: " + str(e))
+        return None
+    return nfo
+
+
+def getNFOValue(nfo, option, section='video'):
+    """ returns option of the nfo section or None if it is not set """
+    try:
+        return nfo.get(section, option) or None
+    except (NoOptionError, NoSectionError):
+        return None
+
+
 def parseNFO(options):
     nfo = loadNFO(options)
     if nfo:
@@ -208,3 +240,184 @@ def cleanString(toclean):
         cleaned = cleaned + strtoclean
 
     return cleaned
+
+
+def kernel_copy(source, target):
+    """ copies source to target without moving the data through python
+
+    A reflink is tried first (btrfs, xfs), then copy_file_range and
+    sendfile, which copy inside the kernel or even on the file server.
+    """
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        size = os.fstat(src_fd).st_size
+        try:
+            import fcntl
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return
+        except (ImportError, OSError):
+            pass
+
+        offset = 0
+        for method in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, method):
+                continue
+            try:
+                while offset < size:
+                    if method == 'copy_file_range':
+                        copied = os.copy_file_range(src_fd, dst_fd,
+                                                    size - offset, offset,
+                                                    offset)
+                    else:
+                        copied = os.sendfile(dst_fd, src_fd, offset,
+                                             size - offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+                break
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+        if offset < size:
+            src.seek(offset)
+            dst.seek(offset)
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        dst.flush()
+        os.fsync(dst_fd)
+
+
+def publish_file(source, target, move=False):
+    """ puts source at target without ever exposing a half written file
+
+    On the same file system source is renamed (move) or hard linked.
+    Otherwise it is copied by the kernel to a hidden temporary name next to
+    target, checked for its size and renamed into place.
+    """
+    tmp_target = join(dirname(target) or '.', '.' + basename(target) + '.tmp')
+    if os.path.exists(tmp_target):
+        os.remove(tmp_target)
+    size = os.stat(source).st_size
+    same_device = os.stat(source).st_dev == \
+        os.stat(dirname(target) or '.').st_dev
+
+    if same_device:
+        try:
+            if move:
+                os.rename(source, target)
+            else:
+                os.link(source, tmp_target)
+                os.replace(tmp_target, target)
+            return target
+        except OSError as e:
+            # some shares do not support hard links
+            logging.debug("linking " + source + " failed: " + str(e))
+
+    kernel_copy(source, tmp_target)
+    shutil.copymode(source, tmp_target)
+    if os.stat(tmp_target).st_size != size:
+        os.remove(tmp_target)
+        raise IOError("copy of " + source + " to " + target + " is incomplete")
+    os.replace(tmp_target, target)
+    if move:
+        os.remove(source)
+    return target
+
+
+def publish_directory(source, target, move=False):
+    """ puts the directory source at target as a whole
+
+    The files are published into a hidden temporary directory next to
+    target, which is renamed into place once complete. A previous target
+    is renamed aside just before and removed afterwards, so readers never
+    see a mix of old and new files.
+    """
+    tmp_target = join(dirname(target) or '.', '.' + basename(target) + '.tmp')
+    old_target = join(dirname(target) or '.', '.' + basename(target) + '.old')
+    for path in (tmp_target, old_target):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    same_device = os.stat(source).st_dev == \
+        os.stat(dirname(target) or '.').st_dev
+    if move and same_device:
+        os.rename(source, tmp_target)
+    else:
+        os.mkdir(tmp_target)
+        for name in sorted(os.listdir(source)):
+            publish_file(join(source, name), join(tmp_target, name), move)
+
+    if os.path.exists(target):
+        os.rename(target, old_target)
+    os.rename(tmp_target, target)
+    if os.path.exists(old_target):
+        shutil.rmtree(old_target)
+    if move and os.path.exists(source):
+        os.rmdir(source)
+    return target
+
+
+def sample_digest(path, prefix=b'', sample_size=1024 * 1024):
+    """ returns the sha256 of prefix and the first and last sample_size
+    bytes of path
+
+    Enough to tell recordings apart without reading gigabytes from the
+    file server, the caller puts size or name into prefix.
+    """
+    import hashlib
+
+    digest = hashlib.sha256(prefix)
+    with open(path, 'rb') as data:
+        digest.update(data.read(sample_size))
+        if os.fstat(data.fileno()).st_size > 2 * sample_size:
+            data.seek(-sample_size, os.SEEK_END)
+            digest.update(data.read(sample_size))
+    return digest.hexdigest()
+
+
+def file_digest(path, block_size=8 * 1024 * 1024, drop_cache=False):
+    """ returns the sha256 of path, read in large blocks
+
+    drop_cache asks the kernel to forget the cached pages first, so a
+    freshly written file is read back from the disk instead of memory.
+    """
+    import hashlib
+
+    digest = hashlib.sha256()
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as data:
+        if drop_cache and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(data.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        while True:
+            count = data.readinto(buffer)
+            if not count:
+                break
+            digest.update(view[:count])
+    return digest.hexdigest()
+
+
+def move_verified(source, target, source_digest=None):
+    """ moves source to target and only removes source once target matches
+
+    A rename on the same file system never touches the data. Otherwise the
+    copy is read back and compared by sha256 before source is deleted,
+    source is only hashed if its source_digest is not known yet. Returns
+    the sha256 if it is known, else None.
+    """
+    target_dir = dirname(target) or '.'
+    if os.stat(source).st_dev == os.stat(target_dir).st_dev:
+        os.rename(source, target)
+        return source_digest
+
+    tmp_target = join(target_dir, '.' + basename(target) + '.tmp')
+    kernel_copy(source, tmp_target)
+    source_digest = source_digest or file_digest(source)
+    if file_digest(tmp_target, drop_cache=True) != source_digest:
+        os.remove(tmp_target)
+        raise IOError("copy of " + source + " to " + target +
+                      " does not match the original")
+    shutil.copystat(source, tmp_target)
+    os.replace(tmp_target, target)
+    os.remove(source)
+    return source_digest
@@ -0,0 +1,154 @@
+""" watches the search path and hands over recordings once they are complete
+
+inotify (through the optional inotify_simple package) is used on local
+file systems. Network shares do not deliver inotify events for changes
+made by other machines, so they are polled instead.
+"""
+
+import logging
+import os
+import time
+
+NETWORK_FILE_SYSTEMS = ("cifs", "smb3", "smbfs", "nfs", "nfs4", "fuse.sshfs",
+                        "9p", "afs")
+
+
+def get_file_system_type(path):
+    """ returns the type of the file system path lives on, None if unknown """
+    path = os.path.realpath(path)
+    best_mount, best_type = "", None
+    try:
+        with open("/proc/mounts") as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace("\\040", " ")
+                if (path == mount_point or
+                        path.startswith(mount_point.rstrip("/") + "/")) and \
+                        len(mount_point) >= len(best_mount):
+                    best_mount, best_type = mount_point, fields[2]
+    except OSError:
+        return None
+    return best_type
+
+
+def open_inotify(path, mode):
+    """ returns an inotify watch on path or None to fall back to polling """
+    if mode == "poll":
+        return None
+    if mode == "auto" and get_file_system_type(path) in NETWORK_FILE_SYSTEMS:
+        logging.info("%s is a network share, polling it", path)
+        return None
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        if mode == "inotify":
+            raise
+        logging.info("inotify_simple is not installed, polling %s", path)
+        return None
+    inotify = INotify()
+    inotify.add_watch(path, flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE |
+                      flags.MOVED_TO | flags.ATTRIB)
+    return inotify
+
+
+def read_events(inotify, path, timeout):
+    """ waits for inotify events, returns {file path: closed after write} """
+    from inotify_simple import flags
+
+    changed = {}
+    for event in inotify.read(timeout=int(timeout * 1000)):
+        if not event.name:
+            continue
+        file_path = os.path.join(path, event.name)
+        complete = bool(event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO))
+        changed[file_path] = changed.get(file_path, False) or complete
+    return changed
+
+
+def scan(path, extensions):
+    """ returns {file path: (size, mtime)} of the files with extensions """
+    files = {}
+    for entry in os.scandir(path):
+        if entry.is_file() and \
+                entry.name.rsplit(".", 1)[-1] in extensions:
+            stat = entry.stat()
+            files[entry.path] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+def watch(path, extensions, process, settle_time=30, poll_interval=10,
+          retry_interval=3600, mode="auto"):
+    """ calls process with the list of files that stopped changing
+
+    A file is complete when it was closed after writing or moved into
+    path, or when its size and mtime did not change for settle_time
+    seconds. Files process left behind are offered again after
+    retry_interval seconds or as soon as they change.
+    """
+    inotify = open_inotify(path, mode)
+    # path -> [size, mtime, time of the last change, closed after write]
+    pending = {}
+    # path -> ((size, mtime), time it was handed to process)
+    handed_over = {}
+    # pick up what was already there when the daemon started
+    rescan = True
+
+    while True:
+        now = time.time()
+        if rescan:
+            current = scan(path, extensions)
+            rescan = inotify is None
+        else:
+            current = {}
+            for file_path in pending:
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                current[file_path] = (stat.st_size, stat.st_mtime)
+
+        for file_path in list(pending):
+            if file_path not in current:
+                del pending[file_path]
+        for file_path, signature in current.items():
+            offered = handed_over.get(file_path)
+            if offered and offered[0] == signature and \
+                    now - offered[1] < retry_interval:
+                pending.pop(file_path, None)
+                continue
+            entry = pending.get(file_path)
+            if entry is None or tuple(entry[:2]) != signature:
+                closed = entry[3] if entry else False
+                pending[file_path] = [signature[0], signature[1], now, closed]
+
+        ready = sorted(file_path for file_path, entry in pending.items()
+                       if entry[3] or now - entry[2] >= settle_time)
+        if ready:
+            for file_path in ready:
+                entry = pending.pop(file_path)
+                handed_over[file_path] = (tuple(entry[:2]), time.time())
+            logging.info("processing %d complete file(s)", len(ready))
+            process(ready)
+            for file_path in list(handed_over):
+                if not os.path.exists(file_path):
+                    del handed_over[file_path]
+
+        if inotify is None:
+            rescan = True
+            time.sleep(poll_interval)
+            continue
+
+        # wake up for events, or in time to check settling files again
+        timeout = poll_interval if pending else retry_interval
+        for file_path, closed in read_events(inotify, path, timeout).items():
+            if file_path.rsplit(".", 1)[-1] not in extensions:
+                continue
+            entry = pending.setdefault(file_path, [None, None, time.time(),
+                                                   False])
+            entry[2] = time.time()
+            entry[3] = closed
+        if not pending:
+            # offer files left behind again once their retry time is over
+            rescan = True
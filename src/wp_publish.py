@@ -0,0 +1,247 @@
+""" wordpress publishing with one client per run and batched post creation """
+
+import logging
+import threading
+import time
+
+# posts sent in one system.multicall request
+MULTICALL_BATCH_SIZE = 20
+
+# posts fetched per wp.getPosts request while syncing the post index
+SYNC_BATCH_SIZE = 500
+
+# seconds after which a long running process syncs the post index again
+SYNC_INTERVAL = 600
+
+# only what the post index needs, the content of ten years of posts is big
+SYNC_FIELDS = ["post_title", "post_date_gmt", "post_modified_gmt", "terms"]
+
+
+class WordpressPublisher(object):
+    """ shares one authenticated XML-RPC client and queues new posts
+
+    Queued posts are created together through system.multicall when
+    flush is called, which saves a round trip to wordpress per post. With
+    wordpress.post_index_path set, a sermon that already has a post gets
+    that post updated instead of a second one.
+    """
+
+    def __init__(self, config):
+        from wordpress_xmlrpc import Client
+
+        self.url = config["wordpress"]["url"]
+        self.category = config["wordpress"]["category"]
+        self.client = Client(
+            self.url + "/xmlrpc.php",
+            config["wordpress"]["user"], config["wordpress"]["password"])
+        # ServerProxy is not thread safe
+        self.lock = threading.Lock()
+        self.queue = []
+        self.index = None
+        if config["wordpress"].get("post_index_path"):
+            import post_index
+            self.index = post_index.PostIndex(
+                config["wordpress"]["post_index_path"])
+        self.sync_batch_size = config["wordpress"].get(
+            "post_index_batch", SYNC_BATCH_SIZE)
+        self.sync_lock = threading.Lock()
+        self.synced = None
+
+    def call(self, method):
+        """ runs a single wordpress_xmlrpc method on the shared client """
+        with self.lock:
+            return self.client.call(method)
+
+    def sync(self):
+        """ pulls the sermon posts modified since the last sync into the index
+
+        Posts are paged newest modification first, so a sync after the
+        first one stops at the first page reaching back to the cursor.
+        """
+        from post_index import parse_post_title, post_key
+        from wordpress_xmlrpc import WordPressPost
+        from wordpress_xmlrpc.methods import posts
+
+        cursor = self.index.cursor(self.url)
+        newest = cursor
+        offset = 0
+        count = 0
+        while True:
+            method = posts.GetPosts(
+                {"post_type": "post", "orderby": "modified", "order": "DESC",
+                 "number": self.sync_batch_size, "offset": offset},
+                SYNC_FIELDS)
+            # process_result of lists uses collections.Iterable, which is
+            # gone since python 3.10
+            with self.lock:
+                page = [WordPressPost(raw) for raw in getattr(
+                    self.client.server, method.method_name)(
+                        *method.get_args(self.client))]
+            entries = []
+            reached = False
+            for post in page:
+                modified = post.date_modified.isoformat()
+                if cursor is not None and modified < cursor:
+                    reached = True
+                    break
+                newest = max(newest or modified, modified)
+                title, preacher = parse_post_title(post.title)
+                if title is not None and self.category in [
+                        term.name for term in post.terms
+                        if term.taxonomy == "category"]:
+                    entries.append((post_key(post.date.date(), title,
+                                             preacher), post.id))
+            self.index.update(entries, None, self.url)
+            count += len(entries)
+            if reached or len(page) < self.sync_batch_size:
+                break
+            offset += len(page)
+        # the cursor moves only after a complete sync, an interrupted one
+        # is repeated from the old cursor
+        self.index.update([], newest, self.url)
+        logging.info("wordpress: %d sermon posts synced", count)
+
+    def existing_post(self, post):
+        """ returns the id of the post of the same sermon or None """
+        from post_index import parse_post_title, post_key
+
+        if self.index is None:
+            return None
+        title, preacher = parse_post_title(post.title)
+        if title is None:
+            return None
+        with self.sync_lock:
+            if self.synced is None or \
+                    time.monotonic() - self.synced > SYNC_INTERVAL:
+                self.sync()
+                self.synced = time.monotonic()
+        return self.index.lookup(post_key(post.date.date(), title, preacher))
+
+    def remember(self, post, post_id):
+        """ adds a post created by this process to the index """
+        from post_index import parse_post_title, post_key
+
+        title, preacher = parse_post_title(post.title)
+        if self.index is not None and title is not None:
+            self.index.add(post_key(post.date.date(), title, preacher),
+                           post_id)
+
+    def publish_post(self, post, replace=True):
+        """ creates post or updates the post of the same sermon, returns its id
+
+        With replace False an existing post is kept as it is, e.g. when
+        post only says that there is no recording.
+        """
+        from wordpress_xmlrpc.compat import xmlrpc_client
+        from wordpress_xmlrpc.methods import posts
+
+        post_id = self.existing_post(post)
+        if post_id is not None and not replace:
+            return post_id
+        if post_id is not None:
+            try:
+                self.call(posts.EditPost(post_id, post))
+                return post_id
+            except xmlrpc_client.Fault as e:
+                if e.faultCode != 404:
+                    raise
+                # deleted on wordpress since the last sync
+                self.index.remove(post_id)
+        post_id = self.call(posts.NewPost(post))
+        self.remember(post, post_id)
+        return post_id
+
+    def queue_post(self, key, post, replace=True):
+        """ remembers post to be published by the next flush """
+        with self.lock:
+            self.queue.append((key, post, replace))
+
+    def flush(self, batch_size=MULTICALL_BATCH_SIZE):
+        """ publishes all queued posts, returns {key: post id or exception}
+
+        Queued posts of the same sermon are sent in later rounds, so they
+        update the post the first one created.
+        """
+        from post_index import parse_post_title
+
+        with self.lock:
+            queue, self.queue = self.queue, []
+
+        results = {}
+        while queue:
+            seen = set()
+            current = []
+            later = []
+            for key, post, replace in queue:
+                sermon = (post.date.date(), parse_post_title(post.title))
+                (later if sermon in seen else current).append(
+                    (key, post, replace))
+                seen.add(sermon)
+            results.update(self.send(current, batch_size))
+            queue = later
+        return results
+
+    def send(self, queue, batch_size):
+        """ publishes [(key, post, replace)] in multicall batches """
+        from wordpress_xmlrpc.compat import xmlrpc_client
+        from wordpress_xmlrpc.methods import posts
+
+        results = {}
+        for start in range(0, len(queue), batch_size):
+            batch = []
+            for key, post, replace in queue[start:start + batch_size]:
+                try:
+                    post_id = self.existing_post(post)
+                except Exception as e:
+                    results[key] = e
+                    continue
+                if post_id is not None and not replace:
+                    results[key] = post_id
+                else:
+                    batch.append((key, post, post_id))
+            if not batch:
+                continue
+
+            multicall = xmlrpc_client.MultiCall(self.client.server)
+            methods = []
+            for key, post, post_id in batch:
+                method = posts.NewPost(post) if post_id is None else \
+                    posts.EditPost(post_id, post)
+                getattr(multicall, method.method_name)(
+                    *method.get_args(self.client))
+                methods.append(method)
+
+            try:
+                with self.lock:
+                    responses = multicall()
+            except Exception as e:
+                logging.error("wordpress: multicall of %d posts failed: %s",
+                              len(batch), e)
+                for key, post, post_id in batch:
+                    results[key] = e
+                continue
+
+            for position, (key, post, post_id) in enumerate(batch):
+                try:
+                    # raises the fault of this single call
+                    result = methods[position].process_result(
+                        responses[position])
+                    if post_id is None:
+                        post_id = result
+                        self.remember(post, post_id)
+                    results[key] = post_id
+                except xmlrpc_client.Fault as e:
+                    if post_id is None or e.faultCode != 404:
+                        results[key] = e
+                        continue
+                    # deleted on wordpress since the last sync
+                    self.index.remove(post_id)
+                    try:
+                        results[key] = self.publish_post(post)
+                    except Exception as e:
+                        results[key] = e
+        return results
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
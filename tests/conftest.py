@@ -0,0 +1,6 @@
+""" puts the flat modules of src on the path of the tests """
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
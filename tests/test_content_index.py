@@ -0,0 +1,64 @@
+import shutil
+
+import content_index
+import utils
+from content_index import ContentIndex
+
+MEGABYTE = 1024 * 1024
+
+
+def write(path, middle=b"m"):
+    # larger than the head and tail the fingerprint reads
+    with open(str(path), "wb") as recording:
+        recording.write(b"h" * MEGABYTE + middle * MEGABYTE + b"t" * MEGABYTE)
+    return str(path)
+
+
+def test_a_copy_under_another_name_is_found(tmpdir):
+    index = ContentIndex(str(tmpdir.join("index.sqlite")))
+    archived = write(tmpdir.join("2024-01-07_Title_Preacher.mp4"))
+    index.add(archived, {"peertube": "https://peertube.example.com/w/1",
+                         "archive": archived, "audio": "/tmp/audio.mp3"})
+    copy = str(tmpdir.join("2024-01-07_Other Title_Preacher.mp4"))
+    shutil.copy(archived, copy)
+
+    # the local files of the archived recording are not reused
+    assert index.lookup(copy) == {
+        "peertube": "https://peertube.example.com/w/1"}
+    index.close()
+
+
+def test_same_fingerprint_with_other_content_is_no_match(tmpdir):
+    index = ContentIndex(str(tmpdir.join("index.sqlite")))
+    archived = write(tmpdir.join("archived.mp4"))
+    index.add(archived, {"peertube": "https://peertube.example.com/w/1"})
+    other = write(tmpdir.join("other.mp4"), middle=b"x")
+
+    assert content_index.fingerprint(other) == \
+        content_index.fingerprint(archived)
+    assert index.lookup(other) is None
+    index.close()
+
+
+def test_a_candidate_without_hash_that_is_gone_is_skipped(tmpdir):
+    index = ContentIndex(str(tmpdir.join("index.sqlite")))
+    archived = write(tmpdir.join("archived.mp4"))
+    index.add(archived, {"peertube": "https://peertube.example.com/w/1"})
+    copy = str(tmpdir.join("copy.mp4"))
+    shutil.move(archived, copy)
+
+    assert index.lookup(copy) is None
+    index.close()
+
+
+def test_a_known_hash_does_not_need_the_archived_file(tmpdir):
+    index = ContentIndex(str(tmpdir.join("index.sqlite")))
+    archived = write(tmpdir.join("archived.mp4"))
+    index.add(archived, {"peertube": "https://peertube.example.com/w/1"},
+              sha256=utils.file_digest(archived))
+    copy = str(tmpdir.join("copy.mp4"))
+    shutil.move(archived, copy)
+
+    assert index.lookup(copy) == {
+        "peertube": "https://peertube.example.com/w/1"}
+    index.close()
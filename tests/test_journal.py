@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from journal import Journal, recording_key, run_stage
+
+
+def write(path, data):
+    with open(str(path), "wb") as recording:
+        recording.write(data)
+    return str(path)
+
+
+def test_run_stage_runs_a_stage_once(tmpdir):
+    journal = Journal(str(tmpdir.join("journal.sqlite")))
+    calls = []
+
+    def upload(path):
+        calls.append(path)
+        return "https://example.com/videos/1"
+
+    assert run_stage(journal, "key", "a.mp4", "video_url", upload,
+                     "a.mp4") == "https://example.com/videos/1"
+    assert run_stage(journal, "key", "a.mp4", "video_url", upload,
+                     "a.mp4") == "https://example.com/videos/1"
+    assert calls == ["a.mp4"]
+
+
+def test_failed_stage_is_not_recorded(tmpdir):
+    journal = Journal(str(tmpdir.join("journal.sqlite")))
+
+    def fail():
+        raise IOError("uplink down")
+
+    with pytest.raises(IOError):
+        run_stage(journal, "key", "a.mp4", "video_url", fail)
+    assert journal.stages("key") == {}
+    assert run_stage(journal, "key", "a.mp4", "video_url",
+                     lambda: "url") == "url"
+
+
+def test_reopened_journal_resumes_after_the_last_stage(tmpdir):
+    path = str(tmpdir.join("journal.sqlite"))
+    journal = Journal(path)
+    journal.record("key", "a.mp4", "video_url", "url")
+    journal.record("key", "a.mp4", "loudness", {"input_i": "-20.1"})
+    journal.record("other", "b.mp4", "post", 7)
+    journal.close()
+
+    journal = Journal(path)
+    assert journal.stages("key") == {"video_url": "url",
+                                     "loudness": {"input_i": "-20.1"}}
+
+    def must_not_run():
+        raise AssertionError("finished stage ran again")
+
+    assert run_stage(journal, "key", "a.mp4", "video_url",
+                     must_not_run) == "url"
+    assert run_stage(journal, "key", "a.mp4", "post", lambda: 3) == 3
+    assert journal.stages("other") == {"post": 7}
+
+
+def test_recording_key_follows_name_and_content(tmpdir):
+    data = os.urandom(3 * 1024 * 1024)
+    first = write(tmpdir.join("2024-01-07_Title_Preacher.mp4"), data)
+    key = recording_key(first)
+    assert recording_key(first) == key
+
+    renamed = write(tmpdir.join("2024-01-07_Other_Preacher.mp4"), data)
+    os.utime(renamed, (os.stat(first).st_atime, os.stat(first).st_mtime))
+    assert recording_key(renamed) != key
+
+    # a re-export differs in its tail only
+    write(first, data[:-1] + bytes([data[-1] ^ 1]))
+    os.utime(first, (os.stat(renamed).st_atime, os.stat(renamed).st_mtime))
+    assert recording_key(first) != key
@@ -0,0 +1,127 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import limits
+import media
+import uploader
+from journal import Journal, recording_key
+from limits import limited
+
+
+@pytest.fixture
+def caps_of_one():
+    limits.configure({})
+    yield
+    limits.SEMAPHORES.clear()
+
+
+def test_sermons_with_and_without_faststart_do_not_deadlock(
+        tmpdir, monkeypatch, caps_of_one):
+    config = {"tee": {"block_size": 1024, "queue_blocks": 2},
+              "text_file_extension": "txt",
+              "archive_path": str(tmpdir.join("archive"))}
+    journal = Journal(str(tmpdir.join("journal.sqlite")))
+    videos = []
+    for name in ("2024-01-14_Slow_Preacher.mp4",
+                 "2024-01-07_Fast_Preacher.mp4"):
+        path = str(tmpdir.join(name))
+        with open(path, "wb") as video:
+            video.write(b"\0" * 64 * 1024)
+        # only the tee branches are of interest, not the post
+        for stage in ("post", "archive"):
+            journal.record(recording_key(path), path, stage)
+        videos.append(path)
+
+    @limited("peertube")
+    def upload(config, path, metadata, stream):
+        time.sleep(0.2)
+        while stream.read(4096):
+            pass
+        stream.close()
+        return "https://peertube.example.com/videos/watch/1"
+
+    @limited("extraction")
+    def extract(path, stream):
+        time.sleep(0.2)
+        if stream is not None:
+            while stream.read(4096):
+                pass
+
+    def prepare_audio(config, journal, key, video, stream=None):
+        # the other sermon takes its first slot in the meantime
+        time.sleep(0.1)
+        try:
+            extract(video, stream)
+        finally:
+            if stream is not None:
+                stream.close()
+        return None, None, [], None, None
+
+    monkeypatch.setattr(media, "is_faststart",
+                        lambda path: "_Fast_" in path)
+    monkeypatch.setattr(uploader, "upload_sermon_to_peertube", upload)
+    monkeypatch.setattr(uploader, "prepare_audio", prepare_audio)
+
+    results = []
+    executor = ThreadPoolExecutor(8)
+    workers = [threading.Thread(
+        target=lambda video=video: results.append(
+            uploader.process_sermon_video(
+                config, executor, journal, None, video,
+                {"title": "Title", "preacher": "Preacher"})),
+        daemon=True) for video in videos]
+    # the sermon without faststart holds the upload slot first
+    for worker in workers:
+        worker.start()
+        time.sleep(0.05)
+    for worker in workers:
+        worker.join(10)
+    # a deadlocked executor must not hang the test run
+    executor.shutdown(wait=False)
+    assert not any(worker.is_alive() for worker in workers)
+    assert results == [True, True]
+
+
+def test_calls_stay_within_the_cap_of_their_destination():
+    limits.configure({"peertube": 2})
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    @limited("peertube")
+    def upload():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+
+    try:
+        with ThreadPoolExecutor(6) as executor:
+            for future in [executor.submit(upload) for _ in range(6)]:
+                future.result()
+    finally:
+        limits.SEMAPHORES.clear()
+    assert max(peak) == 2
+
+
+def test_destinations_without_configure_are_unlimited():
+    limits.SEMAPHORES.clear()
+    with limits.slot("peertube"), limits.slot("peertube"):
+        pass
+
+
+def test_held_slots_are_not_taken_again(caps_of_one):
+    @limited("extraction")
+    def extract():
+        return "audio"
+
+    with limits.slots("peertube", "extraction") as held:
+        # with caps of 1 taking the slot again would block forever
+        with ThreadPoolExecutor(1) as executor:
+            assert executor.submit(
+                limits.holding, held, extract).result(5) == "audio"
@@ -0,0 +1,90 @@
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+import media
+
+
+def box(kind, payload=b""):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def write(path, data):
+    with open(str(path), "wb") as video:
+        video.write(data)
+    return str(path)
+
+
+def test_moov_before_mdat_is_faststart(tmpdir):
+    video = write(tmpdir.join("video.mp4"), box(b"ftyp", b"isom") +
+                  box(b"moov", b"\0" * 100) + box(b"mdat", b"\0" * 1000))
+    assert media.is_faststart(video)
+
+
+def test_moov_after_mdat_is_not_faststart(tmpdir):
+    video = write(tmpdir.join("video.mp4"), box(b"ftyp", b"isom") +
+                  box(b"mdat", b"\0" * 1000) + box(b"moov", b"\0" * 100))
+    assert not media.is_faststart(video)
+
+
+def test_large_boxes_before_moov_are_skipped(tmpdir):
+    # a box with a 64 bit size
+    free = struct.pack(">I4sQ", 1, b"free", 16 + 100) + b"\0" * 100
+    video = write(tmpdir.join("video.mp4"), box(b"ftyp", b"isom") + free +
+                  box(b"moov"))
+    assert media.is_faststart(video)
+
+
+def test_truncated_or_other_files_are_not_faststart(tmpdir):
+    assert not media.is_faststart(write(tmpdir.join("empty.mp4"), b""))
+    assert not media.is_faststart(write(tmpdir.join("text.mp4"),
+                                        b"not a video at all"))
+
+
+@pytest.mark.parametrize("value, seconds", [
+    ("01:02:03", 3723.0), ("02:03.5", 123.5), ("42", 42.0), (7, 7.0),
+    (" 00:10 ", 10.0)])
+def test_parse_timestamp(value, seconds):
+    assert media.parse_timestamp(value) == seconds
+
+
+def test_parse_timestamp_rejects_other_text():
+    with pytest.raises(ValueError):
+        media.parse_timestamp("ten minutes")
+
+
+def keyframes_every(seconds, duration):
+    def keyframe_times(path, start, end):
+        return [time for time in range(0, duration, seconds)
+                if start <= time <= end]
+    return keyframe_times
+
+
+def test_cut_points_move_outwards_onto_keyframes(monkeypatch):
+    monkeypatch.setattr(media, "keyframe_times", keyframes_every(4, 3600))
+    assert media.snap_to_keyframes("video.mp4", 601.5, 1802.5) == (600, 1804)
+    assert media.snap_to_keyframes("video.mp4", 600, 1804) == (600, 1804)
+
+
+def test_cut_points_without_keyframes_nearby(monkeypatch):
+    monkeypatch.setattr(media, "keyframe_times", keyframes_every(4, 3600))
+    # nothing in the window before start means the start of the file
+    assert media.snap_to_keyframes("video.mp4", 50, window=1.0)[0] == 0.0
+    # and after the last keyframe the end of the file
+    assert media.snap_to_keyframes("video.mp4", 600, 3599) == (600, None)
+
+
+@pytest.mark.skipif(shutil.which(media.FFMPEG) is None or
+                    shutil.which(media.FFPROBE) is None,
+                    reason="ffmpeg is not installed")
+def test_keyframes_of_a_real_video(tmpdir):
+    video = str(tmpdir.join("video.mp4"))
+    # a keyframe every 2 seconds
+    subprocess.check_call([
+        media.FFMPEG, "-v", "error", "-f", "lavfi", "-i",
+        "testsrc=size=160x90:rate=25:duration=10", "-g", "50",
+        "-keyint_min", "50", "-sc_threshold", "0", video])
+    assert media.keyframe_times(video, 0, 10) == [0.0, 2.0, 4.0, 6.0, 8.0]
+    assert media.snap_to_keyframes(video, 3.0, 5.0) == (2.0, 6.0)
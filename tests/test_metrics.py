@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+import metrics
+from journal import Journal
+
+
+@pytest.fixture(autouse=True)
+def new_run():
+    metrics.TRACER.take()
+    yield
+    metrics.TRACER.take()
+
+
+def test_traced_records_bytes_and_errors():
+    @metrics.traced("upload", path_arg=0,
+                    count_bytes=lambda args, result: len(result))
+    def upload(path):
+        metrics.add_retry()
+        return b"x" * 10
+
+    @metrics.traced("post")
+    def post():
+        raise IOError("server gone")
+
+    upload("/recordings/2024-01-07_Title_Preacher.mp4")
+    with pytest.raises(IOError):
+        post()
+
+    spans = metrics.TRACER.take()[2]
+    assert [(span.stage, span.bytes, span.retries) for span in spans] == [
+        ("upload", 10, 1), ("post", 0, 0)]
+    assert spans[0].attributes["recording"] == "2024-01-07_Title_Preacher.mp4"
+    assert spans[0].error is None
+    assert spans[1].error == "OSError: server gone"
+
+
+def test_export_writes_the_textfile_and_the_run_log(tmpdir):
+    @metrics.traced("archive", count_bytes=lambda args, result: 100)
+    def archive():
+        pass
+
+    archive()
+    archive()
+    textfile = str(tmpdir.join("uploader.prom"))
+    run_log = str(tmpdir.join("runs.jsonl"))
+    metrics.export({"textfile": textfile, "run_log": run_log})
+
+    with open(textfile) as prometheus:
+        lines = prometheus.read().splitlines()
+    assert 'sermon_uploader_stage_calls{stage="archive"} 2' in lines
+    assert 'sermon_uploader_stage_bytes{stage="archive"} 200' in lines
+    with open(run_log) as log:
+        runs = [json.loads(line) for line in log]
+    assert [run["stage"] for run in runs] == ["archive", "archive"]
+    assert runs[0]["run"] == runs[1]["run"]
+    assert metrics.TRACER.pending() == 0
+
+
+def test_an_idle_run_records_no_post(tmpdir):
+    import uploader
+
+    journal = Journal(str(tmpdir.join("journal.sqlite")))
+    journal.record("key", "/recordings/text.txt", "post", "5")
+
+    assert uploader.publish_queued_posts(
+        {}, journal, [("key", "/recordings/text.txt", None, None, {})]) == \
+        {"key"}
+    assert uploader.publish_queued_posts({}, journal, []) == set()
+    assert metrics.TRACER.pending() == 0
@@ -0,0 +1,56 @@
+import io
+import json
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+import peaks  # noqa: E402
+
+
+def pcm(samples):
+    return io.BytesIO(numpy.asarray(samples, dtype="<i2").tobytes())
+
+
+def test_min_and_max_per_bucket():
+    samples = [0, 100, -100, 50, 1000, -2000, 3, 4, 7]
+    waveform = peaks.Peaks(8000, (2,)).read(pcm(samples))
+    # the last, incomplete bucket holds the remaining sample
+    assert waveform.minimum.tolist() == [0, -100, -2000, 3, 7]
+    assert waveform.maximum.tolist() == [100, 50, 1000, 4, 7]
+
+
+def test_buckets_across_blocks_of_the_stream():
+    samples = numpy.arange(-5000, 5000, dtype="<i2")
+    waveform = peaks.Peaks(8000, (3,)).read(pcm(samples))
+    expected = [samples[start:start + 3] for start in range(0, 10000, 3)]
+    assert waveform.minimum.tolist() == [int(b.min()) for b in expected]
+    assert waveform.maximum.tolist() == [int(b.max()) for b in expected]
+
+
+def test_coarser_levels_combine_the_finest_buckets():
+    samples = [1, -1, 2, -2, 30, -30, 4, -4, 5, -5]
+    waveform = peaks.Peaks(8000, (4, 2)).read(pcm(samples))
+    minimum, maximum = waveform.level(4)
+    assert minimum.tolist() == [-2, -30, -5]
+    assert maximum.tolist() == [2, 30, 5]
+
+
+def test_levels_must_be_multiples_of_the_finest():
+    with pytest.raises(ValueError):
+        peaks.Peaks(8000, (2, 3))
+
+
+def test_audiowaveform_json(tmpdir):
+    samples = [-32768, 32767, 256, 512]
+    path = str(tmpdir.join("audio.peaks.json"))
+    peaks.Peaks(8000, (2, 4)).read(pcm(samples)).write(path)
+    with open(path) as peaks_file:
+        document = json.load(peaks_file)
+
+    assert document["version"] == 2 and document["bits"] == 8
+    assert document["samples_per_pixel"] == 2
+    assert document["length"] == 2
+    assert document["data"] == [-128, 127, 1, 2]
+    assert document["levels"] == [
+        {"samples_per_pixel": 4, "length": 1, "data": [-128, 127]}]
@@ -0,0 +1,75 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("requests_oauthlib")
+pytest.importorskip("requests_toolbelt")
+pytest.importorskip("tzlocal")
+
+import pt_upload  # noqa: E402
+
+
+class Response(object):
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+@pytest.mark.parametrize("headers, offset", [
+    ({}, 0),
+    ({"Range": "bytes=0-0"}, 1),
+    ({"Range": "bytes=0-10485759"}, 10485760),
+])
+def test_parse_range_offset(headers, offset):
+    assert pt_upload.parse_range_offset(Response(308, headers)) == offset
+
+
+def test_query_upload_offset():
+    class Session(object):
+        def __init__(self, response):
+            self.response = response
+
+        def put(self, url, headers=None):
+            assert headers["Content-Range"] == "bytes */100"
+            return self.response
+
+    assert pt_upload.query_upload_offset(
+        Session(Response(308, {"Range": "bytes=0-49"})), "u", 100) == \
+        (50, None)
+    assert pt_upload.query_upload_offset(
+        Session(Response(200)), "u", 100)[0] == 100
+    assert pt_upload.query_upload_offset(
+        Session(Response(404)), "u", 100)[0] is None
+    # a server error is no reason to give the session up
+    with pytest.raises(pt_upload.UploadError):
+        pt_upload.query_upload_offset(Session(Response(503)), "u", 100)
+
+
+def test_stalled_upload_gives_up(tmpdir, monkeypatch):
+    monkeypatch.setattr(pt_upload.time, "sleep", lambda seconds: None)
+    video = str(tmpdir.join("video.mp4"))
+    with open(video, "wb") as data:
+        data.write(os.urandom(1000))
+    with open(video + pt_upload.UPLOAD_STATE_SUFFIX, "w") as state:
+        json.dump({"upload_url": "u", "size": 1000, "offset": 100,
+                   "mtime": int(os.stat(video).st_mtime)}, state)
+
+    class Session(object):
+        puts = 0
+
+        def put(self, url, data=None, headers=None):
+            self.puts += 1
+            if data is not None:
+                data.read()
+            # acknowledges the same byte again and again
+            return Response(308, {"Range": "bytes=0-99"})
+
+    session = Session()
+    with pytest.raises(pt_upload.UploadError):
+        pt_upload.upload_video_resumable(
+            session, {"peertube_url": "https://peertube.example.com"},
+            {"file": video, "chunk_size": 200, "retries": 2}, {})
+    # the resume query, three chunks and an offset query between them
+    assert session.puts == 1 + 3 + 2
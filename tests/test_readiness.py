@@ -0,0 +1,63 @@
+import threading
+
+from readiness import ReadinessTracker, VideoFailed
+
+
+def tracker(check, **kwargs):
+    return ReadinessTracker(check, initial_delay=0.01, max_delay=0.02,
+                            **kwargs)
+
+
+def test_action_runs_once_the_video_is_playable():
+    checks = []
+    published = []
+
+    def check(item):
+        checks.append(item)
+        return len(checks) >= 3
+
+    readiness = tracker(check)
+    readiness.track("video", "url", lambda: published.append("video"))
+    assert readiness.wait(5)
+    readiness.stop()
+    assert checks == ["url"] * 3
+    assert published == ["video"]
+
+
+def test_failed_and_timed_out_videos_are_dropped():
+    published = []
+
+    def check(item):
+        if item == "failed":
+            raise VideoFailed("transcoding failed")
+        return False
+
+    readiness = tracker(check, timeout=0.05)
+    for item in ("failed", "stuck"):
+        readiness.track(item, item, lambda: published.append(item))
+    assert readiness.wait(5)
+    readiness.stop()
+    assert published == []
+    assert len(readiness) == 0
+
+
+def test_a_running_action_does_not_hold_the_checks():
+    release = threading.Event()
+    published = []
+
+    def slow():
+        release.wait(5)
+        published.append("slow")
+
+    readiness = tracker(lambda item: True, workers=2)
+    readiness.track("slow", "slow", slow)
+    readiness.track("fast", "fast", lambda: published.append("fast"))
+    # the fast video is published while the slow action still runs
+    assert not readiness.wait(0.5)
+    assert published == ["fast"]
+    # and the slow action is still counted
+    assert len(readiness) == 1
+    release.set()
+    assert readiness.wait(5)
+    readiness.stop()
+    assert published == ["fast", "slow"]
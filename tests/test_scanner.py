@@ -0,0 +1,66 @@
+import datetime
+
+import pytest
+
+import scanner
+
+
+@pytest.fixture(autouse=True)
+def default_grammar():
+    scanner.configure({})
+    yield
+    scanner.configure({})
+
+
+def test_parse_name_of_a_sermon():
+    name, metadata = scanner.parse_name(
+        "2024-01-07_Ein Titel_Max Mustermann.mp4")
+    assert name == "sermon"
+    assert metadata == {"date": datetime.date(2024, 1, 7),
+                        "title": "Ein Titel", "preacher": "Max Mustermann"}
+
+
+def test_parse_name_of_a_baptism():
+    name, metadata = scanner.parse_name("2024-01-07_Taufe.mp4")
+    assert name == "baptism"
+    assert metadata == {"date": datetime.date(2024, 1, 7)}
+
+
+@pytest.mark.parametrize("file_name", [
+    "notes.txt", "2024-1-7_Title_Preacher.mp4", "2024-01-07_Title.mp4",
+    "2024-01-07_Title_Preacher"])
+def test_parse_name_ignores_other_files(file_name):
+    assert scanner.parse_name(file_name) == (None, None)
+
+
+def test_configured_grammar_replaces_a_pattern():
+    scanner.configure({"baptism": "(?P<date>[0-9]{4}-[0-9]{2}-[0-9]{2})_"
+                                  "Baptism[.].+"})
+    assert scanner.parse_name("2024-01-07_Baptism.mp4")[0] == "baptism"
+    assert scanner.parse_name("2024-01-07_Taufe.mp4") == (None, None)
+
+
+def test_scan_sorts_files_by_kind(tmpdir):
+    for name in ["2024-01-07_Title_Preacher.mp4",
+                 "2024-01-07_Title_Preacher.mp3",
+                 "2024-01-07_Title_Preacher.txt",
+                 "2024-01-14_Taufe.mp4",
+                 "2024-01-21_Audio_Preacher.mp3",
+                 "2024-01-28_Text_Preacher.txt",
+                 "2024-02-04_Taufe.txt",
+                 "notes.txt"]:
+        tmpdir.join(name).write("")
+    tmpdir.mkdir("2024-02-11_Folder_Preacher.mp4")
+
+    recordings = scanner.scan(str(tmpdir), "mp4", "mp3", "txt")
+
+    def names(kind):
+        return sorted(path.rsplit("/", 1)[-1] for path, metadata
+                      in recordings[kind])
+
+    assert names("sermon") == ["2024-01-07_Title_Preacher.mp4"]
+    assert names("extracted") == ["2024-01-07_Title_Preacher.mp3"]
+    assert names("sidecar") == ["2024-01-07_Title_Preacher.txt"]
+    assert names("baptism") == ["2024-01-14_Taufe.mp4"]
+    assert names("audio") == ["2024-01-21_Audio_Preacher.mp3"]
+    assert names("text") == ["2024-01-28_Text_Preacher.txt"]
@@ -0,0 +1,65 @@
+import datetime
+
+import scheduler
+
+SUNDAY_SERVICE = {
+    "default_mbit": 0,
+    "windows": [{"days": ["sun"], "start": "08:30", "end": "13:00",
+                 "mbit": 2}],
+}
+
+# 2024-01-07 was a Sunday
+SUNDAY = datetime.date(2024, 1, 7)
+
+
+def at(day, hour, minute=0):
+    return datetime.datetime.combine(day, datetime.time(hour, minute))
+
+
+def test_window_applies_inside_its_times():
+    assert scheduler.window_rate(SUNDAY_SERVICE, at(SUNDAY, 10)) == 250000.0
+    assert scheduler.window_rate(SUNDAY_SERVICE,
+                                 at(SUNDAY, 8, 30)) == 250000.0
+
+
+def test_window_end_is_exclusive():
+    assert scheduler.window_rate(SUNDAY_SERVICE, at(SUNDAY, 13)) is None
+    assert scheduler.window_rate(SUNDAY_SERVICE, at(SUNDAY, 8, 29)) is None
+
+
+def test_window_applies_on_its_days_only():
+    monday = SUNDAY + datetime.timedelta(days=1)
+    assert scheduler.window_rate(SUNDAY_SERVICE, at(monday, 10)) is None
+
+
+def test_window_without_days_applies_every_day():
+    config = {"windows": [{"start": "00:00", "end": "06:00", "mbit": 8}]}
+    for offset in range(7):
+        day = SUNDAY + datetime.timedelta(days=offset)
+        assert scheduler.window_rate(config, at(day, 3)) == 1000000.0
+
+
+def test_default_rate_outside_windows():
+    config = dict(SUNDAY_SERVICE, default_mbit=16)
+    assert scheduler.window_rate(config, at(SUNDAY, 20)) == 2000000.0
+    assert scheduler.window_rate({}, at(SUNDAY, 20)) is None
+
+
+def test_first_matching_window_wins():
+    config = {"windows": [
+        {"days": ["sun"], "start": "09:00", "end": "12:00", "mbit": 1},
+        {"start": "00:00", "end": "23:59", "mbit": 4}]}
+    assert scheduler.window_rate(config, at(SUNDAY, 10)) == 125000.0
+    assert scheduler.window_rate(config, at(SUNDAY, 13)) == 500000.0
+
+
+def test_window_over_midnight():
+    config = {"windows": [{"days": ["sat"], "start": "22:00", "end": "02:00",
+                           "mbit": 8}]}
+    saturday = SUNDAY - datetime.timedelta(days=1)
+    assert scheduler.window_rate(config, at(saturday, 23)) == 1000000.0
+    # the hours after midnight belong to the day the window started on
+    assert scheduler.window_rate(config, at(SUNDAY, 1)) == 1000000.0
+    assert scheduler.window_rate(config, at(SUNDAY, 2)) is None
+    assert scheduler.window_rate(config, at(saturday, 1)) is None
+    assert scheduler.window_rate(config, at(SUNDAY, 23)) is None
@@ -0,0 +1,54 @@
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+import media  # noqa: E402
+import silence  # noqa: E402
+
+LOUD, QUIET = -20.0, -80.0
+
+
+def levels(*runs):
+    """ builds the block levels of (level, seconds) runs of 100 ms blocks """
+    return numpy.concatenate([numpy.full(int(round(seconds * 10)), level)
+                              for level, seconds in runs])
+
+
+def test_leading_and_trailing_silence_is_cut_to_the_padding():
+    assert silence.keep_segments(levels((QUIET, 10), (LOUD, 60),
+                                        (QUIET, 20))) == [[9.5, 70.5]]
+
+
+def test_long_pauses_are_shortened():
+    segments = silence.keep_segments(levels((LOUD, 30), (QUIET, 10),
+                                            (LOUD, 30)))
+    assert segments == [[0.0, 30.75], [39.25, 70.0]]
+
+
+def test_short_pauses_are_kept():
+    assert silence.keep_segments(levels((QUIET, 2), (LOUD, 30), (QUIET, 4),
+                                        (LOUD, 30))) == [[1.5, 66.0]]
+
+
+def test_nothing_to_cut_or_nothing_loud():
+    assert silence.keep_segments(levels((LOUD, 30))) is None
+    assert silence.keep_segments(levels((QUIET, 30))) is None
+
+
+def test_block_levels_of_a_pcm_stream():
+    import io
+
+    sample_rate = 8000
+    tone = (numpy.sin(numpy.arange(sample_rate) / 5.0) * 16384).astype("<i2")
+    pcm = numpy.concatenate([numpy.zeros(sample_rate, dtype="<i2"), tone])
+    result = silence.block_levels(io.BytesIO(pcm.tobytes()), sample_rate)
+    assert len(result) == 20
+    assert (result[:10] <= -119).all()
+    # a sine at half scale is about -9 dBFS
+    assert numpy.allclose(result[10:], -9.0, atol=0.5)
+
+
+def test_select_filter_keeps_the_segments():
+    assert media.select_filter([[9.5, 70.5], [80.0, 90.25]]) == (
+        "aselect='between(t,9.500,70.500)+between(t,80.000,90.250)',"
+        "asetpts=N/SR/TB")
@@ -0,0 +1,66 @@
+import hashlib
+import os
+import threading
+
+import pytest
+
+from tee import Tee
+
+
+@pytest.fixture
+def video(tmpdir):
+    path = str(tmpdir.join("video.mp4"))
+    with open(path, "wb") as data:
+        data.write(os.urandom(100000))
+    return path
+
+
+def read_all(consumer, results, name):
+    chunks = []
+    for data in iter(lambda: consumer.read(777), b""):
+        chunks.append(data)
+    results[name] = b"".join(chunks)
+
+
+def test_every_consumer_gets_the_whole_file(video):
+    tee = Tee(video, block_size=4096, queue_blocks=2, hash_content=True)
+    consumers = [tee.consumer(), tee.consumer()]
+    assert len(consumers[0]) == 100000
+    results = {}
+    threads = [threading.Thread(target=read_all,
+                                args=(consumer, results, index))
+               for index, consumer in enumerate(consumers)]
+    tee.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    with open(video, "rb") as data:
+        content = data.read()
+    assert results == {0: content, 1: content}
+    assert tee.join() == hashlib.sha256(content).hexdigest()
+
+
+def test_a_closed_consumer_does_not_hold_the_others(video):
+    tee = Tee(video, block_size=4096, queue_blocks=1)
+    early, late = tee.consumer(), tee.consumer()
+    tee.start()
+    early.read(10)
+    early.close()
+    results = {}
+    reader = threading.Thread(target=read_all, args=(late, results, "late"))
+    reader.start()
+    reader.join(10)
+    assert len(results["late"]) == 100000
+    tee.join()
+
+
+def test_the_reader_stops_when_all_consumers_are_gone(video):
+    tee = Tee(video, block_size=1024, queue_blocks=1)
+    consumer = tee.consumer()
+    tee.start()
+    consumer.read(10)
+    consumer.close()
+    tee.thread.join(5)
+    assert not tee.thread.is_alive()
@@ -0,0 +1,112 @@
+import os
+
+import pytest
+
+import utils
+
+
+class Stat(object):
+    """ stat of a path that pretends to live on another file system """
+
+    st_dev = -1
+
+    def __init__(self, stat):
+        self.stat = stat
+
+    def __getattr__(self, name):
+        return getattr(self.stat, name)
+
+
+@pytest.fixture
+def share(tmpdir, monkeypatch):
+    """ a directory that counts as another file system """
+    directory = tmpdir.mkdir("share")
+    stat = os.stat
+
+    def share_stat(path, *args, **kwargs):
+        result = stat(path, *args, **kwargs)
+        if str(path).startswith(str(directory)):
+            return Stat(result)
+        return result
+
+    monkeypatch.setattr(utils.os, "stat", share_stat)
+    return directory
+
+
+def write(path, data=b"sermon audio" * 1000):
+    with open(str(path), "wb") as recording:
+        recording.write(data)
+    return str(path)
+
+
+def read(path):
+    with open(str(path), "rb") as data:
+        return data.read()
+
+
+def test_publish_file_links_on_the_same_file_system(tmpdir):
+    source = write(tmpdir.join("audio.mp3"))
+    target = str(tmpdir.mkdir("web").join("audio.mp3"))
+
+    assert utils.publish_file(source, target) == target
+    assert os.path.samefile(source, target)
+
+
+def test_publish_file_copies_where_links_fail(tmpdir, monkeypatch):
+    def link(source, target):
+        raise OSError("not supported")
+
+    monkeypatch.setattr(utils.os, "link", link)
+    source = write(tmpdir.join("audio.mp3"))
+    web = tmpdir.mkdir("web")
+
+    utils.publish_file(source, str(web.join("audio.mp3")))
+    assert read(web.join("audio.mp3")) == read(source)
+    assert not os.path.samefile(source, str(web.join("audio.mp3")))
+    assert os.listdir(str(web)) == ["audio.mp3"]
+
+
+def test_publish_file_moves_to_another_file_system(tmpdir, share):
+    source = write(tmpdir.join("audio.mp3"))
+    content = read(source)
+
+    utils.publish_file(source, str(share.join("audio.mp3")), move=True)
+    assert read(share.join("audio.mp3")) == content
+    assert not os.path.exists(source)
+    assert os.listdir(str(share)) == ["audio.mp3"]
+
+
+def test_move_verified_checks_the_copy(tmpdir, share):
+    source = write(tmpdir.join("video.mp4"))
+    content = read(source)
+
+    digest = utils.move_verified(source, str(share.join("video.mp4")))
+    assert digest == utils.file_digest(str(share.join("video.mp4")))
+    assert read(share.join("video.mp4")) == content
+    assert not os.path.exists(source)
+
+
+def test_move_verified_keeps_the_source_of_a_bad_copy(tmpdir, share,
+                                                      monkeypatch):
+    file_digest = utils.file_digest
+
+    def corrupted(path, drop_cache=False, **kwargs):
+        # the copy is read back with drop_cache
+        return "0" * 64 if drop_cache else file_digest(path, **kwargs)
+
+    monkeypatch.setattr(utils, "file_digest", corrupted)
+    source = write(tmpdir.join("video.mp4"))
+
+    with pytest.raises(IOError):
+        utils.move_verified(source, str(share.join("video.mp4")))
+    assert os.path.exists(source)
+    assert os.listdir(str(share)) == []
+
+
+def test_sample_digest_only_reads_head_and_tail(tmpdir):
+    first = write(tmpdir.join("first"), b"a" * 10 + b"b" * 10 + b"c" * 10)
+    second = write(tmpdir.join("second"), b"a" * 10 + b"x" * 10 + b"c" * 10)
+    assert utils.sample_digest(first, sample_size=10) == \
+        utils.sample_digest(second, sample_size=10)
+    assert utils.sample_digest(first, b"1", sample_size=10) != \
+        utils.sample_digest(first, b"2", sample_size=10)
@@ -0,0 +1,61 @@
+import threading
+import time
+
+import pytest
+
+import watcher
+
+
+class Stop(Exception):
+    pass
+
+
+def run(path, handed_over, calls=1, **kwargs):
+    """ polls path until process was called calls times """
+    def process(paths):
+        handed_over.append((time.time(), sorted(paths)))
+        if len(handed_over) >= calls:
+            raise Stop()
+
+    with pytest.raises(Stop):
+        watcher.watch(str(path), ["mp4"], process, mode="poll",
+                      poll_interval=0.02, **kwargs)
+
+
+def test_a_file_is_handed_over_once_it_stopped_growing(tmpdir):
+    video = tmpdir.join("2024-01-07_Title_Preacher.mp4")
+    video.write("")
+    written = []
+
+    def record():
+        for _ in range(10):
+            with open(str(video), "a") as data:
+                data.write("x" * 1000)
+            time.sleep(0.05)
+        written.append(time.time())
+
+    writer = threading.Thread(target=record)
+    writer.start()
+    handed_over = []
+    run(tmpdir, handed_over, settle_time=0.3)
+    writer.join()
+
+    assert handed_over[0][1] == [str(video)]
+    assert handed_over[0][0] >= written[0] + 0.25
+    assert video.size() == 10000
+
+
+def test_only_watched_extensions_are_handed_over(tmpdir):
+    tmpdir.join("notes.txt").write("")
+    tmpdir.join("2024-01-07_Title_Preacher.mp4").write("")
+    handed_over = []
+    run(tmpdir, handed_over, settle_time=0.05)
+    assert handed_over[0][1] == [str(tmpdir.join(
+        "2024-01-07_Title_Preacher.mp4"))]
+
+
+def test_a_file_left_behind_is_offered_again_after_the_retry_time(tmpdir):
+    tmpdir.join("2024-01-07_Title_Preacher.mp4").write("")
+    handed_over = []
+    run(tmpdir, handed_over, calls=2, settle_time=0.05, retry_interval=0.5)
+    assert handed_over[1][0] - handed_over[0][0] >= 0.45
@@ -0,0 +1,108 @@
+import datetime
+import time
+
+import pytest
+
+pytest.importorskip("wordpress_xmlrpc")
+
+from wordpress_xmlrpc import WordPressPost  # noqa: E402
+from wordpress_xmlrpc.compat import xmlrpc_client  # noqa: E402
+
+import post_index  # noqa: E402
+import wp_publish  # noqa: E402
+
+
+class Server(object):
+    """ answers system.multicall with canned responses """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+        self.system = self
+
+    def multicall(self, calls):
+        self.calls.append([call["methodName"] for call in calls])
+        return self.responses.pop(0)
+
+
+class Client(object):
+
+    def __init__(self, server, new_post_id=None):
+        self.server = server
+        self.blog_id = 0
+        self.username = "user"
+        self.password = "password"
+        self.new_post_id = new_post_id
+
+    def call(self, method):
+        return self.new_post_id
+
+
+def publisher(tmpdir, responses, new_post_id=None):
+    instance = wp_publish.WordpressPublisher.__new__(
+        wp_publish.WordpressPublisher)
+    instance.url = "https://example.com"
+    instance.category = "sermon"
+    instance.client = Client(Server(responses), new_post_id)
+    instance.lock = wp_publish.threading.Lock()
+    instance.sync_lock = wp_publish.threading.Lock()
+    instance.queue = []
+    instance.index = post_index.PostIndex(str(tmpdir.join("posts.sqlite")))
+    # no sync with the stand-in client
+    instance.synced = time.monotonic()
+    return instance
+
+
+def sermon(day, title="Title", preacher="Preacher"):
+    post = WordPressPost()
+    post.title = title + " // " + preacher
+    post.content = ""
+    post.date = datetime.datetime(2024, 1, day, 9)
+    return post
+
+
+def fault(code):
+    return {"faultCode": code, "faultString": "fault %d" % code}
+
+
+def test_results_are_mapped_to_their_keys(tmpdir):
+    posts = publisher(tmpdir, [[["11"], fault(500), ["13"]]])
+    for day in (7, 14, 21):
+        posts.queue_post(day, sermon(day))
+
+    results = posts.flush()
+
+    assert posts.client.server.calls == [["wp.newPost"] * 3]
+    assert results[7] == "11" and results[21] == "13"
+    assert isinstance(results[14], xmlrpc_client.Fault)
+    assert posts.existing_post(sermon(21)) == "13"
+    assert posts.existing_post(sermon(14)) is None
+
+
+def test_existing_posts_are_edited_or_kept(tmpdir):
+    posts = publisher(tmpdir, [[[True]]])
+    posts.remember(sermon(7), "5")
+    posts.remember(sermon(14), "6")
+    posts.queue_post("edit", sermon(7))
+    posts.queue_post("keep", sermon(14), replace=False)
+
+    assert posts.flush() == {"edit": "5", "keep": "6"}
+    assert posts.client.server.calls == [["wp.editPost"]]
+
+
+def test_deleted_post_is_created_again(tmpdir):
+    posts = publisher(tmpdir, [[fault(404)]], new_post_id="9")
+    posts.remember(sermon(7), "5")
+    posts.queue_post("key", sermon(7))
+
+    assert posts.flush() == {"key": "9"}
+    assert posts.existing_post(sermon(7)) == "9"
+
+
+def test_posts_of_one_sermon_go_in_later_rounds(tmpdir):
+    posts = publisher(tmpdir, [[["11"]], [[True]]])
+    posts.queue_post("first", sermon(7))
+    posts.queue_post("second", sermon(7))
+
+    assert posts.flush() == {"first": "11", "second": "11"}
+    assert posts.client.server.calls == [["wp.newPost"], ["wp.editPost"]]